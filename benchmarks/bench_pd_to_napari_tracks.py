@@ -0,0 +1,90 @@
+"""
+Benchmark of utils.pd_to_napari_tracks against the previous dict based conversion.
+
+    python benchmarks/bench_pd_to_napari_tracks.py --rows 5000000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from napari_tracking_analysis import utils
+
+
+def legacy_pd_to_napari_tracks(df: pd.DataFrame, track_header, track_meta_header):
+    properties = {}
+
+    columns = list(df.columns)
+
+    for th in track_header:
+        columns.remove(th)
+
+    tg = df.groupby('track_id', as_index=False,
+                    group_keys=True, dropna=True)
+    track_meta = pd.concat([tg['frame'].count(),
+                            tg['intensity_mean'].max()['intensity_mean'],
+                            tg['intensity_mean'].mean()['intensity_mean'],
+                            tg['intensity_mean'].min()['intensity_mean']], axis=1)
+    track_meta.columns = track_meta_header
+
+    properties = df[columns].to_dict()
+    properties = {k: np.array(list(v.values())) for k, v in properties.items()}
+
+    tracks = df[track_header].to_numpy()
+
+    return tracks, properties, track_meta
+
+
+def make_tracks(rows: int, track_length: int = 50, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_tracks = max(1, rows // track_length)
+    track_id = np.repeat(np.arange(n_tracks), track_length)[:rows]
+    frame = np.tile(np.arange(track_length), n_tracks)[:rows]
+    df = pd.DataFrame({
+        'label': rng.integers(1, 100, rows),
+        'y': rng.uniform(0, 512, rows),
+        'x': rng.uniform(0, 512, rows),
+        'intensity_mean': rng.uniform(100, 1000, rows),
+        'intensity_max': rng.uniform(100, 1000, rows),
+        'intensity_min': rng.uniform(100, 1000, rows),
+        'area': rng.integers(4, 20, rows).astype(np.float64),
+        'frame': frame,
+        'track_id': track_id,
+    })
+    return df
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_tracks(args.rows)
+    header = utils.TrackLabels.track_header
+    meta_header = utils.TrackLabels.track_meta_header
+
+    legacy_time, legacy = timeit(legacy_pd_to_napari_tracks, df, header, meta_header, repeat=args.repeat)
+    new_time, new = timeit(utils.pd_to_napari_tracks, df, header, meta_header, repeat=args.repeat)
+
+    np.testing.assert_array_equal(legacy[0], new[0])
+    for k, v in legacy[1].items():
+        np.testing.assert_array_equal(v, new[1][k])
+    pd.testing.assert_frame_equal(legacy[2], new[2])
+
+    print(f"rows: {args.rows}")
+    print(f"legacy pd_to_napari_tracks: {legacy_time:.3f} s")
+    print(f"pd_to_napari_tracks:        {new_time:.3f} s")
+    print(f"speedup: {legacy_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
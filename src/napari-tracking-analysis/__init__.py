@@ -1,6 +1,14 @@
 __version__ = "0.0.3"
-from ._plugin_widget import PluginWidget
 
 __all__ = (
     "PluginWidget"
 )
+
+
+def __getattr__(name):
+    # the widget (Qt, napari) is imported on first use, the process pool workers
+    # import napari_tracking_analysis._workers without it
+    if name == "PluginWidget":
+        from ._plugin_widget import PluginWidget
+        return PluginWidget
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
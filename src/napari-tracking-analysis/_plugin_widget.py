@@ -6,6 +6,7 @@ from napari_tracking_analysis.tracking_widget import TrackingWidget
 from napari_tracking_analysis.filter_widget import PropertyFilter
 from napari_tracking_analysis.base import AppState
 from napari_tracking_analysis.step_analysis_widget import StepAnalysisWidget
+from napari_tracking_analysis.tracks_writer import DEFAULT_CODEC
 from napari_tracking_analysis import utils
 import napari
 import os
@@ -53,14 +54,18 @@ class PluginWidget(QWidget):
         self.btn_save.setMinimumWidth(20)
         self.btn_save.setMinimumHeight(20)
 
+        # uncompressed projects open memory mapped, compressed ones are smaller
+        save_filters = {"Tracks project (*.tracks)": None,
+                        "Compressed tracks project (*.tracks)": DEFAULT_CODEC}
+
         def _save_clicked():
             file_path = QFileDialog.getSaveFileName(self,
                                                     caption="Save Track State Project",
                                                     directory=str(Path.home()),
-                                                    filter="*.tracks")
+                                                    filter=";;".join(save_filters))
             if len(file_path[0]):
                 print(file_path)
-                self.app_state.save(file_path[0])
+                self.app_state.save(file_path[0], codec=save_filters.get(file_path[1]))
         self.btn_save.clicked.connect(_save_clicked)
 
         self.btn_open = QToolButton()
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+import numpy as np
+from qtpy.QtCore import QThreadPool
+from napari_tracking_analysis.base.app_state import AppState
+
+
+def test_leftover_autosaves_skip_running_sessions(qapp, tmp_path):
+    state = AppState()
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    running = tmp_path / f"project.autosave-20240101-000000-{os.getpid()}.tracks"
+    ended = tmp_path / f"project.autosave-20240101-000000-{process.pid}.tracks"
+    running.touch()
+    ended.touch()
+    assert state.leftover_autosaves(str(tmp_path / "project.tracks")) == [str(ended)]
+    state.close()
+
+
+def test_close_removes_running_autosave(qapp, tmp_path):
+    state = AppState()
+    state.project_path = str(tmp_path / "project.tracks")
+    state.setData("image", np.zeros((64, 256, 256), dtype=np.uint16))
+    state.autosave()
+    file_path = state.autosave_path()
+    assert file_path in state._save_workers
+    # the save thread may still be writing, its finished signal is never processed
+    state.close()
+    QThreadPool.globalInstance().waitForDone()
+    assert not os.path.exists(file_path)
@@ -0,0 +1,41 @@
+import threading
+import time
+from concurrent.futures import wait
+from napari.qt.threading import thread_worker
+from napari_tracking_analysis import utils
+from napari_tracking_analysis.base import ClosingGeneratorWorker
+
+
+def test_shutdown_pool_does_not_wait_for_running_tasks():
+    executor = utils._process_pool(2)
+    futures = [executor.submit(time.sleep, 60) for _ in range(4)]
+    # the spawned workers are running the first tasks
+    deadline = time.monotonic() + 30
+    while not any(future.running() for future in futures) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    start = time.monotonic()
+    utils._shutdown_pool(executor, futures)
+    assert time.monotonic() - start < 5
+    # the running tasks fail with a broken pool, the others are cancelled
+    _, not_done = wait(futures, timeout=10)
+    assert not not_done
+
+
+def test_quit_worker_closes_its_generator_in_the_worker_thread(qtbot):
+    closed = []
+
+    @thread_worker(worker_class=ClosingGeneratorWorker, start_thread=False)
+    def _run():
+        try:
+            while True:
+                time.sleep(0.01)
+                yield
+        finally:
+            closed.append(threading.current_thread())
+
+    worker = _run()
+    # quit once the generator runs
+    worker.yielded.connect(worker.quit)
+    with qtbot.waitSignal(worker.finished, timeout=5000):
+        worker.start()
+    assert len(closed) == 1 and closed[0] is not threading.main_thread()
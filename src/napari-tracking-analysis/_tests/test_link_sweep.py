@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pytest
+from napari_tracking_analysis import utils
+
+
+def _detections(n_frames=5, n_spots=60, size=40.0, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'frame': np.repeat(np.arange(n_frames), n_spots),
+                         'y': rng.random(n_frames * n_spots) * size,
+                         'x': rng.random(n_frames * n_spots) * size})
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_link_sweep_records_failed_runs(n_workers):
+    # the spots are dense for a search range of 30, trackpy can not link the subnetworks
+    result = utils.link_sweep(_detections(), [1, 30], [0], n_workers=n_workers)
+    assert list(result.columns) == utils.LINK_SUMMARY_COLUMNS
+    assert result['search_range'].tolist() == [1, 30]
+    linked, failed = result.iloc[0], result.iloc[1]
+    assert linked['error'] == '' and linked['track_count'] > 0
+    assert failed['error'].startswith('SubnetOversizeException')
+    assert np.isnan(failed['track_count'])
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from skimage import measure
+from napari_tracking_analysis import utils
+
+
+def _stack(n_frames=5, shape=(48, 64), dtype=np.uint16, seed=0):
+    # random discs, some touching or crossing the border, and an empty last frame
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((n_frames,) + shape, dtype=np.uint8)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    for t in range(n_frames - 1):
+        for y, x, r in zip(rng.integers(0, shape[0], 8), rng.integers(0, shape[1], 8), rng.integers(1, 5, 8)):
+            masks[t][(yy - y) ** 2 + (xx - x) ** 2 <= r ** 2] = 1
+    images = (rng.random((n_frames,) + shape) * 4000).astype(dtype)
+    return masks, images
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+@pytest.mark.parametrize("generate_label", [True, False])
+def test_bincount_matches_regionprops(dtype, generate_label):
+    masks, images = _stack(dtype=dtype)
+    if not generate_label:
+        masks = np.stack([measure.label(m) for m in masks])
+    expected = utils.get_statck_properties(masks, images, generate_label=generate_label, backend='regionprops')
+    result = utils.get_statck_properties(masks, images, generate_label=generate_label, backend='bincount',
+                                         chunk_size=2)
+    assert list(result.columns) == list(expected.columns)
+    assert len(result) == len(expected) > 0
+    # regionprops averages float32 images in float32, the bincount backend in float64
+    rtol = 1e-6 if dtype == np.float32 else 1e-9
+    for column in expected.columns:
+        np.testing.assert_allclose(result[column].to_numpy(dtype=np.float64),
+                                   expected[column].to_numpy(dtype=np.float64), rtol=rtol, err_msg=column)
+
+
+def test_feature_cache_measures_changed_frames(tmp_path, monkeypatch):
+    masks, images = _stack(n_frames=6)
+    np.save(tmp_path / 'image.npy', images)
+    images = np.load(tmp_path / 'image.npy', mmap_mode='r')
+    cache = utils.FeatureCache()
+    table = cache.get_statck_properties(masks, images)
+    assert table.equals(utils.get_statck_properties(masks, images))
+
+    hashed = []
+    measured = []
+    array_digest = utils.FeatureCache.array_digest
+    measure_frames_iter = utils.measure_frames_iter
+
+    def _array_digest(arr):
+        hashed.append(arr.shape)
+        return array_digest(arr)
+
+    def _measure_frames_iter(*args, **kwargs):
+        measured.extend(kwargs['frames'])
+        return measure_frames_iter(*args, **kwargs)
+
+    monkeypatch.setattr(utils.FeatureCache, 'array_digest', staticmethod(_array_digest))
+    monkeypatch.setattr(utils, 'measure_frames_iter', _measure_frames_iter)
+
+    masks[2] = 0
+    table = cache.get_statck_properties(masks, images)
+    # the unchanged read only mapped image is not hashed again, only the changed frame is measured
+    assert len(hashed) == len(masks)
+    assert measured == [2]
+    assert table.equals(utils.get_statck_properties(masks, images))
+
+    hashed.clear()
+    measured.clear()
+    assert cache.get_statck_properties(masks, images) is table
+    assert len(hashed) == len(masks) and measured == []
+
+
+def test_feature_cache_tells_slices_of_a_file_apart(tmp_path):
+    masks, images = _stack(n_frames=8)
+    np.save(tmp_path / 'image.npy', images)
+    mapped = np.load(tmp_path / 'image.npy', mmap_mode='r')
+    # same shape, dtype and memmap offset, different bytes of the file
+    first, second = mapped[:4], mapped[4:]
+    assert utils.FeatureCache.file_identity(first) != utils.FeatureCache.file_identity(second)
+    assert utils.FeatureCache.file_identity(mapped[::2]) != utils.FeatureCache.file_identity(first)
+    cache = utils.FeatureCache()
+    mask = np.repeat(masks[:1], 4, axis=0)
+    assert cache.get_statck_properties(mask, first).equals(utils.get_statck_properties(mask, first))
+    assert cache.get_statck_properties(mask, second).equals(utils.get_statck_properties(mask, second))
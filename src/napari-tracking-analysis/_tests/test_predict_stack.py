@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from napari_tracking_analysis import utils
+
+
+def _predict(image):
+    # per pixel classifier, the same on a frame or on the whole stack
+    return (np.asarray(image) > 500).astype(np.uint8) + 1
+
+
+@pytest.mark.parametrize("n_frames, chunk_size, n_workers", [(23, 8, None), (23, 5, 1), (4, 8, 2), (0, 8, None)])
+@pytest.mark.parametrize("post_process", [False, True])
+def test_predict_stack_iter_matches_whole_stack(n_frames, chunk_size, n_workers, post_process):
+    rng = np.random.default_rng(0)
+    images = (rng.random((n_frames, 16, 12)) * 1000).astype(np.uint16)
+    expected = _predict(images)
+
+    def _post_process(i, values):
+        return values * (i % 3)
+    if post_process:
+        expected = expected * (np.arange(n_frames) % 3)[:, None, None].astype(np.uint8)
+
+    out = np.zeros(images.shape, dtype=np.uint8)
+    counts = list(utils.predict_stack_iter(_predict, images, out, _post_process if post_process else None,
+                                           chunk_size=chunk_size, n_workers=n_workers))
+    assert sum(counts) == n_frames
+    assert all(0 < count <= chunk_size for count in counts)
+    np.testing.assert_array_equal(out, expected)
@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pytest
+import tifffile
+from napari_tracking_analysis.stack_reader import get_reader, raw_sidecar
+
+
+def _stack(dtype=np.uint16):
+    rng = np.random.default_rng(0)
+    return (rng.random((5, 12, 16)) * 1000).astype(dtype)
+
+
+def _read(path):
+    reader = get_reader(str(path))
+    assert callable(reader)
+    layers = reader(str(path))
+    assert len(layers) == 1
+    data, kwargs, layer_type = layers[0]
+    assert layer_type == "image"
+    assert kwargs == {"name": path.stem}
+    return data
+
+
+def _write_tif(path, stack):
+    tifffile.imwrite(path, stack)
+
+
+def _write_compressed_tif(path, stack):
+    tifffile.imwrite(path, stack, compression='zlib')
+
+
+def _write_npy(path, stack):
+    np.save(path, stack)
+
+
+def _write_raw(path, stack):
+    stack.tofile(path)
+    with open(raw_sidecar(str(path)), 'w') as f:
+        json.dump({"shape": list(stack.shape), "dtype": stack.dtype.name}, f)
+
+
+@pytest.mark.parametrize("name, write", [("stack.tif", _write_tif), ("stack.npy", _write_npy),
+                                         ("stack.raw", _write_raw)])
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_read_mapped_stack(tmp_path, name, write, dtype):
+    stack = _stack(dtype)
+    path = tmp_path / name
+    write(path, stack)
+    data = _read(path)
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    assert data.shape == stack.shape and data.dtype == stack.dtype
+    np.testing.assert_array_equal(data, stack)
+
+
+def test_read_compressed_tif_lazily(tmp_path):
+    import dask.array as da
+    stack = _stack()
+    path = tmp_path / "stack.tif"
+    _write_compressed_tif(path, stack)
+    data = _read(path)
+    # one page read per frame when used
+    assert isinstance(data, da.Array)
+    assert data.shape == stack.shape and data.dtype == stack.dtype
+    assert data.numblocks[0] == stack.shape[0]
+    np.testing.assert_array_equal(np.asarray(data[3]), stack[3])
+    np.testing.assert_array_equal(data.compute(), stack)
+
+
+def test_raw_needs_its_sidecar(tmp_path):
+    path = tmp_path / "stack.raw"
+    _stack().tofile(path)
+    assert get_reader(str(path)) is None
+    assert get_reader(str(tmp_path / "stack.png")) is None
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+from napari_tracking_analysis import utils
+
+
+def _tracks_df(n_tracks=300, seed=0):
+    # noisy piecewise constant traces of random lengths
+    rng = np.random.default_rng(seed)
+    frames = []
+    for track_id in range(n_tracks):
+        length = int(rng.integers(1, 60))
+        levels = np.repeat(rng.normal(0, 5, 4), length // 4 + 1)[:length]
+        frames.append(pd.DataFrame({'track_id': track_id, 'frame': np.arange(length),
+                                    'intensity_mean': levels + rng.normal(0, 1, length)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _find_steps_loop(tracks_df, track_ids, window, threshold):
+    # per track FindSteps tables, as the step analysis did before fit_steps
+    steps = []
+    meta = []
+    for track_id in track_ids:
+        intensity = tracks_df[tracks_df['track_id'] == track_id]['intensity_mean'].to_numpy()
+        steptable, _, _ = utils.FindSteps(data=intensity, window=window, threshold=threshold)
+        steps_df = pd.DataFrame(steptable, columns=utils.STEP_TABLE_COLUMNS)
+        steps_df['track_id'] = track_id
+        steps.append(steps_df)
+        meta.append([track_id, len(steptable),
+                     -len(steps_df[steps_df['step_height'] < 0]),
+                     len(steps_df[steps_df['step_height'] >= 0]),
+                     steps_df['step_height'].mean(),
+                     np.max(intensity), len(intensity)])
+    return pd.concat(steps, ignore_index=True), pd.DataFrame(meta, columns=utils.STEP_META_COLUMNS)
+
+
+@pytest.mark.parametrize("window, threshold", [(1, 0.1), (2, 0.9), (20, 0.9)])
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_fit_steps_matches_find_steps(window, threshold, n_workers):
+    df = _tracks_df()
+    track_ids = df['track_id'].unique()
+    steps_df, steps_meta_df = utils.fit_steps(utils.track_index(df), track_ids, window=window,
+                                              threshold=threshold, n_workers=n_workers, chunk_size=64)
+    expected_steps, expected_meta = _find_steps_loop(df, track_ids, window, threshold)
+    # the traces include steps at index 0, whose height is nan
+    assert steps_df['step_height'].isna().any()
+
+    pd.testing.assert_frame_equal(steps_df[expected_steps.columns], expected_steps, check_dtype=False)
+    pd.testing.assert_frame_equal(steps_meta_df[utils.STEP_META_COLUMNS], expected_meta, check_dtype=False)
+
+
+def test_fit_cache_keeps_the_dwell_table_of_a_run():
+    df = _tracks_df(n_tracks=50)
+    track_ids = df['track_id'].unique()
+    steps_df, steps_meta_df = utils.fit_steps(utils.track_index(df), track_ids, window=2, threshold=0.9)
+    cache = utils.StepFitCache()
+    cache.add_steps(steps_df, steps_meta_df, 2, 0.9, 1)
+    dwell_df = cache.dwell_table(steps_df, steps_meta_df, 2, 0.9, 1)
+    pd.testing.assert_frame_equal(dwell_df, utils.step_dwell_table(steps_df, steps_meta_df))
+    assert cache.dwell_table(steps_df, steps_meta_df, 2, 0.9, 1) is dwell_df
+    # another table of the same parameters or another data version is not the registered run
+    assert cache.dwell_table(steps_df.copy(), steps_meta_df, 2, 0.9, 1) is not dwell_df
+    assert cache.dwell_table(steps_df, steps_meta_df, 2, 0.9, 2) is not dwell_df
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from napari_tracking_analysis import utils
+
+
+def _stack(dtype, n_frames=23, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n_frames, 6, 5)) * 1000).astype(dtype)
+
+
+def _expected(stack, window, method):
+    frames = stack.astype(np.float64)
+    if method == "mean":
+        return np.stack([frames[i:i + window].mean(axis=0) for i in range(len(frames) - window + 1)])
+    if method == "median":
+        return np.stack([np.median(frames[i:i + window], axis=0) for i in range(len(frames) - window + 1)])
+    alpha = 2.0 / (window + 1)
+    state = frames[0].copy()
+    ema = [state.copy()]
+    for frame in frames[1:]:
+        state = state + alpha * (frame - state)
+        ema.append(state.copy())
+    return np.stack(ema[window - 1:])
+
+
+@pytest.mark.parametrize("method", utils.TEMPORAL_FILTERS)
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32, np.float64])
+@pytest.mark.parametrize("window, chunk_size", [(1, 4), (4, 3), (5, 100)])
+def test_temporal_filter(method, dtype, window, chunk_size):
+    stack = _stack(dtype)
+    original = stack.copy()
+    result = utils.temporal_filter(stack, window=window, method=method, chunk_size=chunk_size)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, _expected(original, window, method), rtol=1e-6)
+    # the input (e.g. the layer data) is left as it is
+    np.testing.assert_array_equal(stack, original)
+
+
+def test_ema_of_a_float64_stack():
+    stack = np.array([0, 4, 8, 12, 16], dtype=np.float64).reshape(5, 1, 1)
+    result = utils.temporal_filter(stack, window=1, method="ema")
+    np.testing.assert_array_equal(stack.ravel(), [0, 4, 8, 12, 16])
+    np.testing.assert_allclose(result.ravel(), [0, 4, 8, 12, 16])
+    result = utils.temporal_filter(stack, window=3, method="ema")
+    np.testing.assert_allclose(result.ravel(), [5, 8.5, 12.25])
+
+
+@pytest.mark.parametrize("method", utils.TEMPORAL_FILTERS)
+def test_temporal_filter_of_a_read_only_memmap(tmp_path, method):
+    path = tmp_path / "stack.npy"
+    np.save(path, _stack(np.float64))
+    stack = np.load(path, mmap_mode='r')
+    result = utils.temporal_filter(stack, window=4, method=method, chunk_size=5)
+    np.testing.assert_allclose(result, _expected(np.load(path), 4, method), rtol=1e-6)
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import pytest
+from qtpy.QtCore import Qt, QModelIndex, QPersistentModelIndex
+from napari_tracking_analysis.tracking_widget.track_models import TrackMetaModel, TrackMetaModelProxy
+
+
+def _meta_df(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'track_id': rng.permutation(n),
+        'length': rng.integers(1, 100, n),
+        'intensity_mean': rng.random(n),
+    })
+
+
+def _proxy(df, fetch_batch=None):
+    model = TrackMetaModel(df, 'track_id')
+    if fetch_batch is not None:
+        model.fetch_batch = fetch_batch
+    proxy = TrackMetaModelProxy()
+    proxy.setTrackModel(model)
+    return model, proxy
+
+
+def _fetch_all(model):
+    while model.canFetchMore():
+        model.fetchMore()
+
+
+def _column(model, column):
+    return np.array([model.data(model.index(row, column), Qt.ItemDataRole.UserRole + 1)
+                     for row in range(model.rowCount())])
+
+
+def _accepted(df, ranges):
+    accepted = np.ones(len(df), dtype=bool)
+    for name, (vmin, vmax) in ranges.items():
+        values = df[name].to_numpy()
+        accepted &= (values >= vmin) & (values <= vmax)
+    return accepted
+
+
+def test_proxy_filters_with_the_property_ranges():
+    df = _meta_df()
+    model, proxy = _proxy(df)
+    track_ids = df['track_id'].to_numpy()
+    ranges = {}
+    for name, vrange in [('length', (10, 50)), ('intensity_mean', (0.2, 0.9)),
+                         ('length', (30, 80)), ('intensity_mean', (0.0, 1.0)), ('length', (60, 20))]:
+        ranges[name] = vrange
+        proxy.property_filter_updated(name, vrange)
+        accepted = _accepted(df, ranges)
+        # in the dataframe order while nothing is sorted
+        np.testing.assert_array_equal(proxy.accepted_track_ids(), track_ids[accepted])
+        _fetch_all(proxy)
+        assert proxy.rowCount() == accepted.sum()
+        np.testing.assert_array_equal(_column(proxy, 0), track_ids[accepted])
+        np.testing.assert_array_equal(proxy.update_accepted(), accepted)
+
+
+def test_proxy_maps_to_and_from_source():
+    df = _meta_df(n=200)
+    model, proxy = _proxy(df)
+    proxy.property_filter_updated('length', (20, 60))
+    _fetch_all(proxy)
+    for row in range(proxy.rowCount()):
+        source = proxy.mapToSource(proxy.index(row, 1))
+        assert source.column() == 1
+        assert model.data(source) == proxy.data(proxy.index(row, 1))
+        assert proxy.mapFromSource(source).row() == row
+    rejected = np.flatnonzero(~_accepted(df, {'length': (20, 60)}))
+    assert not proxy.mapFromSource(model.index(int(rejected[0]), 0)).isValid()
+    assert not proxy.mapToSource(QModelIndex()).isValid()
+
+
+def test_proxy_keeps_the_selected_rows():
+    df = _meta_df(n=200)
+    model, proxy = _proxy(df)
+    _fetch_all(proxy)
+    lengths = df['length'].to_numpy()
+    kept = int(np.flatnonzero(lengths >= 50)[-1])
+    dropped = int(np.flatnonzero(lengths < 50)[-1])
+    kept_index = QPersistentModelIndex(proxy.index(kept, 0))
+    dropped_index = QPersistentModelIndex(proxy.index(dropped, 0))
+    proxy.property_filter_updated('length', (50, 100))
+    assert kept_index.isValid()
+    assert proxy.data(proxy.index(kept_index.row(), 0)) == str(df['track_id'].to_numpy()[kept])
+    assert not dropped_index.isValid()
+
+
+@pytest.mark.parametrize("max_row_signals", [0, 64])
+def test_proxy_applies_range_moves_incrementally(qtmodeltester, max_row_signals):
+    df = _meta_df(n=400)
+    model, proxy = _proxy(df, fetch_batch=100)
+    proxy.max_row_signals = max_row_signals
+    # the python model tester raises on an inconsistent signal
+    qtmodeltester.check(proxy, force_py=True)
+    signals = {'removed': 0, 'layout': 0}
+    proxy.rowsRemoved.connect(lambda *args: signals.update(removed=signals['removed'] + 1))
+    proxy.layoutChanged.connect(lambda *args: signals.update(layout=signals['layout'] + 1))
+    track_ids = df['track_id'].to_numpy()
+    selected = QPersistentModelIndex(proxy.index(50, 0))
+    selected_track = proxy.data(proxy.index(50, 0))
+
+    ranges = {}
+    for name, vrange in [('length', (2, 99)), ('length', (3, 99)), ('intensity_mean', (0.0, 0.99)),
+                         ('length', (2, 99)), ('length', (1, 99)), ('intensity_mean', (0.0, 1.0))]:
+        ranges[name] = vrange
+        proxy.property_filter_updated(name, vrange)
+        accepted = _accepted(df, ranges)
+        np.testing.assert_array_equal(proxy.accepted_track_ids(), track_ids[accepted])
+        assert min(100, accepted.sum()) <= proxy.rowCount() <= accepted.sum()
+        np.testing.assert_array_equal(_column(proxy, 0), track_ids[accepted][:proxy.rowCount()])
+        if selected.isValid():
+            assert proxy.data(proxy.index(selected.row(), 0)) == selected_track
+
+    if max_row_signals:
+        assert signals['removed'] and not signals['layout']
+    else:
+        assert signals['layout'] and not signals['removed']
+    _fetch_all(proxy)
+    np.testing.assert_array_equal(_column(proxy, 0), track_ids)
+
+
+def test_model_fetches_rows_in_batches():
+    df = _meta_df(n=250)
+    model = TrackMetaModel(df, 'track_id')
+    model.fetch_batch = 100
+    model.setDataframe(df)
+    rows = []
+    model.rowsInserted.connect(lambda parent, first, last: rows.append((first, last)))
+    assert model.rowCount() == 100
+    _fetch_all(model)
+    assert rows == [(100, 199), (200, 249)]
+    assert model.rowCount() == len(df)
+    assert not model.canFetchMore()
+    np.testing.assert_array_equal(_column(model, 0), df['track_id'].to_numpy())
+
+
+@pytest.mark.parametrize("order", [Qt.SortOrder.AscendingOrder, Qt.SortOrder.DescendingOrder])
+def test_model_sorts_stable(order):
+    df = _meta_df(n=300)
+    model = TrackMetaModel(df, 'track_id')
+    _fetch_all(model)
+    selected = QPersistentModelIndex(model.index(7, 0))
+    model.sort(1, order)
+    expected = df.sort_values('length', ascending=order == Qt.SortOrder.AscendingOrder, kind='stable')
+    np.testing.assert_array_equal(_column(model, 0), expected['track_id'].to_numpy())
+    assert model.data(model.index(selected.row(), 0)) == str(df['track_id'].to_numpy()[7])
+    model.sort(-1)
+    np.testing.assert_array_equal(_column(model, 0), df['track_id'].to_numpy())
+
+
+def test_proxy_and_source_sort_independently():
+    df = _meta_df(n=300)
+    model, proxy = _proxy(df)
+    _fetch_all(model)
+    proxy.property_filter_updated('length', (20, 60))
+    _fetch_all(proxy)
+    accepted = df[_accepted(df, {'length': (20, 60)})]
+
+    proxy.sort(2, Qt.SortOrder.DescendingOrder)
+    expected = accepted.sort_values('intensity_mean', ascending=False, kind='stable')['track_id'].to_numpy()
+    np.testing.assert_array_equal(_column(proxy, 0), expected)
+    # the source model keeps the dataframe order
+    np.testing.assert_array_equal(_column(model, 0), df['track_id'].to_numpy())
+
+    selected = QPersistentModelIndex(proxy.index(3, 0))
+    model.sort(1)
+    np.testing.assert_array_equal(_column(model, 0), df.sort_values('length', kind='stable')['track_id'].to_numpy())
+    np.testing.assert_array_equal(_column(proxy, 0), expected)
+    assert selected.row() == 3
+    for row in range(proxy.rowCount()):
+        source = proxy.mapToSource(proxy.index(row, 0))
+        assert model.data(source) == proxy.data(proxy.index(row, 0))
+        assert proxy.mapFromSource(source).row() == row
+
+    # the range moves keep the sort order of the proxy
+    for vrange in [(30, 90), (1, 99), (40, 50)]:
+        proxy.property_filter_updated('length', vrange)
+        _fetch_all(proxy)
+        accepted = df[_accepted(df, {'length': vrange})]
+        np.testing.assert_array_equal(
+            _column(proxy, 0), accepted.sort_values('intensity_mean', ascending=False, kind='stable')['track_id'])
+    proxy.sort(-1)
+    np.testing.assert_array_equal(_column(proxy, 0), accepted['track_id'].to_numpy())
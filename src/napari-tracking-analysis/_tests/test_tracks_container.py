@@ -0,0 +1,260 @@
+import gc
+import gzip
+import importlib.util
+import mmap
+import os
+import json
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from napari_tracking_analysis.tracks_writer import (write_container, append_container, compact_container,
+                                                     superseded_size, FORMAT_NAME, FORMAT_VERSION, MANIFEST_NAME)
+from napari_tracking_analysis.tracks_reader import state_reader, is_container, file_in_use, TracksContainerReader
+
+
+def _tracks_df(n=100):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'track_id': np.repeat(np.arange(n // 10), 10),
+        'frame': np.tile(np.arange(10), n // 10),
+        'y': rng.random(n),
+        'x': rng.random(n),
+        'intensity_mean': rng.random(n).astype(np.float32),
+    })
+
+
+def _state(df):
+    return {
+        "tracking": {"tracks_df": df, "meta_df": df.groupby('track_id', as_index=False).size(),
+                     "tracking_params": {"search_range": 2.5, "memory": 1}},
+        "image": np.arange(24, dtype=np.uint16).reshape(2, 3, 4),
+    }
+
+
+@pytest.mark.parametrize("codec", [None, "gzip", pytest.param("zstd", marks=pytest.mark.skipif(
+    importlib.util.find_spec("zstandard") is None, reason="zstd needs the zstd extra (zstandard)"))])
+@pytest.mark.parametrize("lazy", [False, True])
+def test_container_round_trip(tmp_path, codec, lazy):
+    path = str(tmp_path / "state.tracks")
+    df = _tracks_df()
+    write_container(path, _state(df), codec=codec)
+    assert is_container(path)
+
+    data = state_reader(path, lazy=lazy)
+    pd.testing.assert_frame_equal(data["tracking"]["tracks_df"], df)
+    assert data["tracking"]["tracking_params"] == {"search_range": 2.5, "memory": 1}
+    np.testing.assert_array_equal(data["image"], _state(df)["image"])
+
+
+def test_container_extension_dtypes(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    df = pd.DataFrame({
+        'nullable_int': pd.array([1, None, 3], dtype='Int64'),
+        'nullable_float': pd.array([1.5, None, 2.0], dtype='Float32'),
+        'nullable_bool': pd.array([True, None, False], dtype='boolean'),
+        'category': pd.Categorical(['a', 'b', 'a'], ordered=True),
+        'time': pd.date_range('2024-01-01', periods=3, tz='Europe/Paris'),
+        'string': pd.array(['x', None, 'z'], dtype='string'),
+        'object': [1, 'a', None],
+    }, index=pd.Index(['r1', 'r2', 'r3'], name='rows'))
+    write_container(path, {"df": df})
+    pd.testing.assert_frame_equal(state_reader(path)["df"], df)
+
+
+def test_container_rejects_unsupported_dtype(tmp_path):
+    path = tmp_path / "state.tracks"
+    df = pd.DataFrame({'period': pd.period_range('2024-01-01', periods=3, freq='D')})
+    with pytest.raises(TypeError, match="period"):
+        write_container(str(path), {"df": df})
+    # the failed save leaves nothing behind
+    assert not path.exists()
+    assert not (tmp_path / "state.tracks.tmp").exists()
+
+
+def test_container_refuses_newer_version(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(MANIFEST_NAME, json.dumps({"format": FORMAT_NAME, "version": FORMAT_VERSION + 1, "data": {}}))
+    with pytest.raises(ValueError, match="format version"):
+        state_reader(path)
+
+
+def test_read_version_1(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    df = _tracks_df()
+    with gzip.open(path, 'wb') as f:
+        f.write(json.dumps({"tracking": {"tracks_df": df.to_json(), "tracking_params": {"memory": 1}}}).encode('utf-8'))
+    assert not is_container(path)
+    data = state_reader(path)
+    pd.testing.assert_frame_equal(data["tracking"]["tracks_df"], df, check_dtype=False)
+    assert data["tracking"]["tracking_params"] == {"memory": 1}
+
+
+def test_lazy_open_maps_saved_columns(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    df = _tracks_df()
+    # default save, uncompressed
+    write_container(path, _state(df))
+
+    data = state_reader(path, lazy=True)
+    assert not data["tracking"].is_loaded("tracks_df")
+    x = data["tracking"]["tracks_df"]["x"].to_numpy()
+    base = x
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    assert isinstance(getattr(base, "obj", base), mmap.mmap)
+    np.testing.assert_array_equal(x, df["x"].to_numpy())
+
+
+def test_lazy_value_decoded_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _state(_tracks_df()))
+    decode = TracksContainerReader.decode
+
+    def _slow_decode(self, obj, lazy=False):
+        time.sleep(0.05)
+        return decode(self, obj, lazy=lazy)
+    monkeypatch.setattr(TracksContainerReader, "decode", _slow_decode)
+
+    data = state_reader(path, lazy=True)
+    tracking = data["tracking"]
+    # a background decode and the GUI thread reading the same value
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        decoded = list(executor.map(lambda _: tracking["tracks_df"], range(8)))
+    assert all(df is decoded[0] for df in decoded)
+    assert len(data.memo) == 1
+
+
+def test_lazy_values_decoded_concurrently(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _state(_tracks_df()))
+    decode = TracksContainerReader.decode
+    release = threading.Event()
+
+    def _blocked_decode(self, obj, lazy=False):
+        if "__dataframe__" in obj and any(c["name"] == "frame" for c in obj["__dataframe__"]["columns"]):
+            release.wait(5)
+        return decode(self, obj, lazy=lazy)
+    monkeypatch.setattr(TracksContainerReader, "decode", _blocked_decode)
+
+    tracking = state_reader(path, lazy=True)["tracking"]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tracks_df = executor.submit(lambda: tracking["tracks_df"])
+        # the other values of the file are not held up by a decode in progress
+        assert isinstance(tracking["meta_df"], pd.DataFrame)
+        assert not tracks_df.done()
+        release.set()
+        pd.testing.assert_frame_equal(tracks_df.result(), _tracks_df())
+
+
+def _results_state(n=100_000):
+    rng = np.random.default_rng(1)
+    steps_df = pd.DataFrame({'track_id': np.arange(n), 'step_height': rng.random(n)})
+    return {"stepanalysis_result": {"5_0.5_1": {"steps_df": steps_df, "parameters": {"window": 5}}}}
+
+
+def test_delta_save_reuses_decoded_blocks(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _results_state())
+    size = os.path.getsize(path)
+
+    data = state_reader(path, lazy=True)
+    results = data["stepanalysis_result"]
+    # decoded, as the result tabs do
+    assert len(results["5_0.5_1"]["steps_df"]) == 100_000
+    results["5_0.5_2"] = {"steps_df": pd.DataFrame({'track_id': [1], 'step_height': [0.5]}),
+                          "parameters": {"window": 5}}
+    append_container(path, {"stepanalysis_result": results}, {"stepanalysis_result"}, memo=data.memo)
+
+    # only the new result and a manifest are appended
+    assert os.path.getsize(path) - size < 10_000
+    superseded, _ = superseded_size(path)
+    assert superseded < 10_000
+    reopened = state_reader(path)["stepanalysis_result"]
+    assert sorted(reopened) == ["5_0.5_1", "5_0.5_2"]
+    pd.testing.assert_frame_equal(reopened["5_0.5_1"]["steps_df"], _results_state()["stepanalysis_result"]["5_0.5_1"]["steps_df"])
+
+
+def test_superseded_blocks(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    df = _tracks_df(10_000)
+    write_container(path, _state(df))
+    assert superseded_size(path)[0] == 0
+    state = _state(df.copy())
+    append_container(path, state, {"tracking"})
+    superseded, size = superseded_size(path)
+    # the first tracks_df is not used anymore
+    assert superseded > df.memory_usage(index=False).sum()
+    assert superseded < size
+
+
+def test_compact_container(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _state(_tracks_df(10_000)))
+    new_df = _tracks_df(10_000).iloc[::-1]
+    append_container(path, _state(new_df), {"tracking"})
+    compact_container(path)
+    superseded, size = superseded_size(path)
+    assert superseded == 0
+    assert size < 2 * new_df.memory_usage(index=False).sum()
+    pd.testing.assert_frame_equal(state_reader(path)["tracking"]["tracks_df"], new_df)
+
+
+def test_file_in_use_while_mapped(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _state(_tracks_df()))
+    assert not file_in_use(path)
+    # a non lazy read closes the file
+    state_reader(path)
+    assert not file_in_use(path)
+
+    data = state_reader(path, lazy=True)
+    x = data["tracking"]["tracks_df"]["x"]
+    assert file_in_use(path)
+    del data
+    gc.collect()
+    # the reader is gone, the column still maps the file
+    assert file_in_use(path)
+    del x
+    gc.collect()
+    assert not file_in_use(path)
+
+
+def test_interrupted_append_reads_previous_save(tmp_path):
+    path = str(tmp_path / "state.tracks")
+    df = _tracks_df()
+    write_container(path, _state(df))
+    size = os.path.getsize(path)
+    append_container(path, _state(_tracks_df(200)), {"tracking"})
+    # the append stopped before its central directory was written
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 30)
+    assert os.path.getsize(path) > size
+
+    pd.testing.assert_frame_equal(state_reader(path)["tracking"]["tracks_df"], df)
+    # the next delta save goes after the interrupted one
+    new_df = _tracks_df(300)
+    append_container(path, _state(new_df), {"tracking"})
+    pd.testing.assert_frame_equal(state_reader(path)["tracking"]["tracks_df"], new_df)
+
+
+def test_open_error_closes_the_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.tracks")
+    write_container(path, _state(_tracks_df()))
+    windows = []
+
+    def _zip_file(file, *args, **kwargs):
+        # the path does not open, its end records are then opened from the file
+        if isinstance(file, str):
+            raise zipfile.BadZipFile(file)
+        windows.append(file)
+        raise OSError("read error")
+
+    monkeypatch.setattr(zipfile, 'ZipFile', _zip_file)
+    with pytest.raises(OSError):
+        TracksContainerReader(path)
+    assert len(windows) == 1 and windows[0]._file.closed
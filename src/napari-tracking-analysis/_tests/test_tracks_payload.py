@@ -0,0 +1,63 @@
+import gc
+import numpy as np
+import pandas as pd
+from napari_tracking_analysis import utils
+
+
+def _tracks_df(n=60):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'track_id': np.repeat(np.arange(n // 10), 10),
+        'frame': np.tile(np.arange(10), n // 10),
+        'y': rng.random(n),
+        'x': rng.random(n),
+        'intensity_mean': rng.random(n),
+        'area': rng.integers(1, 20, n),
+    })
+
+
+def test_payload_matches_pd_to_napari_tracks():
+    df = _tracks_df()
+    tracks, properties, track_meta = utils.napari_tracks_payload(df)
+    expected = utils.pd_to_napari_tracks(df, utils.TrackLabels.track_header, utils.TrackLabels.track_meta_header)
+    np.testing.assert_array_equal(tracks, expected[0])
+    assert properties.keys() == expected[1].keys()
+    for k in properties:
+        np.testing.assert_array_equal(properties[k], expected[1][k])
+    pd.testing.assert_frame_equal(track_meta, expected[2])
+
+
+def test_payload_cache_hit_and_miss(monkeypatch):
+    calls = []
+    pd_to_napari_tracks = utils.pd_to_napari_tracks
+
+    def _counting(*args, **kwargs):
+        calls.append(args[0])
+        return pd_to_napari_tracks(*args, **kwargs)
+
+    monkeypatch.setattr(utils, 'pd_to_napari_tracks', _counting)
+    df = _tracks_df()
+    payload = utils.napari_tracks_payload(df)
+    # hit: the same DataFrame object shares the payload
+    assert utils.napari_tracks_payload(df) is payload
+    assert len(calls) == 1
+
+    # miss: an equal but different DataFrame, or other headers
+    other = df.copy()
+    assert utils.napari_tracks_payload(other) is not payload
+    meta_header = ['track_id', 'len', 'i_max', 'i_mean', 'i_min']
+    assert list(utils.napari_tracks_payload(df, track_meta_header=meta_header)[2].columns) == meta_header
+    assert len(calls) == 3
+    assert utils.napari_tracks_payload(df) is payload
+    assert len(calls) == 3
+
+
+def test_payload_released_with_dataframe():
+    df = _tracks_df()
+    utils.napari_tracks_payload(df)
+    key = (id(df), ('napari_tracks', tuple(utils.TrackLabels.track_header),
+                    tuple(utils.TrackLabels.track_meta_header)))
+    assert key in utils._dataframe_cache
+    del df
+    gc.collect()
+    assert key not in utils._dataframe_cache
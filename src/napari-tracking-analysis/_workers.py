@@ -0,0 +1,363 @@
+"""
+Process pool tasks. This module only imports numpy, pandas, scipy, scikit-image and trackpy (not Qt or napari),
+so unpickling a task does not import them. The pools are started with spawn (see utils._process_pool),
+a spawned worker still re-imports the main module of the parent process, e.g. napari's entry point
+"""
+import numpy as np
+import pandas as pd
+from skimage import measure
+
+
+PROPERTIES_KEYS = ['label', 'centroid', 'intensity_mean',
+                   'intensity_max', 'intensity_min', 'area']
+
+
+def _frame_columns(frame: int, mask: np.ndarray, image: np.ndarray = None, generate_label: bool = True) -> dict:
+    """
+    Measure a single frame and return the region properties as a dict of column arrays
+    """
+    mask_label = measure.label(mask) if generate_label else mask
+    columns = measure.regionprops_table(
+        label_image=mask_label, intensity_image=image, properties=PROPERTIES_KEYS)
+    columns['frame'] = np.full(len(columns['label']), frame, dtype=np.int64)
+    return columns
+
+
+def _chunk_columns(frames: np.ndarray, masks: np.ndarray, images: np.ndarray, generate_label: bool = True) -> list:
+    """
+    Process pool task, measures a chunk of frames, masks[i] and images[i] belong to frames[i]
+    """
+    return [_frame_columns(frame=frame, mask=masks[i], image=images[i], generate_label=generate_label)
+            for i, frame in enumerate(frames)]
+
+
+def _chunk_columns_bincount(frames: np.ndarray, masks: np.ndarray, images: np.ndarray, generate_label: bool = True) -> list:
+    """
+    Process pool task, vectorized alternative of `_chunk_columns`.
+    The frames of the chunk get non overlapping label ranges and all the regions of the chunk
+    are measured with labeled reductions (np.bincount) over the foreground pixels in one pass
+    """
+    n_frames, height, width = masks.shape
+    labels = np.zeros(masks.shape, dtype=np.int64)
+    offsets = np.zeros(n_frames + 1, dtype=np.int64)
+    for i in range(n_frames):
+        frame_label = measure.label(masks[i]) if generate_label else np.asarray(masks[i])
+        foreground = frame_label > 0
+        labels[i][foreground] = frame_label[foreground] + offsets[i]
+        offsets[i + 1] = offsets[i] + (frame_label.max() if frame_label.size else 0)
+
+    pixels = np.flatnonzero(labels)
+    pixel_labels = labels.ravel()[pixels]
+    intensity = np.asarray(images).ravel()[pixels].astype(np.float64)
+    pixels = pixels % (height * width)
+    n_labels = offsets[-1] + 1
+
+    area = np.bincount(pixel_labels, minlength=n_labels)
+    sum_y = np.bincount(pixel_labels, weights=pixels // width, minlength=n_labels)
+    sum_x = np.bincount(pixel_labels, weights=pixels % width, minlength=n_labels)
+    sum_intensity = np.bincount(pixel_labels, weights=intensity, minlength=n_labels)
+
+    # unbuffered reductions, every pixel of a label is compared
+    intensity_min = np.full(n_labels, np.inf, dtype=np.float64)
+    intensity_max = np.full(n_labels, -np.inf, dtype=np.float64)
+    np.minimum.at(intensity_min, pixel_labels, intensity)
+    np.maximum.at(intensity_max, pixel_labels, intensity)
+
+    present = np.flatnonzero(area)
+    present = present[present > 0]
+    frame_index = np.searchsorted(offsets, present, side='left') - 1
+    bounds = np.searchsorted(frame_index, np.arange(n_frames + 1), side='left')
+    present_area = area[present].astype(np.float64)
+    columns = {
+        'label': present - offsets[frame_index],
+        'centroid-0': sum_y[present] / present_area,
+        'centroid-1': sum_x[present] / present_area,
+        'intensity_mean': sum_intensity[present] / present_area,
+        'intensity_max': intensity_max[present],
+        'intensity_min': intensity_min[present],
+        'area': present_area,
+    }
+
+    result = []
+    for i in range(n_frames):
+        frame_columns = {k: v[bounds[i]:bounds[i + 1]] for k, v in columns.items()}
+        frame_columns['frame'] = np.full(bounds[i + 1] - bounds[i], frames[i], dtype=np.int64)
+        result.append(frame_columns)
+    return result
+
+
+def _iter_frame_coords(coords: np.ndarray):
+    """
+    Yield (frame, positions) from a frame sorted [frame, y, x] array, missing frames are empty
+    """
+    frames = coords[:, 0].astype(np.int64)
+    if not len(frames):
+        return
+    unique_frames, counts = np.unique(frames, return_counts=True)
+    positions = np.split(coords[:, 1:], np.cumsum(counts)[:-1])
+    idx = 0
+    for frame in range(unique_frames[0], unique_frames[-1] + 1):
+        if frame == unique_frames[idx]:
+            yield frame, positions[idx]
+            idx += 1
+        else:
+            yield frame, np.empty((0, coords.shape[1] - 1))
+
+
+def link_summary(coords: np.ndarray, search_range: float = 2, memory: int = 0) -> dict:
+    """
+    Link the detections with trackpy and summarise the result
+
+    params:
+        coords: np.ndarray (N, 3) [frame, y, x] sorted by frame
+        search_range: float
+        memory: int
+
+    returns:
+        dict with the track count, track length distribution and the fraction of
+        linking subnetworks (more than one candidate) over all the linked subnetworks.
+        A run trackpy can not link (a subnetwork too large for the search range) is
+        recorded with nan values and the message of the error, error is '' otherwise
+    """
+    from trackpy.linking import Linker, SubnetOversizeException
+    linker = Linker(search_range, memory=memory)
+    subnet_linker = linker.subnet_linker
+    subnet_count = {'all': 0, 'multi': 0}
+
+    # count the subnetworks handed to the subnet linker before they are resolved
+    def _counting_subnet_linker(source_set, dest_set, *args, **kwargs):
+        if len(source_set):
+            subnet_count['all'] += 1
+            if len(source_set) > 1 or len(dest_set) > 1:
+                subnet_count['multi'] += 1
+        return subnet_linker(source_set, dest_set, *args, **kwargs)
+    linker.subnet_linker = _counting_subnet_linker
+
+    particle_ids = []
+    try:
+        for i, (frame, positions) in enumerate(_iter_frame_coords(coords)):
+            if i == 0:
+                linker.init_level(positions, frame)
+            else:
+                linker.next_level(positions, frame)
+            particle_ids.extend(linker.particle_ids)
+    except SubnetOversizeException as e:
+        summary = dict.fromkeys(LINK_SUMMARY_COLUMNS, np.nan)
+        summary.update(search_range=search_range, memory=memory, error=f"{type(e).__name__}: {e}")
+        return summary
+
+    lengths = np.bincount(np.asarray(particle_ids, dtype=np.int64))
+    lengths = lengths[lengths > 0]
+    if not len(lengths):
+        lengths = np.zeros(1, dtype=np.int64)
+    return {
+        'search_range': search_range,
+        'memory': memory,
+        'track_count': int(np.count_nonzero(lengths)),
+        'length_min': int(lengths.min()),
+        'length_p25': float(np.percentile(lengths, 25)),
+        'length_median': float(np.median(lengths)),
+        'length_mean': float(lengths.mean()),
+        'length_p75': float(np.percentile(lengths, 75)),
+        'length_max': int(lengths.max()),
+        'subnet_fraction': (subnet_count['multi'] / subnet_count['all']) if subnet_count['all'] else 0.0,
+        'error': '',
+    }
+
+
+LINK_SUMMARY_COLUMNS = ['search_range', 'memory', 'track_count', 'length_min', 'length_p25', 'length_median',
+                        'length_mean', 'length_p75', 'length_max', 'subnet_fraction', 'error']
+
+
+# detections shared by the sweep worker processes, set by _init_sweep_worker
+_sweep_coords = None
+
+
+def _init_sweep_worker(coords: np.ndarray):
+    global _sweep_coords
+    _sweep_coords = coords
+
+
+def _sweep_task(search_range: float, memory: int) -> dict:
+    return link_summary(_sweep_coords, search_range=search_range, memory=memory)
+
+
+STEP_TABLE_COLUMNS = ["step_index", "level_before", "level_after",
+                      "step_height", "dwell_before", "dwell_after", "measured_error"]
+
+
+def _reflect_indices(lengths: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Source index of every sample of the traces padded by `radius` on both sides
+    with scipy.ndimage 'reflect' mode (d c b a | a b c d | d c b a), local to each trace
+    """
+    padded_lengths = lengths + 2 * radius
+    trace_lengths = np.repeat(lengths, padded_lengths)
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(padded_lengths[:-1], out=starts[1:])
+    position = np.arange(padded_lengths.sum()) - np.repeat(starts, padded_lengths) - radius
+    position = np.mod(position, 2 * trace_lengths)
+    return np.where(position < trace_lengths, position, 2 * trace_lengths - 1 - position)
+
+
+def find_steps_batch(values: np.ndarray, offsets: np.ndarray, window=20, threshold=0.5):
+    """
+    FindSteps for many traces at once, trace i is values[offsets[i]:offsets[i+1]]
+    (see TrackIndex.ragged). The derivative of Gaussian filter, the edge detection and
+    the segment levels / dwell times / errors are computed for all the traces together.
+
+    returns:
+        steps: pd.DataFrame ['trace'] + STEP_TABLE_COLUMNS, one row per step in trace order,
+               'trace' is the position of the trace in offsets
+        fitx: np.ndarray fitted levels, same layout as values
+        gaussian_normalise: np.ndarray same layout as values
+    """
+    from scipy.ndimage import gaussian_filter1d, correlate1d
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    n_values = offsets[-1] - offsets[0]
+    values = values[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+    fitx = np.zeros(values.shape)
+    gaussian_normalise = np.zeros(values.shape)
+    steps = pd.DataFrame({k: np.zeros(0, dtype=np.int64 if k in ('trace', 'step_index', 'dwell_before', 'dwell_after')
+                                   else np.float64) for k in ['trace'] + STEP_TABLE_COLUMNS})
+    non_empty = np.flatnonzero(lengths)
+    if not n_values:
+        return steps, fitx, gaussian_normalise
+
+    # filter all the traces with one correlation over the reflect padded traces,
+    # the weights are the ones gaussian_filter1d uses (taken from its impulse response)
+    radius = int(4.0 * float(window) + 0.5)
+    impulse = np.zeros(2 * radius + 1)
+    impulse[radius] = 1
+    weights = gaussian_filter1d(impulse, window, order=1, mode='constant')[::-1]
+    trace_lengths = lengths[non_empty]
+    padded_starts = np.zeros(len(non_empty), dtype=np.int64)
+    np.cumsum(trace_lengths[:-1] + 2 * radius, out=padded_starts[1:])
+    source = _reflect_indices(trace_lengths, radius) + np.repeat(offsets[non_empty], trace_lengths + 2 * radius)
+    filtered = correlate1d(values[source], weights, mode='constant')
+    interior = np.repeat(padded_starts + radius - offsets[non_empty], trace_lengths) + np.arange(n_values)
+    gaussian_data = filtered[interior]
+
+    # normalise every trace by its own maximum
+    starts = offsets[non_empty]
+    gaussian_max = np.maximum.reduceat(np.abs(gaussian_data), starts)
+    gaussian_normalise = np.abs(gaussian_data / np.repeat(gaussian_max, trace_lengths))
+
+    # threshold crossings inside each trace, the k-th up crossing pairs with the k-th down crossing
+    peaks = np.where(gaussian_normalise > threshold, 1, 0)
+    peaks_dif = np.diff(peaks)
+    inside = np.ones(len(peaks_dif), dtype=bool)
+    boundaries = offsets[1:-1]
+    inside[boundaries[(boundaries > 0) & (boundaries < n_values)] - 1] = False
+    trace_of = np.repeat(np.arange(len(lengths)), lengths)
+    ups = np.flatnonzero((peaks_dif == 1) & inside)
+    dns = np.flatnonzero((peaks_dif == -1) & inside)
+
+    def _rank_key(positions):
+        traces = trace_of[positions]
+        first = np.searchsorted(traces, traces, side='left')
+        return traces * (n_values + 1) + (np.arange(len(positions)) - first)
+
+    up_key = _rank_key(ups)
+    dn_key = _rank_key(dns)
+    match = np.searchsorted(dn_key, up_key)
+    matched = match < len(dn_key)
+    matched[matched] = dn_key[match[matched]] == up_key[matched]
+    ups = ups[matched]
+    dns = dns[match[matched]]
+    non_empty_slice = dns > ups
+    ups = ups[non_empty_slice]
+    dns = dns[non_empty_slice]
+    if not len(ups):
+        return steps, fitx, gaussian_normalise
+
+    # first argmax of gaussian_normalise[u:d] for every pair
+    slice_lengths = dns - ups
+    slice_starts = np.zeros(len(ups), dtype=np.int64)
+    np.cumsum(slice_lengths[:-1], out=slice_starts[1:])
+    local = np.arange(slice_lengths.sum()) - np.repeat(slice_starts, slice_lengths)
+    slice_values = gaussian_normalise[np.repeat(ups, slice_lengths) + local]
+    slice_max = np.maximum.reduceat(slice_values, slice_starts)
+    candidates = np.where(slice_values == np.repeat(slice_max, slice_lengths), local, n_values)
+    indices = ups + np.minimum.reduceat(candidates, slice_starts)
+
+    # segments of the traces with steps: [trace start, index_0), [index_0, index_1), ... [index_n, trace end)
+    step_trace = trace_of[indices]
+    stepped = np.unique(step_trace)
+    segment_starts = np.concatenate([offsets[stepped], indices])
+    is_step = np.concatenate([np.zeros(len(stepped), dtype=bool), np.ones(len(indices), dtype=bool)])
+    order = np.lexsort((is_step, segment_starts))
+    segment_starts = segment_starts[order]
+    is_step = is_step[order]
+    segment_trace = np.concatenate([stepped, step_trace])[order]
+    segment_ends = np.append(segment_starts[1:], 0)
+    last = np.append(segment_trace[1:] != segment_trace[:-1], True)
+    segment_ends[last] = offsets[segment_trace[last] + 1]
+    segment_lengths = segment_ends - segment_starts
+
+    padded_values = np.append(values, 0).astype(np.float64)
+    bounds = np.column_stack([segment_starts, segment_ends]).ravel()
+    # a step at index 0 leaves an empty first segment, its level is nan like np.mean([])
+    empty = segment_lengths == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        level = np.add.reduceat(padded_values, bounds)[::2] / segment_lengths
+    level[empty] = np.nan
+    rows = np.repeat(segment_starts, segment_lengths) + \
+        (np.arange(segment_lengths.sum()) - np.repeat(np.cumsum(segment_lengths) - segment_lengths, segment_lengths))
+    fitx[rows] = np.repeat(level, segment_lengths)
+    deviation = np.zeros(len(padded_values))
+    deviation[rows] = (padded_values[rows] - fitx[rows]) ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = np.add.reduceat(deviation, bounds)[::2] / segment_lengths
+    variance[empty] = np.nan
+
+    # every segment but the first one of a trace starts at a step
+    after = np.flatnonzero(is_step)
+    before = after - 1
+    steps = pd.DataFrame({
+        'trace': segment_trace[after],
+        'step_index': segment_starts[after] - offsets[segment_trace[after]],
+        'level_before': level[before],
+        'level_after': level[after],
+        'step_height': level[after] - level[before],
+        'dwell_before': segment_lengths[before],
+        'dwell_after': segment_lengths[after],
+        'measured_error': np.sqrt(variance[after] + variance[before]),
+    })
+    return steps, fitx, gaussian_normalise
+
+
+def _fit_steps_chunk(track_ids: np.ndarray, values: np.ndarray, offsets: np.ndarray, window=20, threshold=0.5):
+    """
+    steps_df and steps_meta_df of the traces values[offsets[i]:offsets[i+1]] of track_ids[i]
+    """
+    steps, _, _ = find_steps_batch(values, offsets, window=window, threshold=threshold)
+
+    trace = steps['trace'].to_numpy()
+    height = steps['step_height'].to_numpy()
+    n_tracks = len(track_ids)
+    step_count = np.bincount(trace, minlength=n_tracks)
+    # a step at index 0 has a nan height, counted neither negative nor positive
+    # and left out of the mean as in the per track FindSteps tables
+    negetive = np.bincount(trace[height < 0], minlength=n_tracks)
+    positive = np.bincount(trace[height >= 0], minlength=n_tracks)
+    valid = ~np.isnan(height)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        height_mean = np.bincount(trace[valid], weights=height[valid], minlength=n_tracks) / \
+            np.bincount(trace[valid], minlength=n_tracks)
+    lengths = np.diff(offsets)
+    max_intensity = np.maximum.reduceat(values, offsets[:-1]) if len(values) else np.zeros(0, dtype=values.dtype)
+
+    steps_df = steps[STEP_TABLE_COLUMNS].reset_index(drop=True)
+    steps_df['track_id'] = track_ids[trace]
+    steps_meta_df = pd.DataFrame({'track_id': track_ids,
+                                  'step_count': step_count,
+                                  'negetive_steps': -negetive,
+                                  'positive_steps': positive,
+                                  'step_height': height_mean,
+                                  'max_intensity': max_intensity,
+                                  'length': lengths})
+    return steps_df, steps_meta_df
@@ -1,5 +1,5 @@
 from .app_state import AppState
-from .widget import NLayerWidget
+from .widget import NLayerWidget, ClosingGeneratorWorker
 from .sliders import HFilterSlider, HRangeSlider
 from .plots import Histogram, IntensityStepPlots
 from .histogram_grid import HistogramGrid
@@ -7,7 +7,7 @@ from ..filter_widget.properties_histogram import PropertiesHistogram
 
 __all__ = (
     "AppState",
-    "NLayerWidget",
+    "NLayerWidget", "ClosingGeneratorWorker",
     "TrackMetaModel", "TrackMetaModelProxy",
     "HFilterSlider", "HRangeSlider",
     "PropertiesHistogram", "Histogram", "IntensityStepPlots", "HistogramGrid", "PropertiesHistogram"
@@ -1,16 +1,94 @@
-from qtpy.QtCore import QObject, Signal
+import glob
+import os
+import threading
+import time
+import zipfile
+from collections.abc import Mapping
+from pathlib import Path
+from qtpy.QtCore import QObject, Signal, QTimer, QCoreApplication
 import napari
 from napari.utils.events import Event
-from napari_tracking_analysis.tracks_writer import state_write
-from napari_tracking_analysis.tracks_reader import state_reader
+from napari.utils.notifications import Notification, NotificationSeverity, notification_manager
+from napari.qt.threading import thread_worker
+from napari_tracking_analysis.tracks_writer import (write_container, append_container, compact_container,
+                                                     superseded_size)
+from napari_tracking_analysis.tracks_reader import state_reader, is_container, file_in_use, LazyMapping
 import warnings
 from napari_tracking_analysis import utils
 
 
+def _snapshot(value):
+    """
+    copy of the nested dicts of a value (the other values are shared),
+    so a save running in a thread does not see the dicts changed meanwhile
+    """
+    if isinstance(value, LazyMapping):
+        copy = value.copy()
+        for k in value:
+            if value.is_loaded(k):
+                copy[k] = _snapshot(value[k])
+        return copy
+    if isinstance(value, Mapping):
+        return {k: _snapshot(v) for k, v in value.items()}
+    return value
+
+
+def _process_alive(pid: int) -> bool:
+    """
+    a process with the pid is running (os.kill(pid, 0) would terminate it on windows)
+    """
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        try:
+            # STILL_ACTIVE
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and exit_code.value == 259
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _autosave_owner_alive(file_path) -> bool:
+    """
+    the session writing the autosave file is running, its pid ends the file name (see AppState.session)
+    """
+    pid = Path(file_path).stem.rsplit('-', 1)[-1]
+    return pid.isdigit() and _process_alive(int(pid))
+
+
 class AppState(QObject):
     """
     Class to control the state of the app
+
+    Every setData bumps the version of the key, a save to a file written (or opened) before
+    only appends the keys changed since, and the changes not saved to the project are
+    autosaved every AUTOSAVE_INTERVAL to the autosave file of the session (only the keys changed
+    since the project was saved or opened, all of them without project). The autosave files of
+    the session are removed once saved to the project and when the app quits (once written, if
+    an autosave is running), the ones left by sessions no longer running are offered to restore
+    when their project is opened (at start up without project). The files of another running
+    session (e.g. a second napari) are never offered, so they are not restored or removed twice.
+    A file whose superseded blocks take more than COMPACT_RATIO of it is written again
+    as a whole instead of appended to, or compacted (in a thread) before it is opened if it
+    was still open (memory mapped) when saved, as an open file can not be replaced on windows.
     """
+    # ms
+    AUTOSAVE_INTERVAL = 60 * 1000
+    COMPACT_RATIO = 0.5
+
     nLayerInserted = Signal(Event)
     nLayerRemoved = Signal(Event)
 
@@ -30,6 +108,25 @@ class AppState(QObject):
         self._parameters = dict()
         self._data = dict()
         self._objects = dict()
+        # key -> version, path -> {key: version} written to that file, path -> writer memo
+        self._versions = dict()
+        self._saved = dict()
+        self._memos = dict()
+        self._save_workers = dict()
+        # path -> set by the save thread once it is done writing, so close can wait for it
+        self._save_done = {}
+        self.project_path = None
+        # autosave files are per session, a new session never writes over the one of a crashed session
+        self.session = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self._autosaves = set()
+
+        self._autosave_timer = QTimer(self)
+        self._autosave_timer.setInterval(self.AUTOSAVE_INTERVAL)
+        self._autosave_timer.timeout.connect(self.autosave)
+        self._autosave_timer.start()
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.close)
 
         if self.viewer:
             def _inserted(event):
@@ -40,21 +137,50 @@ class AppState(QObject):
             def _removed(event):
                 self.nLayerRemoved.emit(event)
             self.viewer.layers.events.removed.connect(_removed)
+            # autosaves of the sessions without project
+            QTimer.singleShot(0, self._offer_autosaves)
+
+        def _track_layer_args(value):
+            all_tracks = value['tracks_df']
+            all_meta = value['meta_df']
+            tracks, properties, _ = utils.napari_tracks_payload(all_tracks)
+            metadata = {'all_meta': all_meta,
+                        'all_tracks': all_tracks,
+                        }
+            if utils.TrackLabels.tracking_params in value:
+                metadata[utils.TrackLabels.tracking_params] = value[utils.TrackLabels.tracking_params]
+            return tracks, properties, metadata
+
+        def _add_track_layer(args):
+            tracks, properties, metadata = args
+            utils.add_track_to_viewer(self.viewer, name=utils.TrackLabels.tracks_layer,
+                                      data=tracks,
+                                      properties=properties,
+                                      metadata=metadata)
 
         def _add_track(key, val):
-            if key == "tracking":
-                all_tracks = val['value']['tracks_df']
-                all_meta = val['value']['meta_df']
-                tracks, properties, _ = utils.pd_to_napari_tracks(all_tracks,
-                                                                  utils.TrackLabels.track_header,
-                                                                  utils.TrackLabels.track_meta_header)
-                utils.add_track_to_viewer(self.viewer, name=utils.TrackLabels.tracks_layer,
-                                          data=tracks,
-                                          properties=properties,
-                                          metadata={'all_meta': all_meta,
-                                                    'all_tracks': all_tracks,
-                                                    })
+            if key != "tracking":
+                return
+            value = val['value']
+            if isinstance(value, LazyMapping) and not value.is_loaded('tracks_df'):
+                # tracks of an opened project, decoded (from the memory mapped columns) in a thread
+                # and added once ready, the widgets are usable meanwhile
+                @thread_worker
+                def _decode():
+                    return _track_layer_args(value)
+
+                def _decoded(args):
+                    # not replaced meanwhile
+                    if self._data.get("tracking") is value:
+                        _add_track_layer(args)
+
+                worker = _decode()
+                worker.returned.connect(_decoded)
+                worker.start()
+                return
+            _add_track_layer(_track_layer_args(value))
         self.dataAdded.connect(_add_track)
+        self.dataUpdated.connect(_add_track)
 
     def setParameter(self, name, value):
         is_added = False
@@ -78,6 +204,7 @@ class AppState(QObject):
         if name not in self._data:
             is_added = True
         self._data[name] = value
+        self._versions[name] = self._versions.get(name, 0) + 1
         if is_added:
             self.dataAdded.emit(name, {'value': value})
         else:
@@ -112,17 +239,228 @@ class AppState(QObject):
     def getLayers(self):
         return self.viewer.layers
 
-    def save(self, file_path):
-        _saved = state_write(file_path, self)
-        if _saved == file_path:
-            napari.utils.notifications.show_info(f"Saved to {_saved}")
+    def dirtyKeys(self, file_path=None) -> set:
+        """
+        keys changed since the data was saved to, or opened from, file_path (the project by default)
+        """
+        saved = self._saved.get(file_path or self.project_path, {})
+        return {k for k, v in self._versions.items() if saved.get(k) != v}
 
-    def open(self, file_path):
+    def save(self, file_path, codec: str = None):
+        """
+        save the data in a thread. Without codec the column blocks are stored uncompressed
+        and memory mapped when the project is opened, with a codec (e.g. tracks_writer.DEFAULT_CODEC)
+        they are compressed in parallel while written, the file is smaller but a column is
+        decompressed as a whole when it is read
+        """
+        self._write(file_path, notify=True, codec=codec)
+
+    @staticmethod
+    def _autosave_pattern(project_path=None):
+        # folder and file name pattern of the autosave files of a project (or without project)
+        if project_path:
+            project = Path(project_path)
+            return project.parent, f"{glob.escape(project.stem)}.autosave-*.tracks"
+        return Path.home().joinpath(".napari-tracking-analysis"), "autosave-*.tracks"
+
+    def autosave_path(self) -> str:
+        folder, pattern = self._autosave_pattern(self.project_path)
+        return str(folder.joinpath(pattern.replace("*", self.session)))
+
+    def autosave(self):
+        """
+        save the changes not saved to the project to the autosave file
+        """
+        if not self._data or not self.dirtyKeys():
+            return
+        file_path = self.autosave_path()
+        if not self.dirtyKeys(file_path):
+            return
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        self._autosaves.add(file_path)
+        # only the keys the project does not have, so the project is not copied
+        self._write(file_path, notify=False, keys=self.dirtyKeys())
+
+    def leftover_autosaves(self, project_path=None) -> list:
+        """
+        autosave files left by the sessions no longer running, of project_path or of the sessions without project
+        """
+        folder, pattern = self._autosave_pattern(project_path)
+        return sorted(str(p) for p in folder.glob(pattern)
+                      if str(p) not in self._autosaves and not _autosave_owner_alive(p))
+
+    def restore_autosave(self, file_path):
+        """
+        set the data of an autosave file left by another session and remove it. The autosave
+        of a project only has the keys changed since it was saved, it is restored over the project
+        """
         data = state_reader(file_path)
+        for k, v in data.items():
+            self.setData(k, v)
+        self._remove_file(file_path)
+        napari.utils.notifications.show_info(f"Restored {file_path}")
+
+    def _offer_autosaves(self, project_path=None):
+        for file_path in self.leftover_autosaves(project_path):
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(file_path)))
+            notification_manager.dispatch(Notification(
+                f"Changes of a previous session were autosaved to {file_path} ({modified})",
+                severity=NotificationSeverity.INFO,
+                actions=[("Restore", lambda _, path=file_path: self.restore_autosave(path)),
+                         ("Discard", lambda _, path=file_path: self._remove_file(path))]))
+
+    def _remove_file(self, file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            warnings.warn(f"Can not remove {file_path}: {e}", stacklevel=2)
+
+    def _remove_autosaves(self):
+        """
+        remove the autosave files of the session, the ones still being written are removed once written
+        """
+        for file_path in list(self._autosaves):
+            done = self._save_done.get(file_path)
+            if done is not None and not done.is_set():
+                continue
+            self._autosaves.discard(file_path)
+            self._saved.pop(file_path, None)
+            self._memos.pop(file_path, None)
+            self._remove_file(file_path)
+
+    def close(self):
+        """
+        end of the session, its autosave files are removed. A running autosave is waited for,
+        as its finished signal is not delivered once the app quits
+        """
+        self._autosave_timer.stop()
+        for file_path in list(self._autosaves):
+            done = self._save_done.get(file_path)
+            if done is not None:
+                done.wait()
+        self._remove_autosaves()
+
+    def _write(self, file_path, notify, codec=None, keys=None):
+        if file_path in self._save_workers:
+            if notify:
+                napari.utils.notifications.show_warning(f"A save to {file_path} is already running")
+            return
+        versions = dict(self._versions)
+        dirty = self.dirtyKeys(file_path)
+        append = file_path in self._saved and os.path.exists(file_path)
+        if append and not dirty:
+            # the file is up to date
+            if notify:
+                self.project_path = file_path
+                napari.utils.notifications.show_info(f"Saved to {file_path}")
+            return
+        memo = self._memos.get(file_path, {}) if append else {}
+        data = _snapshot(self._data if keys is None else {k: self._data[k] for k in keys})
+
+        # a file still open is appended to, and compacted when opened again
+        compact_ratio = None if file_in_use(file_path) else self.COMPACT_RATIO
+        done = threading.Event()
+
+        @thread_worker
+        def _save():
+            try:
+                return _write_file()
+            finally:
+                done.set()
+
+        def _write_file():
+            if append:
+                try:
+                    superseded, size = superseded_size(file_path)
+                    if compact_ratio is None or superseded <= compact_ratio * size:
+                        return append_container(file_path, data, dirty, codec=codec, memo=memo), memo
+                    # mostly blocks of replaced values, written again (compacted)
+                except (zipfile.BadZipFile, KeyError):
+                    # not a container (or not a complete one) anymore, written again
+                    pass
+            new_memo = {}
+            return write_container(file_path, data, codec=codec, memo=new_memo), new_memo
+
+        def _saved(value):
+            path, used_memo = value
+            self._saved[file_path] = versions
+            self._memos[file_path] = used_memo
+            if notify:
+                self.project_path = file_path
+                # the autosaved changes are in the project
+                self._remove_autosaves()
+                napari.utils.notifications.show_info(f"Saved to {path}")
+
+        def _errored(error):
+            self._memos.pop(file_path, None)
+            if notify:
+                napari.utils.notifications.show_error(f"Can not save {file_path}: {error}")
+            else:
+                warnings.warn(f"Autosave to {file_path} failed: {error}", stacklevel=2)
+
+        def _finished():
+            self._save_workers.pop(file_path, None)
+            self._save_done.pop(file_path, None)
+            if file_path in self._autosaves and (file_path != self.autosave_path() or not self.dirtyKeys()):
+                # saved to the project meanwhile
+                self._remove_autosaves()
+
+        worker = _save()
+        worker.returned.connect(_saved)
+        worker.errored.connect(_errored)
+        worker.finished.connect(_finished)
+        self._save_workers[file_path] = worker
+        self._save_done[file_path] = done
+        worker.start()
+
+    def open(self, file_path):
+        """
+        open a project, it is compacted in a thread first if needed (see _compact) and opened
+        once compacted, no save to it starts meanwhile
+        """
+        if file_path in self._save_workers:
+            napari.utils.notifications.show_warning(f"A save to {file_path} is running")
+            return
+
+        def _finished():
+            self._save_workers.pop(file_path, None)
+            self._open(file_path)
+
+        worker = thread_worker(self._compact)(file_path)
+        worker.finished.connect(_finished)
+        self._save_workers[file_path] = worker
+        worker.start()
+
+    def _open(self, file_path):
+        # the saved values are decoded when first used
+        data = state_reader(file_path, lazy=True)
         if data:
             # self._data = data
             for k, v in data.items():
                 self.setData(k, v)
+            # the opened values are the ones of the file
+            self.project_path = file_path
+            self._saved[file_path] = {k: self._versions[k] for k in data}
+            # the DataFrames decoded from the file are not written again by a delta save
+            self._memos[file_path] = data.memo if isinstance(data, LazyMapping) else {}
             napari.utils.notifications.show_info("Data loaded")
+            self._offer_autosaves(file_path)
         else:
-            warnings.warn(f"Something went wrong can not open {file_path}")
+            warnings.warn(f"Something went wrong can not open {file_path}", stacklevel=2)
+
+    def _compact(self, file_path):
+        """
+        compact a container with mostly superseded blocks, before it is opened (and memory mapped)
+        """
+        if file_in_use(file_path):
+            return
+        try:
+            if not is_container(file_path):
+                return
+            superseded, size = superseded_size(file_path)
+            if superseded > self.COMPACT_RATIO * size:
+                compact_container(file_path)
+        except (zipfile.BadZipFile, KeyError, OSError) as e:
+            warnings.warn(f"Can not compact {file_path}: {e}", stacklevel=2)
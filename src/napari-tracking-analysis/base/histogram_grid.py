@@ -1,9 +1,16 @@
 from napari_tracking_analysis.base.plots import colors, Histogram
 from qtpy.QtWidgets import QWidget, QGridLayout, QScrollArea, QVBoxLayout
+from qtpy.QtCore import QRect, QTimer
 from typing import Optional
 
 
 class HistogramGrid(QWidget):
+    """
+    Grid of histograms in a scroll area. Every cell is a light placeholder, its Histogram
+    (Matplotlib canvas and toolbar) is created when the cell is first scrolled into view and
+    reused by the next setData. Only the cells visible in the scroll area are drawn, the
+    others are drawn when they are scrolled into view.
+    """
     def __init__(
         self,
         parent: Optional[QWidget] = None,
@@ -16,25 +23,63 @@ class HistogramGrid(QWidget):
 
         self.centralWidget = QWidget()
         self.centralWidget.setLayout(QGridLayout())
+        self.scrollArea.setWidget(self.centralWidget)
 
         self.layout().addWidget(self.scrollArea)
         self.col = 2
+        self.data = {}
+        self.cells = []
+        self.histograms = {}
+        self._dirty = set()
+
+        self.scrollArea.verticalScrollBar().valueChanged.connect(self.draw_visible)
+        self.scrollArea.horizontalScrollBar().valueChanged.connect(self.draw_visible)
 
     def draw(self) -> None:
-        n_colors = len(colors)
-        # print(len(self.axes))
-        for i, (key, val) in enumerate(self.data.items()):
+        for i in range(len(self.cells), len(self.data)):
             row = int(i / self.col)
             col = int(i % self.col)
-            # print("MultiHistogramWidgets draw", row, col)
-            _histogram = Histogram()
-            _histogram.setMinimumWidth(400)
-            _histogram.setMinimumHeight(400)
-            _histogram.setData(val, key)
+            cell = QWidget()
+            cell.setLayout(QVBoxLayout())
+            cell.layout().setContentsMargins(0, 0, 0, 0)
+            cell.setMinimumWidth(400)
+            cell.setMinimumHeight(400)
+            self.centralWidget.layout().addWidget(cell, row, col)
+            self.cells.append(cell)
+
+        for i, cell in enumerate(self.cells):
+            cell.setVisible(i < len(self.data))
+        self._dirty = set(range(len(self.data)))
+        # once the grid is laid out
+        QTimer.singleShot(0, self.draw_visible)
+
+    def draw_visible(self) -> None:
+        if not self._dirty or not self.isVisible():
+            return
+        n_colors = len(colors)
+        keys = list(self.data.keys())
+        viewport = self.scrollArea.viewport()
+        visible = QRect(-self.centralWidget.pos(), viewport.size())
+        for i in sorted(self._dirty):
+            cell = self.cells[i]
+            if not cell.geometry().intersects(visible):
+                continue
+            if i not in self.histograms:
+                self.histograms[i] = Histogram()
+                cell.layout().addWidget(self.histograms[i])
+            _histogram = self.histograms[i]
+            _histogram.setData(self.data[keys[i]], keys[i])
             _histogram.setColor(colors[int(i % n_colors)])
             _histogram.draw()
-            self.centralWidget.layout().addWidget(_histogram, row, col)
-        self.scrollArea.setWidget(self.centralWidget)
+            self._dirty.discard(i)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        QTimer.singleShot(0, self.draw_visible)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        QTimer.singleShot(0, self.draw_visible)
 
     def setData(self, data):
         self.data = data
@@ -6,7 +6,7 @@ from matplotlib.backends.backend_qtagg import (
 )
 from matplotlib.figure import Figure
 from qtpy.QtWidgets import QVBoxLayout, QWidget, QAbstractItemView
-from qtpy.QtCore import QModelIndex, Qt, QRect, QPoint, Signal
+from qtpy.QtCore import QModelIndex, Qt, QRect, QPoint, Signal, QTimer
 from qtpy.QtGui import QRegion, QIntValidator
 from qtpy import uic
 from pathlib import Path
@@ -111,6 +111,14 @@ class BaseMPLWidget(QWidget):
 
 
 class IntensityStepPlots(BaseMPLWidget):
+    """
+    Intensity trace and step fit of a track. The two lines are kept and updated with set_data,
+    the trace is min / max decimated to the pixel width of the axes and re-sampled when the
+    x range changes (zoom, pan), the fit is drawn from its change points only.
+    A redraw of the same track within the same limits (a new fit while the window or the
+    threshold is changed) blits the lines over the cached axes background, the lines are
+    drawn normally once they settle like the bars of the Histogram.
+    """
 
     def __init__(
         self,
@@ -120,23 +128,92 @@ class IntensityStepPlots(BaseMPLWidget):
 
         # self._setup_callbacks()
         self.add_single_axes()
+        self.intensity = np.zeros(0)
+        self.intensity_line, = self.axes.plot([], [], label="Intensity", color=colors[0])
+        self.fit_line, = self.axes.plot([], [], label="Steps", color=colors[1])
+        self.axes.legend(loc='upper right')
+        self._autoscaling = False
+        self.axes.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        self._background = None
+        self._settle = QTimer(self)
+        self._settle.setSingleShot(True)
+        self._settle.setInterval(300)
+        self._settle.timeout.connect(self._settle_lines)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
 
-    def draw(self, intensity, fitx, title) -> None:
-        self.clear()
-
-        if len(intensity):
-            _intensity = np.array(intensity)
-            self.axes.plot(_intensity.ravel(), label="Intensity", color=colors[0])
-
-        if len(fitx):
-            _fitx = np.array(fitx)
-            self.axes.plot(_fitx.ravel(), label="Steps", color=colors[1])
+    def clear(self) -> None:
+        self.intensity = np.zeros(0)
+        self.intensity_line.set_data([], [])
+        self.fit_line.set_data([], [])
+
+    def _lines(self):
+        return (self.intensity_line, self.fit_line)
+
+    def _on_draw(self, event):
+        # full draw while the lines are animated, keep the background without them
+        if self.fit_line.get_animated():
+            self._background = self.canvas.copy_from_bbox(self.axes.bbox)
+            for line in self._lines():
+                self.axes.draw_artist(line)
+
+    def _blit_lines(self):
+        if self._background is None or not self.fit_line.get_animated():
+            for line in self._lines():
+                line.set_animated(True)
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            for line in self._lines():
+                self.axes.draw_artist(line)
+            self.canvas.blit(self.axes.bbox)
+        self._settle.start()
+
+    def _settle_lines(self):
+        self._settle.stop()
+        for line in self._lines():
+            line.set_animated(False)
+        self._background = None
+        self.canvas.draw_idle()
+
+    def _sample_intensity(self, start, stop):
+        n_bins = max(int(self.axes.bbox.width), 1)
+        x, y = utils.minmax_decimate(self.intensity, start, stop, n_bins)
+        self.intensity_line.set_data(x, y)
+
+    def _on_xlim_changed(self, axes):
+        # the autoscaling of draw samples the full trace itself
+        if self._autoscaling or not len(self.intensity):
+            return
+        x0, x1 = axes.get_xlim()
+        self._sample_intensity(np.floor(x0), np.ceil(x1) + 1)
+        self.canvas.draw_idle()
 
-        self.axes.legend(loc='upper right')
+    def draw(self, intensity, fitx, title) -> None:
+        limits = (self.axes.get_xlim(), self.axes.get_ylim())
+        same_title = self.axes.get_title() == title
+        self.intensity = np.asarray(intensity, dtype=np.float64).ravel()
+        _fitx = np.asarray(fitx, dtype=np.float64).ravel()
+
+        if len(_fitx):
+            x = utils.step_change_points(_fitx)
+            self.fit_line.set_data(x, _fitx[x])
+        else:
+            self.fit_line.set_data([], [])
+
+        # the decimated trace keeps the extremes, so the limits are the ones of the full trace
+        self._sample_intensity(0, len(self.intensity))
+        self._autoscaling = True
+        try:
+            self.axes.relim()
+            self.axes.autoscale_view()
+        finally:
+            self._autoscaling = False
+        if same_title and limits == (self.axes.get_xlim(), self.axes.get_ylim()):
+            # only the lines changed, the ticks and the title are the ones of the background
+            self._blit_lines()
+            return
         self.axes.set_title(label=title)
-
-        # needed
-        self.canvas.draw()
+        self._settle_lines()
 
 
 class Histogram(BaseMPLWidget):
@@ -152,11 +229,20 @@ class Histogram(BaseMPLWidget):
         self.data = []
         self.label = None
         self.color = colors[0]
+        self._bars = {}
+        self._background = None
+        # the bars are blitted while they change quickly and drawn normally once they settle
+        self._settle = QTimer(self)
+        self._settle.setSingleShot(True)
+        self._settle.setInterval(300)
+        self._settle.timeout.connect(self._settle_bars)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
         self.control = HistogramBinSize()
         self.toolbar.addSeparator()
         self.toolbar.addWidget(self.control)
         self.control.setTitle("Bin Size")
         self.control.setValue(5)
+        self.control.editingFinished.connect(self.draw)
         if hasattr(self.toolbar, "coordinates"):
             self.toolbar.coordinates = False
 
@@ -175,11 +261,76 @@ class Histogram(BaseMPLWidget):
             self.control.setValue(5 if len(data) > 5 else 2)
 
         self.label = title
-        self.control.editingFinished.connect(self.draw)
 
     def setColor(self, color):
         self.color = color
 
+    def setCounts(self, counts: dict, title=None) -> None:
+        """
+        Draw precomputed histograms, counts: {label: (hist, edges)}.
+        The bars of every label are one filled step artist, a later call with the same labels
+        and edges only updates the bar heights instead of re-creating the artists.
+        """
+        same_bins = (self._bars.keys() == counts.keys() and
+                     all(np.array_equal(self._bars[k].get_data().edges, edges) for k, (_, edges) in counts.items()))
+        if not same_bins:
+            self.clear()
+            self._bars = {}
+            n_colors = len(colors)
+            for i, (p, (hist, edges)) in enumerate(counts.items()):
+                self._bars[p] = self.axes.stairs(hist, edges, fill=True, edgecolor='black', linewidth=0.5,
+                                                 color=colors[int(i % n_colors)], label=p, alpha=0.5)
+            if len(self._bars):
+                self.axes.legend(loc='upper right')
+            if title is not None:
+                self.axes.set_title(label=title)
+        else:
+            for p, (hist, _) in counts.items():
+                self._bars[p].set_data(values=hist)
+
+        top = max(max([np.max(hist) for hist, _ in counts.values() if len(hist)], default=0), 1) * 1.05
+        ylim = self.axes.get_ylim()[1]
+        if same_bins and (top <= ylim) and (top >= ylim * 0.5):
+            self._blit_bars()
+            return
+        self.axes.set_ylim(0, top)
+        self._settle_bars()
+
+    def _bars_animated(self) -> bool:
+        return any(bar.get_animated() for bar in self._bars.values())
+
+    def _on_draw(self, event):
+        # full draw while the bars are animated, keep the background without them
+        if self._bars and self._bars_animated():
+            self._background = self.canvas.copy_from_bbox(self.axes.bbox)
+            for bar in self._bars.values():
+                self.axes.draw_artist(bar)
+
+    def _blit_bars(self):
+        if self._background is None or not self._bars_animated():
+            for bar in self._bars.values():
+                bar.set_animated(True)
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            for bar in self._bars.values():
+                self.axes.draw_artist(bar)
+            self.canvas.blit(self.axes.bbox)
+        self._settle.start()
+
+    def _settle_bars(self):
+        self._settle.stop()
+        for bar in self._bars.values():
+            bar.set_animated(False)
+        self._background = None
+        self.canvas.draw_idle()
+
+    def clear(self) -> None:
+        self._settle.stop()
+        self.axes.clear()
+        self._bars = {}
+        self._background = None
+
     def draw(self) -> None:
         self.clear()
 
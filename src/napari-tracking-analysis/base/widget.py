@@ -1,10 +1,26 @@
 from pathlib import Path
 from qtpy import uic
 import napari
+from napari.qt.threading import GeneratorWorker
 from qtpy.QtWidgets import QWidget, QFormLayout, QComboBox, QLabel
 from napari_tracking_analysis.base import AppState
 
 
+class ClosingGeneratorWorker(GeneratorWorker):
+    """
+    Generator worker that closes its generator in the worker thread once it stops. A quit
+    worker otherwise leaves the generator open, its clean up (e.g. the shut down of a process
+    pool) then runs whenever it is garbage collected, usually on the GUI thread.
+    Used as thread_worker(worker_class=ClosingGeneratorWorker)
+    """
+
+    def work(self):
+        try:
+            return super().work()
+        finally:
+            self._gen.close()
+
+
 class NLayerWidget(QWidget):
     def __init__(self, app_state: AppState = None, parent: QWidget = None):
         super().__init__(parent)
@@ -1,10 +1,22 @@
 from napari_tracking_analysis.base.plots import Histogram
+from napari_tracking_analysis import utils
 from qtpy.QtWidgets import QWidget, QVBoxLayout
 from qtpy.QtCore import QTimer
+import numpy as np
 import pandas as pd
 
 
 class PropertiesHistogram(QWidget):
+    """
+    Histograms of the rows accepted by the property filters.
+
+    The bins of every property are fixed over the whole table, so a filter change only
+    adds / removes the rows crossing a filter boundary (utils.PropertyRangeIndex) to the
+    bin counts. Slider moves arriving faster than UPDATE_INTERVAL are merged into one update.
+    """
+    # ms, ~30 updates per second while a slider is dragged
+    UPDATE_INTERVAL = 33
+
     def __init__(self, parent=None):
         super().__init__(parent=parent)
 
@@ -12,39 +24,106 @@ class PropertiesHistogram(QWidget):
         self.row_count = 0
         self.setLayout(QVBoxLayout())
         self.plot = Histogram()
+        # the bars are drawn from the incremental counts, not from the histogram data
+        self.plot.control.editingFinished.disconnect(self.plot.draw)
         self.layout().addWidget(self.plot)
         self.track_id_column_name = 'track_id'
         self.include_properties = []
         self.properties = {}
 
-    def draw(self):
-        self.plot.clear()
-        _df = self.dataframe
-        data = {}
-        for _property, val in self.properties.items():
-            if (len(self.include_properties)) and (_property not in self.include_properties):
-                continue
-            _df = _df[(_df[_property] >= val['min']) & (_df[_property] <= val['max'])]
-
-        for _property, val in self.properties.items():
-            if (len(self.include_properties)) and (_property not in self.include_properties):
-                continue
-            data[_property] = _df[_property].to_numpy()
+        self.range_index = None
+        self.bins = {}
+        self.counts = {}
+        self._pending = {}
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.UPDATE_INTERVAL)
+        self._timer.timeout.connect(self.apply_pending)
+        self.plot.control.editingFinished.connect(self.rebuild)
 
-        self.plot.setData(data=data, title="Filtered View")
-        self.plot.draw()
+    def draw(self):
+        data = {p: (self.counts[p], self.bins[p][1]) for p in self.counts}
+        self.plot.setCounts(data, title="Filtered View")
 
     def set_data_source(self, source: pd.DataFrame):
         self.dataframe = source
         self.nrows = self.dataframe.shape[0]
         self.ncols = self.dataframe.shape[1]
         self.update_prperties()
+        self.rebuild()
+
+    def _plotted_properties(self):
+        return [p for p in self.properties
+                if ((not len(self.include_properties)) or (p in self.include_properties))
+                and p in self.dataframe.columns]
+
+    def _bin_counts(self, _property, rows) -> np.ndarray:
+        bins, edges = self.bins[_property]
+        rows_bins = bins[rows]
+        return np.bincount(rows_bins[rows_bins >= 0], minlength=len(edges) - 1)
+
+    def rebuild(self):
+        """
+        bins of every plotted property over the whole table and the counts of the accepted rows
+        """
+        if not hasattr(self, 'dataframe'):
+            return
+        self._timer.stop()
+        self._pending = {}
+        binsize = self.plot.control.value() or 5
+        properties = self._plotted_properties()
+        self.range_index = utils.PropertyRangeIndex(self.dataframe, properties)
+        for _property in properties:
+            val = self.properties[_property]
+            self.range_index.set_range(_property, val['min'], val['max'])
+
+        self.bins = {}
+        for _property in properties:
+            values = self.dataframe[_property].to_numpy(dtype=np.float64)
+            finite = np.isfinite(values)
+            if not finite.any():
+                continue
+            _, edges, _ = utils.histogram(values[finite], binsize)
+            edges = np.asarray(edges, dtype=np.float64)
+            n_bins = len(edges) - 1
+            # same bins as np.histogram, the last one includes its right edge
+            bins = np.searchsorted(edges, values, side='right') - 1
+            bins[values == edges[-1]] = n_bins - 1
+            bins[(~finite) | (bins < 0) | (bins >= n_bins)] = -1
+            self.bins[_property] = (bins, edges)
+
+        accepted = np.flatnonzero(self.range_index.accepted)
+        self.counts = {p: self._bin_counts(p, accepted) for p in self.bins}
         self.draw()
 
     def property_filter_updated(self, property_name, vrange):
         print(f"plots property_filter_updated {property_name}, {vrange}")
         self.properties[property_name] = {'min': vrange[0], 'max': vrange[1]}
-        QTimer.singleShot(10, self.draw)
+        if self.range_index is None or property_name not in self.range_index:
+            return
+        self._pending[property_name] = vrange
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def apply_pending(self):
+        """
+        apply the filter changes received since the last update to the bin counts
+        """
+        pending, self._pending = self._pending, {}
+        changed = [self.range_index.set_range(k, vrange[0], vrange[1]) for k, vrange in pending.items()]
+        if not changed:
+            return
+        # a row flipped an even number of times is back to its previous status
+        rows, flips = np.unique(np.concatenate(changed), return_counts=True)
+        rows = rows[flips % 2 == 1]
+        if not len(rows):
+            return
+        accepted = self.range_index.accepted[rows]
+        entered = rows[accepted]
+        left = rows[~accepted]
+        for _property in self.counts:
+            self.counts[_property] += self._bin_counts(_property, entered) - self._bin_counts(_property, left)
+        self.draw()
 
     def update_prperties(self):
         for property in self.dataframe.columns:
@@ -46,6 +46,10 @@ class FilterWidget(QWidget):
 
         self.allView.setSelectionModel(models['model_selection'])
         self.filterView.setSelectionModel(models['proxy_selection'])
+        # header click sorting, each view sorts its own model with an argsort, starting in the table order
+        for view in (self.allView, self.filterView):
+            view.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
+            view.setSortingEnabled(True)
         models['proxy_selection'].currentChanged.connect(self.current_proxy_selection_changed)
 
         self.filterPlots.include_properties = self.include_properties
@@ -147,6 +147,16 @@ class _walking_average_ui(QWidget):
         self.load_ui(UI_FILE)
         self.windowSizeSpinner.setMinimum(1)
         self.windowSizeSpinner.setValue(4)
+        self.cbFilter.addItems(list(utils.TEMPORAL_FILTERS))
+        self.cbFilter.setToolTip("mean: walking average\n"
+                                 f"median: walking median (window up to {utils.MEDIAN_MAX_WINDOW})\n"
+                                 "ema: exponential moving average")
+        default_maximum = self.windowSizeSpinner.maximum()
+
+        def _filter_changed(method):
+            # the cost of the median grows with the window
+            self.windowSizeSpinner.setMaximum(utils.MEDIAN_MAX_WINDOW if method == "median" else default_maximum)
+        self.cbFilter.currentTextChanged.connect(_filter_changed)
         # Blob_Log
         self.minSigmaSpinner.setMinimum(1.0)
         self.minSigmaSpinner.setValue(1.0)
@@ -185,7 +195,8 @@ class SegmentationWidget(NLayerWidget):
 
             self.walking_average(
                 self.get_current_image(),
-                self.avg_ui.windowSizeSpinner.value()
+                self.avg_ui.windowSizeSpinner.value(),
+                self.avg_ui.cbFilter.currentText()
             )
 
         self.avg_ui.btnAvg.clicked.connect(roalling_average_clicked)
@@ -309,12 +320,10 @@ class SegmentationWidget(NLayerWidget):
         notifications.show_info(
             f"Training {str(self.classifier_class.__name__)}")
 
-        # reduce the data size
-        _ann_ind = np.argwhere(annotation >= 1)
-        _ann_ind = np.unique(_ann_ind[:, 0])
-        _ann_ind = _ann_ind.tolist()
-        _annotation = annotation[_ann_ind]
-        _images = images[_ann_ind]
+        # reduce the data size, only the annotated frames are read
+        _ann_ind = [i for i in range(annotation.shape[0]) if np.any(np.asarray(annotation[i]) >= 1)]
+        _annotation = np.asarray(annotation[_ann_ind])
+        _images = np.asarray(images[_ann_ind])
         print(_annotation.shape)
         print(_images.shape)
         classifier.train(feature_definition, _annotation, _images)
@@ -337,28 +346,29 @@ class SegmentationWidget(NLayerWidget):
             images = images[0]
 
         clf = self.classifier_class(opencl_filename=filename)
-        result = np.zeros(images.shape, dtype=np.uint16)
-        
-        min_obj_size_gradiant = np.ceil(
-            np.linspace(min_obj_size, 1, images.shape[0])).astype(
-            np.uint16) if min_obj_size is not None else None
-        
+
+        def _predict(image):
+            return cle.equal_constant(clf.predict(image=image), constant=2)
+
         if len(images.shape) >= 3:
-            for i in progress(range(images.shape[0]), desc="Predicting..."):
-                result[i] = np.asarray(
-                    cle.equal_constant(clf.predict(image=images[i]),
-                                       constant=2)) if min_obj_size is None else utils.remove_small_objects(
-                    np.asarray(cle.equal_constant(clf.predict(image=images[i]), constant=2)),
-                    min_size=min_obj_size_gradiant[i])
-                # print(result[i])
-                # np.asarray(clf.predict(image=images[i]))
+            # the mask is uint8, memory mapped when larger than utils.OUTPUT_MEMORY_LIMIT
+            result = utils.allocate_stack(images.shape, np.uint8)
+            post_process = None
+            if min_obj_size is not None:
+                min_obj_size_gradiant = np.ceil(
+                    np.linspace(min_obj_size, 1, images.shape[0])).astype(np.uint16)
+
+                def post_process(i, values):
+                    return utils.remove_small_objects(values, min_size=min_obj_size_gradiant[i])
+
+            pbr = progress(total=images.shape[0], desc="Predicting...")
+            for count in utils.predict_stack_iter(_predict, images, result, post_process):
+                pbr.update(count)
+            pbr.close()
         else:
-            result = np.asarray(
-                cle.equal_constant(clf.predict(image=images),
-                                   constant=2)) if min_obj_size is None else utils.remove_small_objects(
-                np.asarray(cle.equal_constant(clf.predict(image=images),
-                                              constant=2)),
-                min_size=min_obj_size)
+            result = np.asarray(_predict(np.asarray(images))).astype(np.uint8)
+            if min_obj_size is not None:
+                result = utils.remove_small_objects(result, min_size=min_obj_size)
 
         print("Applying / prediction done.")
         notifications.show_info("Applying / prediction done.")
@@ -370,12 +380,10 @@ class SegmentationWidget(NLayerWidget):
         _add_to_viewer(self.state.viewer, False, "Result of " +
                        short_filename, result, scale)
 
-    def walking_average(self, image_layer, window: int = 4):
-        image = image_layer.data
-        ret = np.cumsum(image, axis=0, dtype=image.dtype)
-        ret[window:] = ret[window:] - ret[:-window]
-        ret = ret[window - 1:] / window
-        _add_to_viewer(self.state.viewer, True, f"{image_layer.name}_Walking_Avg_{window}", ret, image_layer.scale)
+    def walking_average(self, image_layer, window: int = 4, method: str = "mean"):
+        ret = utils.temporal_filter(image_layer.data, window, method)
+        title = {"mean": "Walking_Avg", "median": "Walking_Median", "ema": "EMA"}[method]
+        _add_to_viewer(self.state.viewer, True, f"{image_layer.name}_{title}_{window}", ret, image_layer.scale)
 
     def quick_segment_2d(self, image_layer, label_layer, min_sigma: float = 1.0, max_sigma: float = 2.0,
                          num_sigma: int = 10, threshold: float = 0.1, overlap: float = 0.5):
@@ -387,12 +395,12 @@ class SegmentationWidget(NLayerWidget):
             notifications.show_warning(
                 "Plese sqitch to 2d Display Mode!")
             return
-        image = image_layer.data[self.state.viewer.dims.current_step[0]]
+        image = np.asarray(image_layer.data[self.state.viewer.dims.current_step[0]])
         if label_layer is not None:
             label = label_layer.data[self.state.viewer.dims.current_step[0]]
         else:
             label_layer = self.state.viewer.add_labels(
-                np.zeros(image_layer.data.shape, dtype=np.uint8),
+                utils.allocate_stack(image_layer.data.shape, np.uint8),
                 name="Annotation_Label")
             label = label_layer.data[self.state.viewer.dims.current_step[0]]
 
@@ -410,10 +418,10 @@ class SegmentationWidget(NLayerWidget):
 
 def _add_to_viewer(viewer, as_image, name, data, scale=None):
     try:
-        viewer.layers[name].data = data.astype(int)
+        viewer.layers[name].data = data
         viewer.layers[name].visible = True
     except KeyError:
         if as_image:
             viewer.add_image(data, name=name, scale=scale)
         else:
-            viewer.add_labels(data.astype(int), name=name, scale=scale)
+            viewer.add_labels(data, name=name, scale=scale)
@@ -0,0 +1,62 @@
+import json
+from pathlib import Path
+from typing import List
+import numpy as np
+
+STACK_EXTENSIONS = (".tif", ".tiff", ".npy", ".raw")
+
+
+def get_reader(path: str):
+    """
+    Reader of image stacks (multi-page TIFF, .npy, raw with a json sidecar), the stack is
+    memory mapped or, when the file can not be mapped (e.g. compressed TIFF), a dask array
+    reading one page per frame, so nothing is read before a frame is used.
+    """
+    if isinstance(path, str) and path.lower().endswith(STACK_EXTENSIONS):
+        if path.lower().endswith(".raw") and not Path(raw_sidecar(path)).exists():
+            return None
+        return stack_reader
+    return None
+
+
+def raw_sidecar(path: str) -> str:
+    """
+    json description of a raw stack: {"shape": [T, Y, X], "dtype": "uint16", "offset": 0, "order": "C"}
+    """
+    return f"{path}.json"
+
+
+def read_stack(path: str):
+    suffix = Path(path).suffix.lower()
+    if suffix == ".npy":
+        return np.load(path, mmap_mode='r')
+    if suffix == ".raw":
+        with open(raw_sidecar(path)) as f:
+            meta = json.load(f)
+        return np.memmap(path, dtype=np.dtype(meta["dtype"]), mode='r', offset=int(meta.get("offset", 0)),
+                         shape=tuple(meta["shape"]), order=meta.get("order", "C"))
+    return _read_tiff(path)
+
+
+def _read_tiff(path: str):
+    import tifffile
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        # compressed or not contiguous
+        pass
+
+    import dask
+    import dask.array as da
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        shape, dtype, page_shape = series.shape, series.dtype, series.keyframe.shape
+    n_pages = int(np.prod(shape)) // int(np.prod(page_shape))
+    read_page = dask.delayed(tifffile.imread, pure=True)
+    pages = [da.from_delayed(read_page(path, key=i), shape=page_shape, dtype=dtype) for i in range(n_pages)]
+    return da.stack(pages).reshape(shape)
+
+
+def stack_reader(path: str) -> List[tuple]:
+    data = read_stack(path)
+    return [(data, {"name": Path(path).stem}, "image")]
@@ -1,4 +1,4 @@
-from napari_tracking_analysis.base import NLayerWidget, AppState
+from napari_tracking_analysis.base import NLayerWidget, AppState, ClosingGeneratorWorker
 from napari_tracking_analysis.filter_widget import FilterWidget
 from qtpy.QtWidgets import QWidget, QVBoxLayout, QFileDialog
 from qtpy.QtCore import Qt
@@ -8,22 +8,32 @@ from pathlib import Path
 from napari_tracking_analysis import utils
 import pandas as pd
 from napari.utils import progress
+from napari.qt.threading import thread_worker
 import numpy as np
 
 
 class ResultWidget(QWidget):
-    def __init__(self, data, parent=None):
+    def __init__(self, data, dwell_table=None, parent=None):
         super().__init__(parent)
         UI_FILE = Path(__file__).resolve().parent.parent.joinpath(
             'ui', 'step_analysis_result_widget.ui')
         self.load_ui(UI_FILE)
         self.btnExport.setIcon(utils.get_icon('file-export'))
         self.data = data
-        self.setup_ui()
+        # dwell_table(result) of the step analysis widget, it keeps the table with its fit cache
+        self.dwell_table = dwell_table
+        # built when first shown, a result opened from a project is only loaded then
+        self._is_setup = False
 
     def load_ui(self, path):
         uic.loadUi(path, self)
 
+    def showEvent(self, event):
+        if not self._is_setup:
+            self._is_setup = True
+            self.setup_ui()
+        super().showEvent(event)
+
     def setup_ui(self):
         step_meta: pd.DataFrame = self.data['steps_meta_df']
         step_info: pd.DataFrame = self.data['steps_df']
@@ -37,26 +47,20 @@ class ResultWidget(QWidget):
         data_dict['step_height'] = np.abs((self.data['steps_df']['step_height']).to_numpy())
         data_dict['track_length'] = step_meta['length'].to_numpy()
 
-        # step length
+        # step length, the dwell table is not stored in the result dict
+        # (it belongs to the app state and is saved with the project)
+        if self.dwell_table is None:
+            dwell_df: pd.DataFrame = utils.step_dwell_table(step_info, step_meta)
+        else:
+            dwell_df: pd.DataFrame = self.dwell_table(self.data)
+        dwell_groups = {key: group['dwell_before'].to_numpy(dtype=np.float64)
+                        for key, group in dwell_df.groupby(['step_count', 'step'], sort=True)}
         max_step_count = np.max(data_dict['step_count'])
 
         for i in range(1, max_step_count+1):
-            track_ids = (step_meta[step_meta['step_count'] == i]['track_id']).to_list()
-            tracks_group = step_info[step_info['track_id'].isin(track_ids)].groupby('track_id')
             for j in range(0, i):
-                print(f"step_count_{i}_step_{j+1}_dwell_before")
-                jth = tracks_group['dwell_before'].nth(j).to_numpy(dtype=np.float64)
-                print(f"jth.dtype : {jth.dtype}, {jth.size}")
-                data_dict[f'step_count_{i}_step_{j+1}_dwell_before'] = jth
-                # data_dict[f'step_count_{i}_step_{j}_dwell_after'] = np.abs(
-                #     tracks_group['dwell_after'].nth(j-1).to_numpy())
-                # data_dict[f'step_count_{i}_step_{j}_step_height'] = np.abs(
-                #     tracks_group['step_height'].nth(j-1).to_numpy())
-                # data_dict[f'step_count_{i}_step_{j}_step_length'] = np.abs(
-                #     tracks_group['dwell_before'].nth(j-1).to_numpy())
-
-            # data_dict[f'step_count_{i}_step_length'] = np.abs((
-            #     step_info[step_info['track_id'].isin(track_ids)]['dwell_before']).to_numpy())
+                data_dict[f'step_count_{i}_step_{j+1}_dwell_before'] = dwell_groups.get((i, j+1),
+                                                                                     np.zeros(0, dtype=np.float64))
 
         self.histogram.setData(data=data_dict)
         self.btnExport.clicked.connect(self.export)
@@ -97,8 +101,18 @@ class StepAnalysisWidget(NLayerWidget):
         self.gbNapariLayers.setVisible(False)
         self.ui.resultWidget.clear()
 
+        self._fit_worker = None
+        self.fit_cache = utils.StepFitCache()
+        self._data_version = 0
         self.property_widget = FilterWidget(self.state, parent=self)
 
+        def _tracking_changed(key, val):
+            if key == "tracking":
+                self._data_version += 1
+                self.fit_cache.clear()
+        self.state.dataAdded.connect(_tracking_changed)
+        self.state.dataUpdated.connect(_tracking_changed)
+
         def _call_setup_ui(key, val):
             if key == "tracking_model":
                 print("_call_setup_ui")
@@ -143,74 +157,75 @@ class StepAnalysisWidget(NLayerWidget):
         tracks_df = self.state.data("tracking")
         all_tracks = tracks_df['tracks_df']
         if 'intensity_mean' in all_tracks.columns:
-            track = all_tracks[all_tracks['track_id'] == track_id]
-            intensity = track['intensity_mean'].to_numpy()
+            intensity = utils.track_index(all_tracks).values('intensity_mean', track_id)
             if len(intensity) < 5:
                 self.ui.intensityPlot.draw(intensity, [], f"Track {track_id}")
                 return
-            _, fitx, _ = utils.FindSteps(data=intensity,
-                                         window=int(self.ui.leWindowSize.text()),
-                                         threshold=self.ui.sbThreshold.value())
+            window = int(self.ui.leWindowSize.text())
+            threshold = self.ui.sbThreshold.value()
+            fitx = self.fit_cache.get(track_id, window, threshold, self._data_version)
+            if fitx is None:
+                _, fitx, _ = utils.FindSteps(data=intensity, window=window, threshold=threshold)
+                self.fit_cache.put(track_id, window, threshold, self._data_version, fitx)
             self.ui.intensityPlot.draw(intensity, fitx, f"Track {track_id}")
 
     def apply_all(self):
+        # a click while fitting is running cancels it
+        if self._fit_worker is not None:
+            self._fit_worker.quit()
+            return
+
         print("Step fitting started")
         models = self.state.object("tracking_model")
         proxy_model = models['proxy']
 
         dfs = self.state.data("tracking")
         all_tracks = dfs['tracks_df']
-        step_meta = []
-        steps_info = pd.DataFrame()
-        rows = proxy_model.rowCount()
+        tracks_index = utils.track_index(all_tracks)
+        # the index only holds a weak reference to the table, build the column while it is alive
+        tracks_index.column('intensity_mean')
+        track_ids = proxy_model.accepted_track_ids()
         window = int(self.ui.leWindowSize.text())
         threshold = self.ui.sbThreshold.value()
-        print(f"Total number of rows {rows}")
-
-        for row in progress(range(rows), desc="Analysing steps.."):
-            index = proxy_model.index(row, 0, self.property_widget.filterView.rootIndex())
-            track_id = int(proxy_model.data(index))
-            track = all_tracks[all_tracks['track_id'] == track_id]
-            intensity = track['intensity_mean'].to_numpy()
-            steptable, fitx, _ = utils.FindSteps(data=intensity,
-                                                 window=window,
-                                                 threshold=threshold)
-
-            # all_tracks.loc[all_tracks['track_id'] == track_id, 'fit'] = fitx
-            # Detail step table
-            steps_df = pd.DataFrame(steptable,
-                                    columns=["step_index", "level_before", "level_after",
-                                             "step_height", "dwell_before", "dwell_after", "measured_error"])
-            steps_df['track_id'] = track_id
-            steps_info = pd.concat([steps_info, steps_df], ignore_index=True)
-
-            # single row description of step table
-            meta_row = []
-            # track id
-            meta_row.append(track_id)
-            # number of steps
-            meta_row.append(len(steptable))
-            # Negetive steps (steps going down)
-            meta_row.append(-len(steps_df[steps_df['step_height'] < 0]))
-            # Positive steps (steps going up or straight line)
-            meta_row.append(len(steps_df[steps_df['step_height'] >= 0]))
-            # Average step height
-            meta_row.append(steps_df['step_height'].mean())
-            # Max Intensity
-            meta_row.append(np.max(intensity.ravel()))
-            # Track length
-            meta_row.append(len(intensity.ravel()))
-
-            step_meta.append(meta_row)
-
-        print("\n\rStep fitting done")
-
-        step_meta_df = pd.DataFrame(data=step_meta,
-                                    columns=['track_id', 'step_count', 'negetive_steps',
-                                             'positive_steps', 'step_height', 'max_intensity', 'length'])
+        track_filter = dict(proxy_model.properties)
+        n_workers = None if self.ui.cbParallel.isChecked() else 1
+        version = self._data_version
+        print(f"Total number of rows {len(track_ids)}")
+        pbr = progress(total=len(track_ids), desc="Analysing steps..")
+
+        # closed in the worker thread when cancelled, see ClosingGeneratorWorker
+        @thread_worker(worker_class=ClosingGeneratorWorker)
+        def _fit():
+            results = {}
+            for i, count, steps_df, steps_meta_df in utils.fit_steps_iter(tracks_index, track_ids,
+                                                                           window=window, threshold=threshold,
+                                                                           n_workers=n_workers):
+                results[i] = (steps_df, steps_meta_df)
+                yield count
+            return utils.concat_step_results(results)
+
+        def _returned(value):
+            steps_info, step_meta_df = value
+            print("\n\rStep fitting done")
+            self.fit_cache.add_steps(steps_info, step_meta_df, window, threshold, version)
+            self.apply_all_done(steps_info, step_meta_df, track_filter, window, threshold)
+
+        def _finished():
+            pbr.close()
+            self._fit_worker = None
+            self.ui.fitAll.setText("Apply All")
+
+        self._fit_worker = _fit()
+        self._fit_worker.yielded.connect(pbr.update)
+        self._fit_worker.returned.connect(_returned)
+        self._fit_worker.finished.connect(_finished)
+        self.ui.fitAll.setText("Cancel")
+        self._fit_worker.start()
+
+    def apply_all_done(self, steps_info, step_meta_df, track_filter, window, threshold):
         _result = {'steps_df': steps_info,
                    'steps_meta_df': step_meta_df,
-                   'track_filter': proxy_model.properties,
+                   'track_filter': track_filter,
                    'parameters': {'window': window, 'threshold': threshold}}
         result_title = f"{window}_{threshold}_1"
         result = {}
@@ -238,12 +253,22 @@ class StepAnalysisWidget(NLayerWidget):
             tab_title = self.ui.resultWidget.tabText(i)
             current_tabs.append(tab_title)
 
-        new_tabs = list(set(results) - set(current_tabs))
+        # the tabs are titled "Results {key}", only the results without a tab get one
+        new_tabs = [key for key in results if f"Results {key}" not in current_tabs]
         for new_tab in new_tabs:
             stepanalysis_data = result_obj[new_tab]
-            resutl_widget = ResultWidget(data=stepanalysis_data)
+            resutl_widget = ResultWidget(data=stepanalysis_data, dwell_table=self.dwell_table)
             self.ui.resultWidget.addTab(resutl_widget, f"Results {new_tab}")
 
+    def dwell_table(self, result: dict) -> pd.DataFrame:
+        """
+        dwell table of a step analysis result, a result of a "Fit All" run of the current data
+        reuses the table kept with the run in the fit cache
+        """
+        parameters = result['parameters']
+        return self.fit_cache.dwell_table(result['steps_df'], result['steps_meta_df'], parameters['window'],
+                                          parameters['threshold'], self._data_version)
+
 
 def _qt_main():
     from qtpy.QtWidgets import QApplication
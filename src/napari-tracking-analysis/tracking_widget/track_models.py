@@ -1,37 +1,110 @@
-from qtpy.QtCore import (Signal, QAbstractTableModel, Qt, QModelIndex, QVariant, QObject, QSortFilterProxyModel)
+from qtpy.QtCore import (Signal, QAbstractTableModel, Qt, QModelIndex, QVariant, QObject, QAbstractProxyModel)
 import pandas as pd
+import numpy as np
+from napari_tracking_analysis import utils
+
+
+def _column_formatter(values: np.ndarray):
+    """
+    display formatter of a column, chosen once per column from its dtype
+    """
+    if values.dtype.kind in 'iu':
+        return lambda v: str(int(v))
+    if values.dtype == np.float64:
+        return lambda v: repr(float(v))
+    return str
+
+
+def _argsort_column(values: np.ndarray, order: Qt.SortOrder) -> np.ndarray:
+    """
+    stable argsort of a column, ties keep the dataframe order in both sort orders
+    """
+    if order == Qt.SortOrder.DescendingOrder:
+        return (len(values) - 1 - np.argsort(values[::-1], kind='stable'))[::-1]
+    return np.argsort(values, kind='stable')
 
 
 class TrackMetaModel(QAbstractTableModel):
+    """
+    Table model of a DataFrame. The columns are cached as numpy arrays with a display
+    formatter per column, the rows are handed to the views in batches (canFetchMore / fetchMore)
+    and sorting is an argsort of the column, the model rows map to the dataframe rows
+    through a permutation.
+    """
+    fetch_batch = 5000
+
     def __init__(self, dataframe: pd.DataFrame = pd.DataFrame(),
                  track_id_column_name: str = 'track_id', parent: QObject = None) -> None:
         super().__init__(parent)
-        self.beginResetModel()
-        self.dataframe = dataframe
-        self.endResetModel()
         self.track_id_column_name = track_id_column_name
+        self.setDataframe(dataframe)
 
     def setDataframe(self, dataframe: pd.DataFrame):
         self.beginResetModel()
         self.dataframe = dataframe
+        self._columns = [dataframe[c].to_numpy() for c in dataframe.columns]
+        self._formatters = [_column_formatter(values) for values in self._columns]
+        self._order = None
+        self._position = None
+        self._loaded = min(len(dataframe), self.fetch_batch)
         self.endResetModel()
 
     def rowCount(self, parent=QModelIndex()) -> int:
-        return self.dataframe.shape[0]
+        if parent.isValid():
+            return 0
+        return self._loaded
 
     def columnCount(self, parent=QModelIndex()) -> int:
-        return self.dataframe.shape[1]
+        if parent.isValid():
+            return 0
+        return len(self._columns)
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return (not parent.isValid()) and self._loaded < len(self.dataframe)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        count = min(self.fetch_batch, len(self.dataframe) - self._loaded)
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+
+    def index(self, row: int, column: int, parent=QModelIndex()) -> QModelIndex:
+        # every row can be addressed (e.g. by a proxy), only the loaded ones are shown
+        if parent.isValid() or row < 0 or column < 0 or row >= len(self.dataframe) or column >= len(self._columns):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def dataframe_rows(self, rows) -> np.ndarray:
+        """
+        dataframe rows (positions) of the model rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows if self._order is None else self._order[rows]
+
+    def model_rows(self, dataframe_rows) -> np.ndarray:
+        """
+        model rows of the dataframe rows (positions)
+        """
+        dataframe_rows = np.asarray(dataframe_rows, dtype=np.int64)
+        if self._order is None:
+            return dataframe_rows
+        if self._position is None:
+            self._position = np.empty(len(self._order), dtype=np.int64)
+            self._position[self._order] = np.arange(len(self._order))
+        return self._position[dataframe_rows]
 
     def data(self, index, role=Qt.ItemDataRole.DisplayRole) -> QVariant:
         if (not index.isValid()):
             return QVariant()
 
+        row = index.row() if self._order is None else self._order[index.row()]
         if role == Qt.ItemDataRole.DisplayRole:
-            return str(self.dataframe.iat[index.row(), index.column()])
+            return self._formatters[index.column()](self._columns[index.column()][row])
 
         if role == Qt.ItemDataRole.UserRole+1:
-            # print("DataFrameModel User Role: ", self.dataframe.iat[index.row(), 0])
-            return float(self.dataframe.iat[index.row(), index.column()])
+            return float(self._columns[index.column()][row])
 
     def headerData(self, section, orientation, role=Qt.DisplayRole) -> QVariant:
         if role == Qt.DisplayRole:
@@ -39,38 +112,303 @@ class TrackMetaModel(QAbstractTableModel):
                 return self.dataframe.columns[section]
             return str(section)
 
+    def sort(self, column: int, order: Qt.SortOrder = Qt.SortOrder.AscendingOrder):
+        """
+        sort the rows with an argsort of the column, a negative column restores the dataframe order
+        """
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        rows = self.dataframe_rows([index.row() for index in persistent])
+        if column < 0 or column >= len(self._columns):
+            self._order = None
+        else:
+            self._order = _argsort_column(self._columns[column], order)
+        self._position = None
+        new_rows = self.model_rows(rows)
+        self.changePersistentIndexList(persistent, [self.index(int(r), index.column())
+                                                    for r, index in zip(new_rows, persistent)])
+        self.layoutChanged.emit()
+
+
+def _contiguous_runs(positions: np.ndarray) -> list:
+    """
+    [(start, stop)] of the runs of consecutive values of the sorted positions
+    """
+    if not len(positions):
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = positions[np.concatenate([[0], breaks])]
+    stops = positions[np.concatenate([breaks - 1, [len(positions) - 1]])] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
 
-class TrackMetaModelProxy(QSortFilterProxyModel):
+
+class TrackMetaModelProxy(QAbstractProxyModel):
+    """
+    Filter proxy of a TrackMetaModel. The property ranges are applied through a
+    utils.PropertyRangeIndex built once per table, so moving a range only visits the rows
+    entering or leaving it, and the proxy rows are mapped to the source rows with an index
+    array, so nothing is evaluated per row. The rows entering or leaving are inserted in or
+    removed from the sorted proxy rows with binary searches and announced with row
+    insert / remove signals, one per run of consecutive proxy rows. A change scattered over
+    more than max_row_signals runs is announced with one layout change instead, the proxy
+    rows are not sorted again either way. Rows are handed to the views in batches like the
+    source model.
+    The proxy rows are dataframe rows and the proxy keeps its own sort order (an argsort of
+    the column like the source model), so sorting the proxy does not reorder the source
+    model and sorting the source model does not move the proxy rows.
+    """
     filterUpdated = Signal(str, tuple)
+    max_row_signals = 64
 
     def __init__(self, parent: QObject = None):
         super(TrackMetaModelProxy, self).__init__(parent)
         self.properties = {}
+        self._range_index = None
+        self._accepted = None
+        # accepted dataframe rows in the sort order of the proxy
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._sort_column = -1
+        self._sort_order = Qt.SortOrder.AscendingOrder
+        self._order = None
+        self._position = None
+        self._proxy_rows = None
+        self._loaded = 0
+        self._persistent = []
+        self._persistent_rows = []
+        # no rows are fetched while a change of the rows is announced
+        self._updating = False
         self.sourceModelChanged.connect(self.update_prperties)
 
-    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex):
-        if (not hasattr(self, 'properties')) or (not self.properties):
-            return True
-        conditions = []
-        for i, (k, v) in enumerate(self.properties.items()):
-            if str(k).strip() == self.track_model.track_id_column_name.strip():
-                continue
-            # print(i, k, v)
-            index = self.sourceModel().index(source_row, i+1, source_parent)
-            conditions.append((float(self.sourceModel().data(index)) >= v['min'])
-                              and (float(self.sourceModel().data(index)) <= v['max']))
+    def update_accepted(self) -> np.ndarray:
+        """
+        rebuild the range index of the source table for the current property ranges
+        """
+        dataframe = self.track_model.dataframe
+        track_id = self.track_model.track_id_column_name.strip()
+        columns = [k for k in self.properties
+                   if str(k).strip() != track_id and k in dataframe.columns]
+        self._range_index = utils.PropertyRangeIndex(dataframe, columns)
+        for k in columns:
+            self._range_index.set_range(k, self.properties[k]['min'], self.properties[k]['max'])
+        self._accepted = self._range_index.accepted
+        return self._accepted
+
+    def _update_order(self):
+        columns = self.track_model._columns
+        if self._sort_column < 0 or self._sort_column >= len(columns):
+            self._order = None
+        else:
+            self._order = _argsort_column(columns[self._sort_column], self._sort_order)
+        self._position = None
+
+    def _sort_keys(self, rows: np.ndarray) -> np.ndarray:
+        """
+        positions of the dataframe rows in the sort order of the proxy
+        """
+        if self._order is None:
+            return rows
+        if self._position is None:
+            self._position = np.empty(len(self._order), dtype=np.int64)
+            self._position[self._order] = np.arange(len(self._order))
+        return self._position[rows]
+
+    def _update_rows(self):
+        # accepted dataframe rows, filtered out of the sort order
+        if self._order is None:
+            self._set_rows(np.flatnonzero(self._accepted))
+        else:
+            self._set_rows(self._order[self._accepted[self._order]])
+
+    def _set_rows(self, rows: np.ndarray):
+        self._rows = rows
+        self._proxy_rows = None
+        self._loaded = min(len(self._rows), max(self._loaded, self.track_model.fetch_batch))
+
+    def _dataframe_row(self, index: QModelIndex) -> int:
+        if not index.isValid():
+            return -1
+        return int(self._rows[index.row()])
+
+    def _proxy_row(self, dataframe_row: int) -> int:
+        if self._proxy_rows is None:
+            self._proxy_rows = np.full(len(self.track_model.dataframe), -1, dtype=np.int64)
+            self._proxy_rows[self._rows] = np.arange(len(self._rows))
+        return int(self._proxy_rows[dataframe_row])
 
-        # AND LOGIC
-        if all(conditions):
-            return True
-        return False
+    def _index_of_dataframe_row(self, row: int, column: int) -> QModelIndex:
+        if row < 0:
+            return QModelIndex()
+        row = self._proxy_row(row)
+        if row < 0 or row >= self._loaded:
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def _begin_remap(self):
+        self._updating = True
+        self.layoutAboutToBeChanged.emit()
+        self._persistent = self.persistentIndexList()
+        self._persistent_rows = [self._dataframe_row(index) for index in self._persistent]
+
+    def _end_remap(self, rows: np.ndarray = None):
+        # persistent indexes (selection, current index) of rows still accepted are kept
+        if rows is None:
+            self._update_rows()
+        else:
+            self._set_rows(rows)
+        self.changePersistentIndexList(self._persistent,
+                                       [self._index_of_dataframe_row(row, index.column())
+                                        for row, index in zip(self._persistent_rows, self._persistent)])
+        self._persistent = []
+        self._persistent_rows = []
+        self.layoutChanged.emit()
+        self._updating = False
+
+    def invalidateFilter(self, changed_rows: np.ndarray = None):
+        """
+        update the proxy rows for the dataframe rows whose accepted status changed,
+        without changed_rows the accepted rows are recomputed and remapped in one layout change
+        """
+        if changed_rows is not None and not len(changed_rows):
+            return
+        if changed_rows is None:
+            self._begin_remap()
+            self.update_accepted()
+            self._end_remap()
+            return
+
+        changed_rows = np.asarray(changed_rows, dtype=np.int64)
+        accepted = self._accepted[changed_rows]
+        entering = changed_rows[accepted]
+        entering_keys = self._sort_keys(entering)
+        order = np.argsort(entering_keys)
+        entering, entering_keys = entering[order], entering_keys[order]
+        keys = self._sort_keys(self._rows)
+        removed = np.searchsorted(keys, np.sort(self._sort_keys(changed_rows[~accepted])))
+        kept = np.delete(self._rows, removed)
+        insert_at = np.searchsorted(np.delete(keys, removed), entering_keys)
+        remove_runs = _contiguous_runs(removed)
+        # positions of the entering rows once inserted
+        insert_runs = _contiguous_runs(insert_at + np.arange(len(entering)))
+
+        if len(remove_runs) + len(insert_runs) > self.max_row_signals:
+            self._begin_remap()
+            self._end_remap(np.insert(kept, insert_at, entering))
+            return
+
+        # one signal per run, the rows are updated run by run so the model is
+        # consistent at every signal
+        self._updating = True
+        # the last runs first, the positions of the runs before stay valid
+        for start, stop in reversed(remove_runs):
+            visible = start < self._loaded
+            if visible:
+                removed_stop = min(stop, self._loaded)
+                self.beginRemoveRows(QModelIndex(), start, removed_stop - 1)
+                self._loaded -= removed_stop - start
+            self._rows = np.delete(self._rows, slice(start, stop))
+            self._proxy_rows = None
+            if visible:
+                self.endRemoveRows()
+        offset = 0
+        for start, stop in insert_runs:
+            # rows inserted after the loaded rows are fetched later, unless every row is loaded
+            visible = start < self._loaded or self._loaded == len(self._rows)
+            if visible:
+                self.beginInsertRows(QModelIndex(), start, stop - 1)
+                self._loaded += stop - start
+            self._rows = np.insert(self._rows, start, entering[offset:offset + stop - start])
+            self._proxy_rows = None
+            offset += stop - start
+            if visible:
+                self.endInsertRows()
+        loaded = min(len(self._rows), max(self._loaded, self.track_model.fetch_batch))
+        if loaded > self._loaded:
+            self.beginInsertRows(QModelIndex(), self._loaded, loaded - 1)
+            self._loaded = loaded
+            self.endInsertRows()
+        self._updating = False
+
+    def _source_about_to_be_reset(self):
+        self.beginResetModel()
+
+    def _source_reset(self):
+        self.update_accepted()
+        self._update_order()
+        self._loaded = 0
+        self._update_rows()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return self._loaded
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        if parent.isValid() or self.sourceModel() is None:
+            return 0
+        return self.sourceModel().columnCount()
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return (not parent.isValid()) and (not self._updating) and self._loaded < len(self._rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        count = min(self.track_model.fetch_batch, len(self._rows) - self._loaded)
+        self._updating = True
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+        self._updating = False
+
+    def index(self, row: int, column: int, parent=QModelIndex()) -> QModelIndex:
+        if parent.isValid() or not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QModelIndex()) -> QModelIndex:
+        return QModelIndex()
+
+    def mapToSource(self, proxy_index: QModelIndex) -> QModelIndex:
+        if not proxy_index.isValid() or proxy_index.row() >= len(self._rows):
+            return QModelIndex()
+        row = self.track_model.model_rows(self._rows[proxy_index.row()])
+        return self.sourceModel().index(int(row), proxy_index.column())
+
+    def mapFromSource(self, source_index: QModelIndex) -> QModelIndex:
+        if not source_index.isValid():
+            return QModelIndex()
+        return self._index_of_dataframe_row(int(self.track_model.dataframe_rows(source_index.row())),
+                                            source_index.column())
 
     def headerData(self, section: int, orientation: Qt.Orientation, role: int):
         return self.sourceModel().headerData(section, orientation, role)
 
+    def sort(self, column: int, order: Qt.SortOrder = Qt.SortOrder.AscendingOrder):
+        """
+        sort the proxy rows with an argsort of the column, the source model keeps its order,
+        a negative column restores the dataframe order
+        """
+        self._begin_remap()
+        self._sort_column = column
+        self._sort_order = order
+        self._update_order()
+        self._end_remap()
+
+    def accepted_track_ids(self):
+        """
+        track ids of the rows accepted by the filter, in the order of the proxy
+        """
+        track_ids = self.track_model.dataframe[self.track_model.track_id_column_name].to_numpy()
+        return track_ids[self._rows]
+
     def setTrackModel(self, model: TrackMetaModel):
         self.track_model = model
+        self.beginResetModel()
         self.setSourceModel(model)
+        self._source_reset()
+        model.modelAboutToBeReset.connect(self._source_about_to_be_reset)
+        model.modelReset.connect(self._source_reset)
 
     def update_prperties(self):
         for property in self.track_model.dataframe.columns:
@@ -85,4 +423,7 @@ class TrackMetaModelProxy(QSortFilterProxyModel):
         print(f"property_filter_updated {property_name}, {vrange}")
         self.properties[property_name] = {'min': vrange[0], 'max': vrange[1]}
         self.filterUpdated.emit(property_name, vrange)
-        self.invalidateFilter()
+        if self._range_index is not None and property_name in self._range_index:
+            self.invalidateFilter(self._range_index.set_range(property_name, vrange[0], vrange[1]))
+        else:
+            self.invalidateFilter()
@@ -1,13 +1,20 @@
 from pathlib import Path
+import napari
 from napari.utils import progress
+from napari.qt.threading import thread_worker
+import pandas as pd
 from qtpy.QtWidgets import QWidget, QVBoxLayout
 from qtpy.QtCore import QItemSelectionModel
-from napari_tracking_analysis.base import NLayerWidget, AppState
+from napari_tracking_analysis.base import NLayerWidget, AppState, ClosingGeneratorWorker
 from napari_tracking_analysis.tracking_widget.track_models import TrackMetaModel, TrackMetaModelProxy
 from napari_tracking_analysis.filter_widget.property_filter_widget import FilterWidget
 from qtpy import uic
 from napari_tracking_analysis import utils
 from napari_tracking_analysis.utils import TrackLabels as Labels
+import time
+
+# seconds between two updates of the "All Tracks" layer while linking
+PARTIAL_TRACKS_INTERVAL = 1.0
 
 
 class _tracking_ui(QWidget):
@@ -18,6 +25,9 @@ class _tracking_ui(QWidget):
         self.load_ui(UI_FILE)
         self.sbSearchRange.setValue(2)
         self.sbMemory.setValue(1)
+        self.cbMeasurement.addItems(list(utils.MEASURE_BACKENDS.keys()))
+        self.cbMeasurement.setToolTip("regionprops: skimage regionprops_table per frame\n"
+                                      "bincount: vectorized labeled reductions, faster for many spots")
 
     def load_ui(self, path):
         uic.loadUi(path, self)
@@ -33,11 +43,18 @@ class TrackingWidget(NLayerWidget):
         self.ui = _tracking_ui(self)
         self.layout().addWidget(self.ui)
         self.ui.filterView.setLayout(QVBoxLayout())
+        # per frame detections, re-tracking only measures the frames that changed
+        self.feature_cache = utils.FeatureCache()
+        # tracking and sweep share the feature cache, only one of them runs at a time
+        self._tracking_worker = None
+        self._sweep_worker = None
 
         def _start_tracking():
             self.track()
 
         self.ui.btnTrack.clicked.connect(_start_tracking)
+        self.ui.btnSweep.clicked.connect(self.sweep)
+        self.ui.sweepView.doubleClicked.connect(self.sweep_selected)
 
         # def _track_layer_added(event):
         #     if isinstance(event.value, napari.layers.Tracks):
@@ -66,7 +83,8 @@ class TrackingWidget(NLayerWidget):
                 #     self.ui.filterView.layout().addWidget(self.propertyFilter)
                 #     self.ui.filterView.layout().setContentsMargins(0, 0, 0, 0)
                 tracking_df = val["value"]
-                self.setup_tracking_state(tracked_df=tracking_df['tracks_df'], track_meta=tracking_df["meta_df"])
+                # only the track meta is used here, the tracks of an opened project stay encoded
+                self.setup_tracking_state(tracked_df=None, track_meta=tracking_df["meta_df"])
         self.state.dataAdded.connect(_track_data_added)
 
         def _state_data_updated(key, val):
@@ -96,46 +114,180 @@ class TrackingWidget(NLayerWidget):
                                                     "proxy_selection": proxy_selection})
 
     def track(self):
+        # a click while tracking is running cancels it
+        if self._tracking_worker is not None:
+            self._tracking_worker.quit()
+            return
+        if self._sweep_worker is not None:
+            napari.utils.notifications.show_warning("A parameter sweep is running")
+            return
+
         image = self.get_layer('Image').data
         mask = self.get_layer('Label').data
         search_range = float(self.ui.sbSearchRange.value())
         memory = int(self.ui.sbMemory.value())
-        pbr = progress(total=100, desc="Tracking")
-
-        image_layer = image
-        mask_layer = mask
-        main_pd_frame = utils.get_statck_properties(
-            masks=mask_layer, images=image_layer, show_progress=False)
-
-        pbr.update(10)
-
-        tracked_df = utils.get_tracks(
-            main_pd_frame, search_range=search_range, memory=memory)
+        backend = self.ui.cbMeasurement.currentText()
+        pbr = progress(total=image.shape[0], desc="Hashing")
+
+        # closed in the worker thread when cancelled, see ClosingGeneratorWorker
+        @thread_worker(worker_class=ClosingGeneratorWorker)
+        def _track():
+            # every yield is a point where a cancel stops the worker
+            for stage, count in self.feature_cache.measure_iter(masks=mask, images=image, backend=backend,
+                                                                n_workers=None):
+                # a stage (hashing, measuring) starts with count None and counts the frames of the stack
+                yield (stage, image.shape[0], None) if count is None else (None, count, None)
+            main_pd_frame = self.feature_cache.table
+
+            linker = utils.FrameLinker(main_pd_frame, search_range=search_range, memory=memory)
+            yield "Tracking", linker.n_frames, None
+            last_push = time.monotonic()
+            for _ in linker:
+                partial_tracks = None
+                if time.monotonic() - last_push > PARTIAL_TRACKS_INTERVAL:
+                    partial_tracks = linker.napari_tracks()
+                    last_push = time.monotonic()
+                yield None, 1, partial_tracks
+            return linker.tracks()
+
+        def _yielded(value):
+            stage, count, partial_tracks = value
+            if stage is not None:
+                # a new stage, count is its total
+                pbr.set_description(stage)
+                pbr.reset(total=count)
+            else:
+                pbr.update(count)
+            if partial_tracks is not None:
+                utils.add_track_to_viewer(self.state.viewer, Labels.tracks_layer, partial_tracks)
+
+        def _returned(tracked_df):
+            self.tracking_done(tracked_df, search_range=search_range, memory=memory)
+
+        def _errored(error):
+            napari.utils.notifications.show_error(f"Tracking failed: {error}")
+
+        def _finished():
+            pbr.close()
+            self._tracking_worker = None
+            self.ui.btnTrack.setText("Track")
+            self.ui.btnSweep.setEnabled(True)
+
+        self._tracking_worker = _track()
+        self._tracking_worker.yielded.connect(_yielded)
+        self._tracking_worker.returned.connect(_returned)
+        self._tracking_worker.errored.connect(_errored)
+        self._tracking_worker.finished.connect(_finished)
+        self.ui.btnTrack.setText("Cancel")
+        self.ui.btnSweep.setEnabled(False)
+        self._tracking_worker.start()
+
+    def tracking_done(self, tracked_df, search_range, memory):
         # column name change from particle to track_id
         tracked_df.rename(columns={'particle': 'track_id'}, inplace=True)
 
-        tracks, properties, track_meta = utils.pd_to_napari_tracks(tracked_df,
-                                                                   Labels.track_header,
-                                                                   Labels.track_meta_header)
-        # self.setup_tracking_state(tracked_df=tracked_df, track_meta=track_meta)
-        self.state.setData(f"{self.name}", {"tracks_df": tracked_df, "meta_df": track_meta})
-
-        pbr.update(100)
-        pbr.close()
-
-        utils.add_track_to_viewer(self.state.viewer, Labels.tracks_layer, tracks, properties=properties,
-                                  metadata={'all_meta': track_meta,
-                                            'all_tracks': tracked_df,
+        # the All Tracks layer is added by the AppState from the shared napari_tracks_payload
+        _, _, track_meta = utils.napari_tracks_payload(tracked_df)
+        self.state.setData(f"{self.name}", {"tracks_df": tracked_df, "meta_df": track_meta,
                                             Labels.tracking_params: {
                                                 "search_range": search_range,
                                                 "memory": memory
-                                            }
-                                            })
+                                            }})
+
+    def sweep(self):
+        # a click while the sweep is running cancels it
+        if self._sweep_worker is not None:
+            self._sweep_worker.quit()
+            return
+        if self._tracking_worker is not None:
+            napari.utils.notifications.show_warning("Tracking is running")
+            return
+
+        image = self.get_layer('Image').data
+        mask = self.get_layer('Label').data
+        backend = self.ui.cbMeasurement.currentText()
+        # the swept values are the ones the search range control can be set to
+        decimals = self.ui.sbSearchRange.decimals()
+        search_ranges = sorted({round(v, decimals)
+                                for v in _parse_values(self.ui.leSweepSearchRange.text(), float)})
+        memories = _parse_values(self.ui.leSweepMemory.text(), int)
+        if not (len(search_ranges) and len(memories)):
+            napari.utils.notifications.show_warning("Enter comma separated search ranges and memories")
+            return
+
+        pbr = progress(total=len(search_ranges) * len(memories), desc="Parameter sweep")
+        summaries = []
+
+        # closed in the worker thread when cancelled, see ClosingGeneratorWorker
+        @thread_worker(worker_class=ClosingGeneratorWorker)
+        def _sweep():
+            # every yield is a point where a cancel stops the worker
+            for _ in self.feature_cache.measure_iter(masks=mask, images=image, backend=backend,
+                                                     n_workers=None):
+                yield None
+            # every run links the same cached detection table
+            yield from utils.link_sweep_iter(self.feature_cache.table, search_ranges, memories,
+                                             n_workers=None)
+
+        def _yielded(summary):
+            if summary is None:
+                return
+            summaries.append(summary)
+            pbr.update(1)
+
+        def _errored(error):
+            # the buttons are reset by _finished, the runs completed before are still shown
+            napari.utils.notifications.show_error(f"Parameter sweep failed: {error}")
+
+        def _finished():
+            pbr.close()
+            self._sweep_worker = None
+            self.ui.btnSweep.setText("Sweep")
+            self.ui.btnTrack.setEnabled(True)
+            failed = [s for s in summaries if s['error']]
+            if len(failed):
+                napari.utils.notifications.show_warning(
+                    f"{len(failed)} of the sweep runs could not be linked: {failed[0]['error']}")
+            if len(summaries):
+                result = pd.DataFrame(summaries).sort_values(['search_range', 'memory'], ignore_index=True)
+                self.set_sweep_result(result)
+
+        self._sweep_worker = _sweep()
+        self._sweep_worker.yielded.connect(_yielded)
+        self._sweep_worker.errored.connect(_errored)
+        self._sweep_worker.finished.connect(_finished)
+        self.ui.btnSweep.setText("Cancel")
+        self.ui.btnTrack.setEnabled(False)
+        self._sweep_worker.start()
+
+    def set_sweep_result(self, result: pd.DataFrame):
+        self.sweep_result = result
+        self.ui.sweepView.setModel(TrackMetaModel(result, 'search_range'))
+
+    def sweep_selected(self, index):
+        if (not index.isValid()) or (not hasattr(self, 'sweep_result')):
+            return
+        row = self.sweep_result.iloc[index.row()]
+        self.ui.sbSearchRange.setValue(float(row['search_range']))
+        self.ui.sbMemory.setValue(int(row['memory']))
 
 
 # Comman functions
 
 
+def _parse_values(text: str, dtype):
+    values = []
+    for v in text.replace(';', ',').split(','):
+        v = v.strip()
+        if not v:
+            continue
+        try:
+            values.append(dtype(v))
+        except ValueError:
+            continue
+    return values
+
+
 def _napari_main():
     import napari
     viewer = napari.Viewer()
@@ -1,10 +1,25 @@
+import contextlib
 import gzip
+import io
 import json
+import mmap
+import os
+import struct
+import threading
+import weakref
+import zipfile
+from collections.abc import MutableMapping
 from typing import List, Any
 import pandas as pd
 from napari_tracking_analysis import utils
+from napari_tracking_analysis.tracks_writer import FORMAT_NAME, FORMAT_VERSION, latest_manifest
 import numpy as np
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def get_reader(path: str) -> List[str]:
     """
@@ -20,14 +35,21 @@ def get_reader(path: str) -> List[str]:
 
 
 def track_stats_reader(path: str):
-    with gzip.open(path, 'rb') as f:
-        output_gz = f.read()
-        output = output_gz.decode('utf-8')
-        output = json.loads(output)
+    if is_container(path):
+        reader = TracksContainerReader(path)
+        output = reader.decode(reader.data)
+        reader.close()
+        all_tracks = output["all_tracks"]
+        all_meta = output["all_meta"]
+    else:
+        with gzip.open(path, 'rb') as f:
+            output_gz = f.read()
+            output = output_gz.decode('utf-8')
+            output = json.loads(output)
+        all_tracks = pd.read_json(io.StringIO(output["all_tracks"]))
+        all_meta = pd.read_json(io.StringIO(output["all_meta"]))
 
     print(output.keys())
-    all_tracks = pd.read_json(output["all_tracks"])
-    all_meta = pd.read_json(output["all_meta"])
     tracking_params = output["tracking_params"]
     metadata = {
         "all_tracks": all_tracks,
@@ -43,9 +65,9 @@ def track_stats_reader(path: str):
     track_meta_header = ['track_id', 'length',
                          'intensity_max', 'intensity_mean', 'intensity_min']
 
-    tracks, properties, track_meta = utils.pd_to_napari_tracks(all_tracks,
-                                                               track_header,
-                                                               track_meta_header)
+    tracks, properties, track_meta = utils.napari_tracks_payload(all_tracks,
+                                                                  track_header,
+                                                                  track_meta_header)
     attributes["properties"] = properties
     # print(type(attributes))
     layer_data = (tracks, attributes, 'tracks')
@@ -64,13 +86,359 @@ class NTracksDecoder(json.JSONDecoder):
         _decodec_obj = {}
         for k, v in dct.items():
             if k.strip().endswith("_df"):
-                _decodec_obj[k] = pd.read_json(v)
+                _decodec_obj[k] = pd.read_json(io.StringIO(v))
             else:
                 _decodec_obj[k] = v
         return _decodec_obj
 
 
-def state_reader(path: str) -> dict:
+def is_container(path: str) -> bool:
+    """
+    the file is a .tracks container (format version 2), it starts with a zip local header
+    """
+    with open(path, 'rb') as f:
+        return f.read(4) == b'PK\x03\x04'
+
+
+class _FileWindow:
+    """
+    the first size bytes of a file, as a seekable file object
+    """
+
+    def __init__(self, f, size: int):
+        self._file = f
+        self._size = size
+        self._pos = 0
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = max(0, min(offset, self._size))
+        return self._pos
+
+    def read(self, n=-1):
+        if n is None or n < 0 or self._pos + n > self._size:
+            n = self._size - self._pos
+        self._file.seek(self._pos)
+        data = self._file.read(n)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+# the readers of the opened containers and their memory maps (alive as long as an array
+# mapped from them is), by the os.stat of their file
+_open_files = weakref.WeakKeyDictionary()
+
+
+def file_in_use(path: str) -> bool:
+    """
+    path is held open by a reader of this process, or memory mapped by arrays decoded from it.
+    Such a file can not be replaced on windows
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return any(os.path.samestat(file_stat, stat) and not handle.closed
+               for handle, file_stat in list(_open_files.items()))
+
+
+def _open_zip(path: str) -> zipfile.ZipFile:
+    """
+    open a container, if a delta save stopped while appending, the file is read up to the
+    end record of the last complete save
+    """
+    try:
+        return zipfile.ZipFile(path, 'r')
+    except zipfile.BadZipFile:
+        pass
+    # the file is closed unless a ZipFile over it is returned
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(path, 'rb'))
+        end = f.seek(0, os.SEEK_END)
+        chunk_size = 1024 ** 2
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            data = f.read(end - start + 3)
+            position = data.rfind(b'PK\x05\x06')
+            while position >= 0:
+                # end of central directory record, 22 bytes and a comment
+                record = start + position
+                f.seek(record + 20)
+                comment_length = struct.unpack('<H', f.read(2))[0]
+                try:
+                    zip_file = zipfile.ZipFile(_FileWindow(f, record + 22 + comment_length), 'r')
+                except zipfile.BadZipFile:
+                    position = data.rfind(b'PK\x05\x06', 0, position)
+                    continue
+                stack.pop_all()
+                return zip_file
+            end = start
+    raise zipfile.BadZipFile(f"{path} has no complete save")
+
+
+class TracksContainerReader:
+    """
+    Reader of the .tracks container written by tracks_writer.TracksContainerWriter.
+    The manifest and the zip directory are read on open and the blocks when they are decoded,
+    uncompressed blocks are memory mapped (copy on write) when memory_map is set.
+    The file stays open with the reader, so the blocks still to decode are the ones of the
+    opened file even if the path is saved over.
+    memo maps the decoded DataFrames to their description, in the format of the
+    tracks_writer.TracksContainerWriter memo, so a delta save to the opened file does not
+    write them again.
+    """
+
+    def __init__(self, path: str, memory_map: bool = False):
+        self.path = path
+        self.memory_map = memory_map
+        self._zip = _open_zip(path)
+        try:
+            manifest = json.loads(self._zip.read(latest_manifest(self._zip.namelist())[0]).decode('utf-8'))
+            if manifest.get("format") != FORMAT_NAME:
+                raise ValueError(f"{path} is not a {FORMAT_NAME} file")
+            if manifest.get("version", 0) > FORMAT_VERSION:
+                raise ValueError(f"{path} has the format version {manifest['version']}, "
+                                 f"this version can read up to {FORMAT_VERSION}")
+        except BaseException:
+            self._zip.close()
+            raise
+        self._infos = {info.filename: info for info in self._zip.infolist()}
+        self._map = None
+        self.closed = False
+        stat = os.fstat(self._zip.fp.fileno())
+        _open_files[self] = stat
+        if memory_map:
+            self._map = mmap.mmap(self._zip.fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            _open_files[self._map] = stat
+        self.manifest = manifest
+        self.data = manifest["data"]
+        self.memo = {}
+
+    def close(self):
+        """
+        close the file, the arrays mapped from it keep the memory map until they are released
+        """
+        fp = self._zip.fp
+        self._zip.close()
+        if isinstance(fp, _FileWindow):
+            fp.close()
+        if self._map is not None:
+            # still exported by mapped arrays, closed when they are released
+            with contextlib.suppress(BufferError):
+                self._map.close()
+            self._map = None
+        self.closed = True
+
+    def is_file(self, path: str) -> bool:
+        """
+        path is the opened file (and not a file saved over it since)
+        """
+        try:
+            return os.path.samestat(os.fstat(self._zip.fp.fileno()), os.stat(path))
+        except (OSError, AttributeError, ValueError):
+            return False
+
+    def _map_array(self, info: zipfile.ZipInfo):
+        # the data of a stored entry follows its local header
+        name_length, extra_length = struct.unpack('<HH', self._map[info.header_offset + 26:info.header_offset + 30])
+        start = info.header_offset + 30 + name_length + extra_length
+        version = tuple(self._map[start + 6:start + 8])
+        if version == (1, 0):
+            header_length = 10 + struct.unpack('<H', self._map[start + 8:start + 10])[0]
+            read_header = np.lib.format.read_array_header_1_0
+        elif version == (2, 0):
+            header_length = 12 + struct.unpack('<I', self._map[start + 8:start + 12])[0]
+            read_header = np.lib.format.read_array_header_2_0
+        else:
+            return None
+        f = io.BytesIO(self._map[start + 8:start + header_length])
+        shape, fortran_order, dtype = read_header(f)
+        if dtype.hasobject or 0 in shape:
+            return None
+        count = int(np.prod(shape))
+        values = np.frombuffer(self._map, dtype=dtype, count=count, offset=start + header_length)
+        return values.reshape(shape, order='F' if fortran_order else 'C')
+
+    def read_array(self, name: str) -> np.ndarray:
+        info = self._infos[name]
+        if self._map is not None and name.endswith('.npy') and info.compress_type == zipfile.ZIP_STORED:
+            values = self._map_array(info)
+            if values is not None:
+                return values
+        with self._zip.open(info, 'r') as f:
+            if name.endswith('.gz'):
+                with gzip.GzipFile(fileobj=f, mode='rb') as block:
+                    return np.lib.format.read_array(block, allow_pickle=False)
+            if name.endswith('.zst'):
+                if zstandard is None:
+                    raise ImportError(f"{self.path} is zstd compressed, reading it needs the zstandard package")
+                with zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as block:
+                    return np.lib.format.read_array(block, allow_pickle=False)
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+    def _decode_values(self, spec: dict):
+        if "block" in spec:
+            values = self.read_array(spec["block"])
+        else:
+            values = np.asarray(spec["values"], dtype=object)
+        dtype = spec.get("dtype")
+        if dtype is None:
+            return values
+        if dtype == "category":
+            return pd.Categorical.from_codes(values, categories=self._decode_values(spec["categories"]),
+                                             ordered=spec["ordered"])
+        dtype = pd.api.types.pandas_dtype(dtype)
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            return pd.DatetimeIndex(values).tz_localize("UTC").tz_convert(dtype.tz).array
+        if "mask" in spec:
+            mask = self.read_array(spec["mask"])
+            return dtype.construct_array_type()(np.asarray(values), np.asarray(mask, dtype=np.bool_))
+        return pd.array(values, dtype=dtype)
+
+    def decode_dataframe(self, spec: dict) -> pd.DataFrame:
+        index_spec = spec["index"]
+        if "range" in index_spec:
+            index = pd.RangeIndex(*index_spec["range"], name=index_spec["name"])
+        else:
+            index = pd.Index(self._decode_values(index_spec), name=index_spec["name"])
+        columns = {column["name"]: self._decode_values(column) for column in spec["columns"]}
+        # copy=False keeps the (memory mapped) column arrays
+        df = pd.DataFrame(columns, index=index, columns=[column["name"] for column in spec["columns"]],
+                          copy=False)
+        self.memo[id(df)] = (weakref.ref(df), {"__dataframe__": spec})
+        return df
+
+    def decode(self, obj: Any, lazy: bool = False) -> Any:
+        """
+        decode a manifest entry, with lazy the dicts are decoded as LazyMapping
+        """
+        if isinstance(obj, dict):
+            if "__dataframe__" in obj:
+                return self.decode_dataframe(obj["__dataframe__"])
+            if "__ndarray__" in obj:
+                return self.read_array(obj["__ndarray__"])
+            if lazy:
+                return LazyMapping(self, obj)
+            return {k: self.decode(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self.decode(v, lazy) for v in obj]
+        return obj
+
+
+class _Encoded:
+    __slots__ = ("spec",)
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class LazyMapping(MutableMapping):
+    """
+    dict of a container entry, every value is decoded on its first access
+    (nested dicts are LazyMapping too), values set afterwards are kept as they are.
+    The decoding of a value holds a lock of its key, so a value read by several threads
+    (e.g. a background decode and the GUI thread) is decoded once and every caller gets
+    the same object, while the other values are decoded meanwhile.
+    """
+
+    def __init__(self, reader: TracksContainerReader, spec: dict):
+        self._reader = reader
+        self._items = {k: _Encoded(v) for k, v in spec.items()}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _key_lock(self, key) -> threading.RLock:
+        with self._locks_lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.RLock()
+            return lock
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if isinstance(value, _Encoded):
+            with self._key_lock(key):
+                # decoded by another thread while waiting
+                value = self._items[key]
+                if isinstance(value, _Encoded):
+                    value = self._reader.decode(value.spec, lazy=True)
+                    self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def is_loaded(self, key) -> bool:
+        return not isinstance(self._items[key], _Encoded)
+
+    def encoded_items(self, path: str) -> dict:
+        """
+        manifest descriptions of the values not decoded yet, when path is the file they were read from
+        """
+        if not self._reader.is_file(path):
+            return {}
+        return {k: v.spec for k, v in self._items.items() if isinstance(v, _Encoded)}
+
+    @property
+    def memo(self) -> dict:
+        """
+        DataFrames decoded from the file and their description, see TracksContainerReader
+        """
+        return self._reader.memo
+
+    def copy(self):
+        """
+        shallow copy, the values not decoded yet stay encoded
+        """
+        mapping = LazyMapping(self._reader, {})
+        mapping._items = dict(self._items)
+        return mapping
+
+    def __repr__(self):
+        return f"LazyMapping({list(self._items.keys())})"
+
+
+def state_reader(path: str, lazy: bool = False) -> dict:
+    """
+    read a saved state, with lazy the values of a container are decoded on first access
+    and its columns are memory mapped
+    """
+    if is_container(path):
+        reader = TracksContainerReader(path, memory_map=lazy)
+        data = reader.decode(reader.data, lazy=lazy)
+        if not lazy:
+            reader.close()
+        return data
+
+    # format version 1, gzip compressed json
     with gzip.open(path, 'rb') as f:
         data = f.read().decode('utf-8')
         data = json.loads(data, cls=NTracksDecoder)
@@ -1,20 +1,356 @@
 import gzip
 import json
+import os
+import shutil
+import weakref
+import zipfile
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, List
 import numpy as np
 import pandas as pd
-import warnings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# .tracks container, format version 2: a zip file holding a json manifest and one .npy
+# block per DataFrame column / numpy array. Version 1 is the gzip compressed json document.
+FORMAT_NAME = "napari-tracking-analysis"
+FORMAT_VERSION = 2
+MANIFEST_NAME = "manifest.json"
+# every delta save appends its blocks and a manifest of the next generation,
+# the manifest of the highest generation describes the file
+MANIFESTS_DIR = "manifests/"
+
+# compressed blocks are a multi member gzip file or a sequence of zstd frames,
+# one member / frame per CHUNK_SIZE bytes of the .npy block
+# saves are uncompressed unless a codec is given, compressed blocks can not be memory mapped
+CODEC_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+# zstandard is the zstd extra of the package
+DEFAULT_CODEC = "zstd" if zstandard is not None else "gzip"
+CHUNK_SIZE = 16 * 1024 ** 2
+
+# pandas nullable arrays, stored as a values block and a mask block
+_MASKED_ARRAYS = tuple(getattr(pd.arrays, name) for name in ("IntegerArray", "FloatingArray", "BooleanArray")
+                       if hasattr(pd.arrays, name))
+
+
+def _compressor(codec: str, level: int = None):
+    if codec == "gzip":
+        level = 1 if level is None else level
+        return lambda data: gzip.compress(data, compresslevel=level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+        level = 3 if level is None else level
+        # a compressor object can not be shared between threads
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"unknown codec {codec}, expected one of {list(CODEC_EXTENSIONS)}")
+
+
+def manifest_name(generation: int) -> str:
+    return MANIFEST_NAME if generation == 0 else f"{MANIFESTS_DIR}{generation:06d}.json"
+
+
+def latest_manifest(names: List[str]):
+    """
+    name and generation of the current manifest among the entry names of a container
+    """
+    generations = [int(name[len(MANIFESTS_DIR):].split('.')[0]) for name in names
+                   if name.startswith(MANIFESTS_DIR)]
+    generation = max(generations, default=0)
+    return manifest_name(generation), generation
+
+
+class _CompressedBlock:
+    """
+    file like object given to np.lib.format.write_array, what is written is cut in
+    CHUNK_SIZE parts compressed on the thread pool and appended to the zip entry in order,
+    with at most max_in_flight parts in memory
+    """
+
+    def __init__(self, entry, executor: ThreadPoolExecutor, compress, max_in_flight: int):
+        self._entry = entry
+        self._executor = executor
+        self._compress = compress
+        self._max_in_flight = max_in_flight
+        self._buffer = bytearray()
+        self._futures = deque()
+
+    def _submit(self, data: bytes):
+        self._futures.append(self._executor.submit(self._compress, data))
+        while len(self._futures) > self._max_in_flight:
+            self._entry.write(self._futures.popleft().result())
+
+    def write(self, data) -> int:
+        if not self._buffer and len(data) == CHUNK_SIZE:
+            self._submit(bytes(data))
+            return len(data)
+        self._buffer += data
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:CHUNK_SIZE]))
+            del self._buffer[:CHUNK_SIZE]
+        return len(data)
+
+    def close(self):
+        if len(self._buffer):
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while len(self._futures):
+            self._entry.write(self._futures.popleft().result())
 
 
 class NTracksEncoder(json.JSONEncoder):
     def default(self, obj: Any) -> Any:
         if isinstance(obj, np.ndarray):
             return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
         if isinstance(obj, pd.DataFrame):
             return obj.to_json()
         return json.JSONEncoder.default(self, obj)
 
 
+class TracksContainerWriter:
+    """
+    Writer of the .tracks container. DataFrames and numpy arrays found in the data are written
+    as .npy blocks, stored without compression so they can be memory mapped when reading, and
+    replaced in the manifest by a description of the blocks:
+        {"__dataframe__": {"columns": [{"name": .., "block": ..}, ..], "index": ..}}
+        {"__ndarray__": "blocks/000001.npy"}
+    Columns that numpy can not store without pickling (object, strings) stay in the manifest
+    as json lists. The pandas dtypes are kept with the column description ("dtype"):
+    nullable integer / float / boolean columns are a values block and a "mask" block,
+    category columns a block of codes and their "categories", tz-aware datetimes a UTC
+    datetime64 block. Other extension dtypes (period, interval, sparse, arrow) raise a TypeError.
+    With a codec the blocks are compressed (blocks/000001.npy.gz, .npy.zst) by n_workers threads,
+    the blocks are written to the file while they are compressed so the data is never held
+    in memory as a whole.
+    With append the blocks and the manifest of the next generation are added after the end of
+    an existing container, whose central directory stays valid until the new one is written.
+    memo maps the DataFrames already written to the file to their description, so they are
+    not written again (a DataFrame changed in place has to be replaced to be written).
+    """
+
+    def __init__(self, path: str, codec: str = None, level: int = None, n_workers: int = None,
+                 append: bool = False, memo: dict = None):
+        self.path = path
+        self.codec = codec
+        self.memo = {} if memo is None else memo
+        self._executor = None
+        if append:
+            # opened for reading first, in 'a' mode zipfile would add a new archive to a broken file
+            with zipfile.ZipFile(path, 'r') as zf:
+                names = zf.namelist()
+                name, generation = latest_manifest(names)
+                self.previous_manifest = json.loads(zf.read(name).decode('utf-8'))
+            self._zip = zipfile.ZipFile(path, 'a', compression=zipfile.ZIP_STORED, allowZip64=True)
+            self._generation = generation + 1
+            self._blocks = 1 + max((int(name[len("blocks/"):].split('.')[0]) for name in names
+                                    if name.startswith("blocks/")), default=-1)
+            self._zip.fp.seek(0, os.SEEK_END)
+            self._zip.start_dir = self._zip.fp.tell()
+        else:
+            self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            self.previous_manifest = None
+            self._generation = 0
+            self._blocks = 0
+        if codec is not None:
+            self._compress = _compressor(codec, level)
+            n_workers = n_workers or os.cpu_count() or 1
+            self._executor = ThreadPoolExecutor(max_workers=n_workers)
+            self._max_in_flight = 2 * n_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._zip.close()
+
+    def add_array(self, values: np.ndarray) -> str:
+        name = f"blocks/{self._blocks:06d}.npy"
+        self._blocks += 1
+        values = np.ascontiguousarray(values)
+        if self.codec is None:
+            with self._zip.open(name, 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, values, allow_pickle=False)
+            return name
+
+        name += CODEC_EXTENSIONS[self.codec]
+        with self._zip.open(name, 'w', force_zip64=True) as f:
+            block = _CompressedBlock(f, self._executor, self._compress, self._max_in_flight)
+            np.lib.format.write_array(block, values, allow_pickle=False)
+            block.close()
+        return name
+
+    def _encode_values(self, values) -> dict:
+        """
+        description of a column / index (Series, Index or numpy array)
+        """
+        dtype = values.dtype
+        array = getattr(values, "array", values)
+        if isinstance(dtype, np.dtype):
+            values = np.asarray(values)
+            if values.dtype.kind in 'biufcmM':
+                return {"block": self.add_array(values)}
+            return {"values": values.tolist()}
+        if isinstance(dtype, pd.CategoricalDtype):
+            categorical = pd.Categorical(array)
+            spec = {"dtype": "category", "ordered": bool(dtype.ordered),
+                    "categories": self._encode_values(categorical.categories)}
+            spec.update(self._encode_values(categorical.codes))
+            return spec
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            spec = self._encode_values(pd.DatetimeIndex(array).tz_convert("UTC").tz_localize(None).to_numpy())
+            spec["dtype"] = str(dtype)
+            return spec
+        if isinstance(array, _MASKED_ARRAYS):
+            mask = np.asarray(array.isna(), dtype=np.bool_)
+            data = array.to_numpy(dtype=dtype.numpy_dtype, na_value=dtype.numpy_dtype.type(0))
+            return {"dtype": str(dtype), "block": self.add_array(data), "mask": self.add_array(mask)}
+        if isinstance(dtype, pd.StringDtype):
+            values = np.asarray(array, dtype=object)
+            return {"dtype": str(dtype), "values": [None if pd.isna(v) else v for v in values.tolist()]}
+        raise TypeError(f"{dtype} values can not be stored in a {FORMAT_NAME} container")
+
+    def encode_dataframe(self, df: pd.DataFrame) -> dict:
+        written = self.memo.get(id(df))
+        if written is not None and written[0]() is df:
+            return written[1]
+        columns = []
+        for name in df.columns:
+            column = {"name": name}
+            try:
+                column.update(self._encode_values(df[name]))
+            except TypeError as e:
+                raise TypeError(f"column {name}: {e}") from e
+            columns.append(column)
+        if isinstance(df.index, pd.RangeIndex):
+            index = {"range": [df.index.start, df.index.stop, df.index.step]}
+        else:
+            index = self._encode_values(df.index)
+        index["name"] = df.index.name
+        spec = {"__dataframe__": {"columns": columns, "index": index}}
+        self.memo[id(df)] = (weakref.ref(df), spec)
+        return spec
+
+    def encode(self, obj: Any) -> Any:
+        if isinstance(obj, pd.DataFrame):
+            return self.encode_dataframe(obj)
+        if isinstance(obj, np.ndarray) and obj.dtype.kind in 'biufcmM':
+            return {"__ndarray__": self.add_array(obj)}
+        if isinstance(obj, Mapping):
+            # values of a lazily opened container (tracks_reader.LazyMapping) not decoded yet
+            # keep their description when appending to the same file
+            encoded = obj.encoded_items(self.path) if hasattr(obj, "encoded_items") else {}
+            return {k: encoded[k] if k in encoded else self.encode(obj[k]) for k in obj}
+        if isinstance(obj, (list, tuple)):
+            return [self.encode(v) for v in obj]
+        return obj
+
+    def write_manifest(self, data: Any):
+        manifest = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "data": data}
+        self._zip.writestr(manifest_name(self._generation), json.dumps(manifest, cls=NTracksEncoder))
+
+
+def _block_names(spec: Any, names: set) -> set:
+    # names of the blocks a manifest entry refers to
+    if isinstance(spec, dict):
+        for k, v in spec.items():
+            if k in ("block", "mask", "__ndarray__") and isinstance(v, str):
+                names.add(v)
+            else:
+                _block_names(v, names)
+    elif isinstance(spec, list):
+        for v in spec:
+            _block_names(v, names)
+    return names
+
+
+def superseded_size(path: str):
+    """
+    bytes of a container taken by the blocks and manifests its current manifest does not use
+    anymore (left by delta saves), and the size of the file
+    """
+    with zipfile.ZipFile(path, 'r') as zf:
+        name, _ = latest_manifest(zf.namelist())
+        used = _block_names(json.loads(zf.read(name).decode('utf-8'))["data"], {name})
+        superseded = sum(info.compress_size for info in zf.infolist() if info.filename not in used)
+    return superseded, os.path.getsize(path)
+
+
+def write_container(path: str, data: dict, codec: str = None, level: int = None,
+                    n_workers: int = None, memo: dict = None) -> str:
+    """
+    write data to a .tracks container, through a temporary file so an existing file
+    is only replaced by a complete one. codec None writes uncompressed blocks, which can be
+    memory mapped when the file is opened.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with TracksContainerWriter(tmp_path, codec=codec, level=level, n_workers=n_workers,
+                                   memo=memo) as writer:
+            writer.write_manifest(writer.encode(data))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def compact_container(path: str) -> str:
+    """
+    write again the manifest of a container and the blocks it uses, without the ones superseded
+    by delta saves. The blocks are copied as they are (not decoded), and the file replaced through
+    a temporary file as by write_container: it must not be open, or memory mapped, on windows
+    (see tracks_reader.file_in_use).
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with zipfile.ZipFile(path, 'r') as source, \
+                zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as target:
+            name, _ = latest_manifest(source.namelist())
+            manifest = source.read(name)
+            used = _block_names(json.loads(manifest.decode('utf-8'))["data"], set())
+            for info in source.infolist():
+                if info.filename in used:
+                    with source.open(info, 'r') as block, target.open(info.filename, 'w', force_zip64=True) as f:
+                        shutil.copyfileobj(block, f, CHUNK_SIZE)
+            # the manifest last, as the writer does
+            target.writestr(name, manifest)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def append_container(path: str, data: dict, keys, codec: str = None, level: int = None,
+                     n_workers: int = None, memo: dict = None) -> str:
+    """
+    delta save of data to an existing .tracks container: the values of keys (and the keys missing
+    from the current manifest) are appended with a new manifest, the other keys keep their
+    description, and blocks, of the current manifest. memo is the one of the previous writes
+    to this file.
+    """
+    with TracksContainerWriter(path, codec=codec, level=level, n_workers=n_workers,
+                               append=True, memo=memo) as writer:
+        previous = writer.previous_manifest["data"]
+        writer.write_manifest({k: writer.encode(v) if (k in keys or k not in previous) else previous[k]
+                               for k, v in data.items()})
+    return path
+
+
 def track_stats_writer(path: str, data: Any, attributes: dict) -> List[str]:
     """
     DataType = Any  # usually something like a numpy array, but varies by layer
@@ -30,23 +366,6 @@ def track_stats_writer(path: str, data: Any, attributes: dict) -> List[str]:
     attributes.pop('metadata')
     attributes.pop('features')
     output['napari_tracks_properties'] = attributes
-    with gzip.open(path, 'wb') as f:
-        f.write(json.dumps(output, cls=NTracksEncoder).encode('utf-8'))
+    write_container(path, output)
 
     return [path]
-
-
-def state_write(path: str, app_state: object) -> str:
-    """
-        from AppState Save 
-        self._data = dict()
-    """
-    if not hasattr(app_state, '_data'):
-        warnings.warn("state object is invalid! nothing to save returning..")
-        return None
-
-    data = app_state._data
-    with gzip.open(path, 'wb') as f:
-        f.write(json.dumps(data, cls=NTracksEncoder).encode('utf-8'))
-
-    return path
@@ -1,13 +1,23 @@
 import numpy as np
 import pandas as pd
 import trackpy
-from skimage import measure
 from tqdm import tqdm
 import napari
+import os
 import warnings
 from math import sqrt
+from itertools import islice
+import hashlib
+import multiprocessing
+import tempfile
+from collections import OrderedDict, deque
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
 from skimage.draw import disk, circle_perimeter
+from .._workers import (PROPERTIES_KEYS, _frame_columns, _chunk_columns, _chunk_columns_bincount,  # noqa: F401
+                        _iter_frame_coords, link_summary, LINK_SUMMARY_COLUMNS, _init_sweep_worker, _sweep_task,
+                        STEP_TABLE_COLUMNS, find_steps_batch, _fit_steps_chunk)
 
 
 class TrackLabels:
@@ -22,15 +32,70 @@ class TrackLabels:
                           'intensity_max', 'intensity_min', 'area', 'frame', 'track_id']
 
 
+# measurement backends selectable in get_statck_properties
+MEASURE_BACKENDS = {
+    'regionprops': _chunk_columns,
+    'bincount': _chunk_columns_bincount,
+}
+
+
+def _columns_to_dataframe(frames_columns: list) -> pd.DataFrame:
+    """
+    Build one DataFrame out of the per frame column dicts with a single concatenation per column
+    """
+    keys = list(frames_columns[0].keys())
+    columns = {k: np.concatenate([c[k] for c in frames_columns]) for k in keys}
+    df = pd.DataFrame(columns)
+    df.rename(columns={'centroid-0': 'y',
+                       'centroid-1': 'x'}, inplace=True)
+    return df
+
+
+def _frame_chunks(frames: np.ndarray, chunk_size: int):
+    for start in range(0, len(frames), chunk_size):
+        yield frames[start:start + chunk_size]
+
+
+def _take_frames(stack: np.ndarray, frames: np.ndarray) -> np.ndarray:
+    """
+    Read the given frames of the stack, contiguous frames are read with a slice
+    """
+    if frames[-1] - frames[0] + 1 == len(frames):
+        return np.asarray(stack[frames[0]:frames[-1] + 1])
+    return np.asarray(stack[frames])
+
+
+def _process_pool(n_workers: int, **kwargs) -> ProcessPoolExecutor:
+    """
+    Process pool started with spawn, the pools are started from napari worker threads and
+    forking a multi threaded Qt process can deadlock. The tasks are in napari_tracking_analysis._workers,
+    which does not import Qt or napari (the workers still re-import the main module of the parent)
+    """
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"), **kwargs)
+
+
+def _shutdown_pool(executor: ProcessPoolExecutor, pending):
+    """
+    Shut a process pool down. With futures still pending (a closed generator, an error) they are
+    cancelled and the worker processes terminated instead of waited for, a running task
+    (e.g. a trackpy run) can take long and the generator may be closed on the GUI thread
+    """
+    pending = [future for future in pending if not future.done()]
+    if not pending:
+        executor.shutdown(wait=True)
+        return
+    # shutdown(cancel_futures=True) needs python 3.9 and does not stop the running tasks
+    for future in pending:
+        future.cancel()
+    for process in list((getattr(executor, '_processes', None) or {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False)
+
+
 def get_frame_position_properties(frame: int, mask: np.ndarray, image: np.ndarray = None, result: pd.DataFrame = None,
                                   generate_label: bool = True) -> pd.DataFrame:
-    mask_label = measure.label(mask) if generate_label else mask
-    properties_keys = ['label', 'centroid', 'intensity_mean',
-                       'intensity_max', 'intensity_min', 'area']
-    properties = measure.regionprops_table(
-        label_image=mask_label, intensity_image=image, properties=properties_keys)
-    pf = pd.DataFrame(properties)
-    pf['frame'] = frame
+    columns = _frame_columns(frame=frame, mask=mask, image=image, generate_label=generate_label)
+    pf = pd.DataFrame(columns)
 
     if result is None:
         result = pf
@@ -40,21 +105,255 @@ def get_frame_position_properties(frame: int, mask: np.ndarray, image: np.ndarra
     return result
 
 
-def get_statck_properties(masks: np.ndarray, images: np.ndarray, result: pd.DataFrame = None,
-                          generate_label: bool = True, show_progress=False) -> pd.DataFrame:
+def measure_frames_iter(masks: np.ndarray, images: np.ndarray, frames=None, generate_label: bool = True,
+                        n_workers: int = 1, chunk_size: int = None, backend: str = 'regionprops'):
+    """
+    Measure the given frames of the stack in chunks, in a process pool when n_workers is not 1.
+    Closing the generator cancels the chunks not started yet.
+
+    params:
+        see measure_frames
+    yields:
+        (chunk frames, list of dict of column arrays one per frame of the chunk) as each chunk finishes
+    """
     assert images.shape == masks.shape
+    measure_chunk = MEASURE_BACKENDS[backend]
 
-    iter_range = tqdm(range(images.shape[0])) if show_progress else range(
-        images.shape[0])
+    frames = np.arange(images.shape[0]) if frames is None else np.asarray(frames, dtype=np.int64)
+    n_frames = len(frames)
+    n_workers = os.cpu_count() if n_workers is None else max(1, int(n_workers))
+    if chunk_size is None:
+        chunk_size = int(np.clip(np.ceil(n_frames / (n_workers * 4)), 1, 64))
+    chunks = list(_frame_chunks(frames, chunk_size))
 
-    for i in iter_range:
-        image = images[i]
-        mask = masks[i]
-        result = get_frame_position_properties(
-            frame=i, mask=mask, image=image, result=result, generate_label=generate_label)
-    result.rename(columns={'centroid-0': 'y',
-                  'centroid-1': 'x'}, inplace=True)
-    return result
+    if n_workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield chunk, measure_chunk(chunk, _take_frames(masks, chunk), _take_frames(images, chunk), generate_label)
+        return
+
+    executor = _process_pool(n_workers)
+    # keep a bounded number of chunks in flight so the stack is never copied as a whole
+    pending = {}
+    try:
+        chunk_iter = iter(chunks)
+
+        def _submit(count):
+            for chunk in islice(chunk_iter, count):
+                future = executor.submit(measure_chunk, chunk, _take_frames(masks, chunk),
+                                         _take_frames(images, chunk), generate_label)
+                pending[future] = chunk
+
+        _submit(n_workers * 2)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+            _submit(len(done))
+    finally:
+        _shutdown_pool(executor, pending)
+
+
+def measure_frames(masks: np.ndarray, images: np.ndarray, frames=None, generate_label: bool = True,
+                   show_progress=False, n_workers: int = 1, chunk_size: int = None,
+                   backend: str = 'regionprops') -> list:
+    """
+    Measure the given frames of the stack, in a process pool when n_workers is not 1
+
+    params:
+        masks: np.ndarray (T, Y, X) mask or label stack
+        images: np.ndarray (T, Y, X) intensity stack
+        frames: list of frame indices to measure, None measures all the frames
+        generate_label: bool label the masks before measuring
+        show_progress: bool show tqdm progress
+        n_workers: int number of worker processes, None uses all the cpus, 1 runs in process
+        chunk_size: int number of frames sent to a worker at once
+        backend: str measurement backend, one of MEASURE_BACKENDS
+
+    returns:
+        list of dict of column arrays, one per frame in the order of `frames`
+    """
+    frames = np.arange(images.shape[0]) if frames is None else np.asarray(frames, dtype=np.int64)
+    pbr = tqdm(total=len(frames)) if show_progress else None
+    measured = {}
+    for chunk, columns in measure_frames_iter(masks, images, frames=frames, generate_label=generate_label,
+                                              n_workers=n_workers, chunk_size=chunk_size, backend=backend):
+        measured[chunk[0]] = columns
+        if pbr is not None:
+            pbr.update(len(chunk))
+    if pbr is not None:
+        pbr.close()
+
+    # chunks are contiguous runs of `frames`, keyed by their first frame
+    frames_columns = []
+    position = 0
+    while position < len(frames):
+        columns = measured[frames[position]]
+        frames_columns.extend(columns)
+        position += len(columns)
+    return frames_columns
+
+
+def get_statck_properties(masks: np.ndarray, images: np.ndarray, result: pd.DataFrame = None,
+                          generate_label: bool = True, show_progress=False,
+                          n_workers: int = 1, chunk_size: int = None,
+                          backend: str = 'regionprops') -> pd.DataFrame:
+    """
+    Measure every frame of the stack and return one table with the columns
+    ['label', 'y', 'x', 'intensity_mean', 'intensity_max', 'intensity_min', 'area', 'frame']
+
+    params:
+        result: pd.DataFrame previous result to append to
+        see measure_frames for the rest of the parameters
+    """
+    frames_columns = measure_frames(masks=masks, images=images, generate_label=generate_label,
+                                    show_progress=show_progress, n_workers=n_workers,
+                                    chunk_size=chunk_size, backend=backend)
+    if not len(frames_columns):
+        return result
+    df = _columns_to_dataframe(frames_columns)
+    if result is not None:
+        result = result.rename(columns={'centroid-0': 'y',
+                                        'centroid-1': 'x'})
+        df = pd.concat([result, df], ignore_index=True)
+    return df
+
+
+class FeatureCache:
+    """
+    Cache of the per frame detection table used for re-tracking.
+
+    Every frame is keyed by a hash of its mask and a hash of its image, so only the frames
+    that changed since the last call (e.g. a painted Labels frame) are measured again
+    and re-tracking with new linking parameters only relinks. A read only memory mapped
+    stack (see stack_reader) whose file did not change is not read to be hashed again.
+    """
+
+    # frames hashed between two progress updates (cancel points)
+    hash_chunk_size = 32
+
+    def __init__(self):
+        self._frames = {}
+        self._settings = None
+        self._table = None
+        self._mapped = {}
+
+    def clear(self):
+        self._frames = {}
+        self._settings = None
+        self._table = None
+        # {file identity: per frame digests} of the read only mapped stacks
+        self._mapped = {}
+
+    @staticmethod
+    def array_digest(arr: np.ndarray) -> str:
+        arr = np.ascontiguousarray(arr)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{arr.dtype.str}{arr.shape}".encode())
+        digest.update(memoryview(arr).cast('B'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_identity(stack):
+        """
+        (path, size, mtime, offset, dtype, shape, strides) of a read only np.memmap stack, None for
+        other arrays. The views of a memmap (e.g. slices) keep the offset of the memmap they are
+        taken from, the offset is the one of the first byte of the view in the file
+        """
+        if not isinstance(stack, np.memmap) or stack.flags.writeable or not stack.filename:
+            return None
+        # the memmap holding the mmap, its offset is the one of its first byte
+        root = stack
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if not isinstance(root, np.memmap):
+            return None
+        offset = root.offset + stack.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+        try:
+            stat = os.stat(stack.filename)
+        except OSError:
+            return None
+        return (stack.filename, stat.st_size, stat.st_mtime_ns, offset, stack.dtype.str, stack.shape, stack.strides)
+
+    def get_statck_properties(self, masks: np.ndarray, images: np.ndarray, generate_label: bool = True,
+                              show_progress=False, n_workers: int = 1,
+                              backend: str = 'regionprops') -> pd.DataFrame:
+        """
+        Same as utils.get_statck_properties, measures only the frames not in the cache.
+        The returned table is shared, callers should not modify it in place.
+        """
+        pbr = tqdm(total=images.shape[0]) if show_progress else None
+        for stage, count in self.measure_iter(masks, images, generate_label=generate_label,
+                                              n_workers=n_workers, backend=backend):
+            if pbr is not None:
+                if count is None:
+                    pbr.set_description(stage)
+                    pbr.reset(total=images.shape[0])
+                else:
+                    pbr.update(count)
+        if pbr is not None:
+            pbr.close()
+        return self._table
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """
+        table of the last complete measure_iter
+        """
+        return self._table
+
+    def measure_iter(self, masks: np.ndarray, images: np.ndarray, generate_label: bool = True,
+                     n_workers: int = 1, backend: str = 'regionprops'):
+        """
+        Hash the frames then measure the frames not in the cache and set `table` when done.
+        Yields (stage, None) when a stage ("Hashing" then "Measuring", n_frames each) starts and
+        (stage, number of frames done) as it progresses, the cached frames are counted first.
+        Closing the generator cancels it, the frames measured so far stay cached.
+        """
+        assert images.shape == masks.shape
+        settings = (backend, generate_label, images.shape)
+        if settings != self._settings:
+            self.clear()
+            self._settings = settings
+
+        n_frames = images.shape[0]
+        known_masks = self._mapped.get(self.file_identity(masks))
+        known_images = self._mapped.get(self.file_identity(images))
+
+        def _digest(i):
+            return (self.array_digest(np.asarray(masks[i])) if known_masks is None else known_masks[i],
+                    self.array_digest(np.asarray(images[i])) if known_images is None else known_images[i])
+
+        yield "Hashing", None
+        digests = []
+        # hashlib releases the GIL on large buffers
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for start in range(0, n_frames, self.hash_chunk_size):
+                stop = min(start + self.hash_chunk_size, n_frames)
+                digests.extend(executor.map(_digest, range(start, stop)))
+                yield "Hashing", stop - start
+        for stack, position in ((masks, 0), (images, 1)):
+            identity = self.file_identity(stack)
+            if identity is not None:
+                # one entry per file, an older identity of the file is stale
+                self._mapped = {k: v for k, v in self._mapped.items() if k[0] != identity[0]}
+                self._mapped[identity] = [d[position] for d in digests]
+
+        yield "Measuring", None
+        stale = [i for i, d in enumerate(digests) if self._frames.get(i, (None, None))[0] != d]
+        yield "Measuring", n_frames - len(stale)
+        if not stale and self._table is not None:
+            return
+
+        self._table = None
+        if stale:
+            for chunk, measured in measure_frames_iter(masks=masks, images=images, frames=stale,
+                                                       generate_label=generate_label, n_workers=n_workers,
+                                                       backend=backend):
+                for i, columns in zip(chunk, measured):
+                    self._frames[i] = (digests[i], columns)
+                yield "Measuring", len(chunk)
+
+        self._table = _columns_to_dataframe([self._frames[i][1] for i in range(n_frames)])
 
 
 def get_tracks(df: pd.DataFrame, search_range: float = 2, memory: int = 0, show_progress: bool = False) -> pd.DataFrame:
@@ -62,6 +361,101 @@ def get_tracks(df: pd.DataFrame, search_range: float = 2, memory: int = 0, show_
     return trackpy.link(f=df, search_range=search_range, memory=memory)
 
 
+def link_sweep_iter(df: pd.DataFrame, search_ranges, memories, n_workers: int = 1):
+    """
+    Link the same detection table for every search_range / memory combination,
+    in a process pool when n_workers is not 1 (None uses all the cpus).
+    The detections are handed to each worker once at start up instead of once per run.
+
+    yields:
+        link_summary dict of each run as it finishes
+    """
+    coords = df[['frame', 'y', 'x']].to_numpy(dtype=np.float64)
+    coords = coords[np.argsort(coords[:, 0], kind='stable')]
+    grid = [(float(sr), int(m)) for sr in search_ranges for m in memories]
+    n_workers = os.cpu_count() if n_workers is None else max(1, int(n_workers))
+    n_workers = min(n_workers, len(grid))
+    if n_workers <= 1:
+        for search_range, memory in grid:
+            yield link_summary(coords, search_range=search_range, memory=memory)
+        return
+
+    executor = _process_pool(n_workers, initializer=_init_sweep_worker, initargs=(coords,))
+    futures = []
+    try:
+        futures = [executor.submit(_sweep_task, search_range, memory) for search_range, memory in grid]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # closing the generator (a cancelled sweep) does not wait for the runs in progress
+        _shutdown_pool(executor, futures)
+
+
+def link_sweep(df: pd.DataFrame, search_ranges, memories, n_workers: int = 1) -> pd.DataFrame:
+    """
+    see link_sweep_iter
+
+    returns:
+        pd.DataFrame one row of link_summary per search_range / memory combination
+    """
+    summaries = list(link_sweep_iter(df, search_ranges, memories, n_workers=n_workers))
+    return pd.DataFrame(summaries).sort_values(['search_range', 'memory'], ignore_index=True)
+
+
+class FrameLinker:
+    """
+    Frame by frame version of get_tracks using trackpy's iterative linker, the detections
+    are linked in frame order (stable sort). Iterating over the object links one frame per
+    step and yields the frame number, the tracks linked so far can be read at any time.
+    The particle ids are not the ones of get_tracks: trackpy resolves ambiguous subnetworks
+    in set order, two links of the same detections can already differ.
+
+    usage:
+        linker = FrameLinker(df, search_range=2, memory=1)
+        for _ in linker:
+            partial = linker.napari_tracks()
+        tracked_df = linker.tracks()
+    """
+
+    def __init__(self, df: pd.DataFrame, search_range: float = 2, memory: int = 0, show_progress: bool = False):
+        trackpy.quiet((not show_progress))
+        self.df = df
+        self.search_range = search_range
+        self.memory = memory
+        frames = df['frame'].to_numpy().astype(np.int64)
+        self.order = np.argsort(frames, kind='stable')
+        self.coords = np.column_stack([frames, df['y'].to_numpy(), df['x'].to_numpy()]).astype(np.float64)
+        self.coords = self.coords[self.order]
+        self.particle_ids = np.full(len(df), -1, dtype=np.int64)
+        self.n_linked = 0
+        self.n_frames = int(frames.max() - frames.min() + 1) if len(frames) else 0
+
+    def __iter__(self):
+        self.n_linked = 0
+        if not len(self.coords):
+            return
+        for frame, ids in trackpy.link_iter(_iter_frame_coords(self.coords), self.search_range,
+                                            memory=self.memory):
+            self.particle_ids[self.n_linked:self.n_linked + len(ids)] = ids
+            self.n_linked += len(ids)
+            yield frame
+
+    def napari_tracks(self) -> np.ndarray:
+        """
+        tracks linked so far as napari Tracks data [track_id, frame, y, x]
+        """
+        return np.column_stack([self.particle_ids[:self.n_linked], self.coords[:self.n_linked]])
+
+    def tracks(self) -> pd.DataFrame:
+        """
+        detections linked so far with the trackpy 'particle' column, same layout as get_tracks
+        """
+        tracked = self.df.iloc[self.order[:self.n_linked]].copy()
+        tracked['frame'] = tracked['frame'].astype(np.int64)
+        tracked['particle'] = self.particle_ids[:self.n_linked]
+        return tracked
+
+
 def napari_track_to_pd(track_layer: napari.layers.Tracks, track_header: list, track_id):
     """
     This function converts the napari Tracks layer to pandas DataFrame
@@ -105,31 +499,243 @@ def pd_to_napari_tracks(df: pd.DataFrame, track_header, track_meta_header):
         napari_track_to_pd
     """
     # assuming df is the dataframe with 'particle' as track_id
-    tracks = []
-    properties = {}
-
     columns = list(df.columns)
 
     for th in track_header:
         columns.remove(th)
 
-    tg = df.groupby('track_id', as_index=False,
-                    group_keys=True, dropna=True)
-    track_meta = pd.concat([tg['frame'].count(),
-                            tg['intensity_mean'].max()['intensity_mean'],
-                            tg['intensity_mean'].mean()['intensity_mean'],
-                            tg['intensity_mean'].min()['intensity_mean']], axis=1)
+    # one groupby pass: [track_id, length, intensity_max, intensity_mean, intensity_min]
+    aggregations = [('frame', 'count'), ('intensity_mean', 'max'),
+                    ('intensity_mean', 'mean'), ('intensity_mean', 'min')]
+    track_meta = df.groupby('track_id', as_index=False, sort=True, dropna=True).agg(
+        **dict(zip(track_meta_header[1:], aggregations)))
     track_meta.columns = track_meta_header
 
-    properties = df[columns].to_dict()
-    properties = dict(
-        map(lambda kv: (kv[0], np.array(list(kv[1].values()))), properties.items()))
+    # column arrays are handed out as they are, without a round trip through python dicts
+    properties = {c: df[c].to_numpy(copy=False) for c in columns}
 
     tracks = df[track_header].to_numpy()
 
     return tracks, properties, track_meta
 
 
+# per DataFrame memoized results keyed by (id of the DataFrame, key), see _dataframe_memo
+_dataframe_cache = {}
+
+
+def _dataframe_memo(df: pd.DataFrame, key, build):
+    """
+    Return build() memoized for the DataFrame object, the entry is dropped when
+    the DataFrame is garbage collected. The DataFrame should not be modified in place
+    after the first call.
+    """
+    cache_key = (id(df), key)
+    entry = _dataframe_cache.get(cache_key)
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+
+    def _evict(ref, cache_key=cache_key):
+        if _dataframe_cache.get(cache_key, (None,))[0] is ref:
+            del _dataframe_cache[cache_key]
+
+    value = build()
+    _dataframe_cache[cache_key] = (weakref.ref(df, _evict), value)
+    return value
+
+
+def napari_tracks_payload(df: pd.DataFrame, track_header=None, track_meta_header=None):
+    """
+    Memoized pd_to_napari_tracks, the tracks array, properties and track meta of a tracks
+    DataFrame are built once and shared by every consumer.
+
+    params:
+        df: pandas.DataFrame
+        track_header: default TrackLabels.track_header
+        track_meta_header: default TrackLabels.track_meta_header
+
+    return:
+        same as pd_to_napari_tracks
+    """
+    track_header = TrackLabels.track_header if track_header is None else track_header
+    track_meta_header = TrackLabels.track_meta_header if track_meta_header is None else track_meta_header
+    return _dataframe_memo(df, ('napari_tracks', tuple(track_header), tuple(track_meta_header)),
+                           lambda: pd_to_napari_tracks(df, track_header, track_meta_header))
+
+
+class TrackIndex:
+    """
+    CSR style index of a tracks DataFrame, the rows sorted by (track_id, frame) plus an
+    offsets array. The rows of track k are offsets[k]:offsets[k+1] of the sorted columns,
+    so a track trace or its coordinates are zero copy slices.
+    The index holds a weak reference to the DataFrame (it is memoized on it), columns not
+    built before the DataFrame is released can not be read anymore.
+
+    usage:
+        index = track_index(tracks_df)
+        intensity = index.values('intensity_mean', track_id)
+        coords = index.values(['frame', 'y', 'x'], track_id)
+    """
+
+    def __init__(self, df: pd.DataFrame, track_id: str = TrackLabels.track_id, frame: str = 'frame'):
+        self._df = weakref.ref(df)
+        track_ids = df[track_id].to_numpy()
+        self.order = np.lexsort((df[frame].to_numpy(), track_ids))
+        self.track_ids, starts = np.unique(track_ids[self.order], return_index=True)
+        self.offsets = np.append(starts, len(self.order)).astype(np.int64)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def __contains__(self, track_id):
+        k = np.searchsorted(self.track_ids, track_id)
+        return k < len(self.track_ids) and self.track_ids[k] == track_id
+
+    def column(self, name) -> np.ndarray:
+        """
+        column(s) sorted by (track_id, frame), built once per column.
+        A list of names gives a 2D array with one column per name
+        """
+        key = name if isinstance(name, str) else tuple(name)
+        if key not in self._columns:
+            df = self._df()
+            if df is None:
+                raise ReferenceError(f"the DataFrame of the index was released, column {name} is not built")
+            if isinstance(name, str):
+                self._columns[key] = df[name].to_numpy()[self.order]
+            else:
+                self._columns[key] = df[list(name)].to_numpy()[self.order]
+        return self._columns[key]
+
+    def slice(self, track_id) -> slice:
+        k = np.searchsorted(self.track_ids, track_id)
+        if k >= len(self.track_ids) or self.track_ids[k] != track_id:
+            raise KeyError(track_id)
+        return slice(self.offsets[k], self.offsets[k + 1])
+
+    def values(self, name, track_id) -> np.ndarray:
+        """
+        view of the column(s) `name` for the rows of `track_id`, ordered by frame
+        """
+        return self.column(name)[self.slice(track_id)]
+
+    def lengths(self, track_ids=None) -> np.ndarray:
+        if track_ids is None:
+            return np.diff(self.offsets)
+        k = np.searchsorted(self.track_ids, track_ids)
+        return self.offsets[k + 1] - self.offsets[k]
+
+    def ragged(self, name: str, track_ids=None):
+        """
+        ragged array of the column for the given tracks (all by default)
+
+        returns:
+            values: np.ndarray concatenated traces
+            offsets: np.ndarray trace i is values[offsets[i]:offsets[i+1]]
+        """
+        values = self.column(name)
+        if track_ids is None:
+            return values, self.offsets
+        track_ids = np.asarray(track_ids)
+        k = np.searchsorted(self.track_ids, track_ids)
+        if np.any(k >= len(self.track_ids)) or np.any(self.track_ids[np.minimum(k, len(self.track_ids) - 1)] != track_ids):
+            raise KeyError("unknown track id")
+        starts = self.offsets[k]
+        lengths = self.offsets[k + 1] - starts
+        offsets = np.zeros(len(k) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return values[rows], offsets
+
+
+def track_index(df: pd.DataFrame) -> TrackIndex:
+    """
+    TrackIndex of the tracks DataFrame, built once per tracking result
+    """
+    return _dataframe_memo(df, 'track_index', lambda: TrackIndex(df))
+
+
+def _interval_difference(start: int, stop: int, other_start: int, other_stop: int) -> np.ndarray:
+    """
+    positions of [start, stop) that are not in [other_start, other_stop)
+    """
+    return np.concatenate([np.arange(start, min(stop, other_start)),
+                           np.arange(max(start, other_stop), stop)])
+
+
+class PropertyRangeIndex:
+    """
+    Range filter index of a table, built once per table.
+
+    Every property keeps its argsort and sorted values so a [min, max] range is a pair of
+    binary searches, and every row keeps the number of property ranges it satisfies.
+    Moving a range only touches the rows entering or leaving it, a row is accepted when
+    it satisfies all the ranges (AND logic).
+
+    usage:
+        index = PropertyRangeIndex(meta_df, ['length', 'intensity_mean'])
+        changed_rows = index.set_range('length', 10, 50)
+        index.accepted  # bool mask of the rows
+    """
+
+    def __init__(self, df: pd.DataFrame, columns):
+        self.columns = list(columns)
+        n_rows = len(df)
+        self._order = {}
+        self._sorted = {}
+        self._bounds = {}
+        for name in self.columns:
+            values = df[name].to_numpy(dtype=np.float64)
+            order = np.argsort(values, kind='stable')
+            self._order[name] = order
+            self._sorted[name] = values[order]
+            # no range set yet, every row (nan included) satisfies it
+            self._bounds[name] = (0, n_rows)
+        self.count = np.full(n_rows, len(self.columns), dtype=np.int32)
+        self.accepted = np.ones(n_rows, dtype=bool)
+
+    def __contains__(self, name):
+        return name in self._order
+
+    def positions(self, name, vmin, vmax):
+        """
+        [start, stop) of the sorted values of `name` in [vmin, vmax], nan never is
+        """
+        if not vmin <= vmax:
+            return 0, 0
+        sorted_values = self._sorted[name]
+        return (int(np.searchsorted(sorted_values, vmin, side='left')),
+                int(np.searchsorted(sorted_values, vmax, side='right')))
+
+    def rows(self, name) -> np.ndarray:
+        """
+        rows satisfying the current range of `name`
+        """
+        start, stop = self._bounds[name]
+        return self._order[name][start:stop]
+
+    def set_range(self, name, vmin, vmax) -> np.ndarray:
+        """
+        set the range of `name`
+        returns:
+            rows whose accepted status changed
+        """
+        start, stop = self._bounds[name]
+        new_start, new_stop = self.positions(name, vmin, vmax)
+        self._bounds[name] = (new_start, new_stop)
+        order = self._order[name]
+        entering = order[_interval_difference(new_start, new_stop, start, stop)]
+        leaving = order[_interval_difference(start, stop, new_start, new_stop)]
+        self.count[entering] += 1
+        self.count[leaving] -= 1
+
+        rows = np.concatenate([entering, leaving])
+        accepted = self.count[rows] == len(self.columns)
+        changed = rows[accepted != self.accepted[rows]]
+        self.accepted[rows] = accepted
+        return changed
+
+
 def FindSteps(data, window=20, threshold=0.5):
     from scipy.ndimage import gaussian_filter1d
     # filter and normalise the data
@@ -193,6 +799,233 @@ def FindSteps(data, window=20, threshold=0.5):
     return table, fitx, gaussian_normalise
 
 
+STEP_META_COLUMNS = ['track_id', 'step_count', 'negetive_steps',
+                     'positive_steps', 'step_height', 'max_intensity', 'length']
+
+
+def fit_steps_iter(tracks_index: TrackIndex, track_ids, window=20, threshold=0.5, column='intensity_mean',
+                   n_workers: int = 1, chunk_size: int = None):
+    """
+    Step fitting of the given tracks in chunks, in a process pool when n_workers is not 1.
+    Only the traces of a chunk are sent to the worker fitting it, with a bounded number of
+    chunks in flight. Closing the generator cancels the chunks not started yet.
+
+    params:
+        n_workers: int number of worker processes, None uses all the cpus, 1 runs in process
+        chunk_size: int number of tracks fitted at once
+    yields:
+        (chunk position, number of tracks, steps_df, steps_meta_df) of each chunk as it finishes
+    """
+    track_ids = np.asarray(track_ids)
+    n_workers = os.cpu_count() if n_workers is None else max(1, int(n_workers))
+    if chunk_size is None:
+        chunk_size = int(np.clip(np.ceil(len(track_ids) / (n_workers * 4)), 1, 5000))
+    chunks = [track_ids[i:i + chunk_size] for i in range(0, len(track_ids), chunk_size)]
+
+    def _chunk_args(chunk):
+        values, offsets = tracks_index.ragged(column, chunk)
+        return chunk, values, offsets, window, threshold
+
+    if n_workers == 1 or len(chunks) <= 1:
+        for i, chunk in enumerate(chunks):
+            yield (i, len(chunk)) + _fit_steps_chunk(*_chunk_args(chunk))
+        return
+
+    executor = _process_pool(n_workers)
+    pending = {}
+    try:
+        chunk_iter = iter(enumerate(chunks))
+
+        def _submit(count):
+            for i, chunk in islice(chunk_iter, count):
+                pending[executor.submit(_fit_steps_chunk, *_chunk_args(chunk))] = (i, len(chunk))
+
+        _submit(n_workers * 2)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, count = pending.pop(future)
+                yield (i, count) + future.result()
+            _submit(len(done))
+    finally:
+        _shutdown_pool(executor, pending)
+
+
+def fit_steps(tracks_index: TrackIndex, track_ids, window=20, threshold=0.5, column='intensity_mean',
+              n_workers: int = 1, chunk_size: int = None):
+    """
+    Step fitting of the given tracks with find_steps_batch, see fit_steps_iter for n_workers / chunk_size.
+    The result does not depend on the number of workers.
+    returns:
+        steps_df: pd.DataFrame STEP_TABLE_COLUMNS + ['track_id'] one row per step
+        steps_meta_df: pd.DataFrame STEP_META_COLUMNS one row per track
+    """
+    results = {}
+    for i, _, steps_df, steps_meta_df in fit_steps_iter(tracks_index, track_ids, window=window,
+                                                         threshold=threshold, column=column,
+                                                         n_workers=n_workers, chunk_size=chunk_size):
+        results[i] = (steps_df, steps_meta_df)
+    return concat_step_results(results)
+
+
+def concat_step_results(results: dict):
+    """
+    steps_df and steps_meta_df from the {chunk position: (steps_df, steps_meta_df)} of fit_steps_iter,
+    in a single concatenation each
+    """
+    if not results:
+        return _fit_steps_chunk(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(1, dtype=np.int64))
+    ordered = [results[i] for i in sorted(results)]
+    steps_df = pd.concat([r[0] for r in ordered], ignore_index=True)
+    steps_meta_df = pd.concat([r[1] for r in ordered], ignore_index=True)
+    return steps_df, steps_meta_df
+
+
+def fitx_from_steps(step_index: np.ndarray, level_before: np.ndarray, level_after: np.ndarray, length: int):
+    """
+    fitx of a trace rebuilt from its step table (the levels are the segment means)
+    """
+    fitx = np.zeros(length)
+    if len(step_index):
+        bounds = np.concatenate([[0], step_index, [length]])
+        levels = np.concatenate([level_before[:1], level_after])
+        fitx[:] = np.repeat(levels, np.diff(bounds))
+    return fitx
+
+
+def step_dwell_table(steps_df: pd.DataFrame, steps_meta_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Tidy dwell time table of a step analysis result, one row per step:
+    ['track_id', 'step_count', 'step', 'dwell_before'], step is the 1 based position of
+    the step in its track
+    """
+    dwell_df = steps_df[['track_id', 'dwell_before']].merge(
+        steps_meta_df[['track_id', 'step_count']], on='track_id', how='left')
+    dwell_df['step'] = dwell_df.groupby('track_id').cumcount() + 1
+    return dwell_df[['track_id', 'step_count', 'step', 'dwell_before']]
+
+
+class StepFitCache:
+    """
+    Bounded LRU cache of the fitx of single tracks keyed by (track_id, window, threshold, data version).
+
+    Step tables of a "Fit All" run can be registered with add_steps, a miss then rebuilds
+    the fitx from the registered table instead of fitting the track again. The dwell table
+    of a registered run is built once and kept with it (dwell_table).
+    """
+
+    def __init__(self, maxsize: int = 1024, max_results: int = 4):
+        self.maxsize = maxsize
+        self.max_results = max_results
+        self._fits = OrderedDict()
+        self._results = OrderedDict()
+
+    def clear(self):
+        self._fits.clear()
+        self._results.clear()
+
+    def __len__(self):
+        return len(self._fits)
+
+    def get(self, track_id, window, threshold, version):
+        key = (track_id, window, threshold, version)
+        if key in self._fits:
+            self._fits.move_to_end(key)
+            return self._fits[key]
+
+        steps = self._results.get((window, threshold, version))
+        if steps is None:
+            return None
+        steps_index, lengths = steps[:2]
+        if track_id not in lengths:
+            return None
+        self._results.move_to_end((window, threshold, version))
+        if track_id in steps_index:
+            step_index, level_before, level_after = steps_index.values(
+                ['step_index', 'level_before', 'level_after'], track_id).T
+            fitx = fitx_from_steps(step_index.astype(np.int64), level_before, level_after, lengths[track_id])
+        else:
+            fitx = np.zeros(lengths[track_id])
+        self.put(track_id, window, threshold, version, fitx)
+        return fitx
+
+    def put(self, track_id, window, threshold, version, fitx):
+        key = (track_id, window, threshold, version)
+        self._fits[key] = fitx
+        self._fits.move_to_end(key)
+        while len(self._fits) > self.maxsize:
+            self._fits.popitem(last=False)
+
+    def add_steps(self, steps_df: pd.DataFrame, steps_meta_df: pd.DataFrame, window, threshold, version):
+        """
+        register the steps_df / steps_meta_df of fit_steps run with window / threshold on the data version
+        """
+        key = (window, threshold, version)
+        lengths = dict(zip(steps_meta_df['track_id'].to_numpy().tolist(), steps_meta_df['length'].to_numpy().tolist()))
+        steps_index = TrackIndex(steps_df, frame='step_index')
+        # the index does not keep steps_df alive
+        steps_index.column(['step_index', 'level_before', 'level_after'])
+        # [steps index, track lengths, steps_df, dwell table built on first use]
+        self._results[key] = [steps_index, lengths, weakref.ref(steps_df), None]
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def dwell_table(self, steps_df: pd.DataFrame, steps_meta_df: pd.DataFrame, window, threshold, version):
+        """
+        step_dwell_table of a step analysis result, kept with the run registered for
+        window / threshold / version when steps_df is its table, built every time otherwise
+        """
+        steps = self._results.get((window, threshold, version))
+        if steps is None or steps[2]() is not steps_df:
+            return step_dwell_table(steps_df, steps_meta_df)
+        if steps[3] is None:
+            steps[3] = step_dwell_table(steps_df, steps_meta_df)
+        return steps[3]
+
+
+def minmax_decimate(values: np.ndarray, start: int, stop: int, n_bins: int):
+    """
+    Min / max decimation of values[start:stop] for drawing, the range is split in n_bins
+    buckets (one per pixel column) and the min and the max of every bucket are kept in the
+    order they occur, so spikes and steps stay visible.
+    returns:
+        x, y: sample positions and values, the raw samples when there are less than 2 * n_bins
+    """
+    start = max(int(start), 0)
+    stop = min(int(stop), len(values))
+    if stop <= start:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    n_bins = max(int(n_bins), 1)
+    segment = np.asarray(values[start:stop], dtype=np.float64)
+    if len(segment) <= 2 * n_bins:
+        return np.arange(start, stop), segment
+
+    width = int(np.ceil(len(segment) / n_bins))
+    n_buckets = int(np.ceil(len(segment) / width))
+    padding = n_buckets * width - len(segment)
+    buckets_min = np.append(segment, np.full(padding, np.inf)).reshape(n_buckets, width)
+    buckets_max = np.append(segment, np.full(padding, -np.inf)).reshape(n_buckets, width)
+    first = np.arange(n_buckets) * width
+    positions = np.stack([first + np.argmin(buckets_min, axis=1),
+                          first + np.argmax(buckets_max, axis=1)], axis=1)
+    positions.sort(axis=1)
+    positions = positions.ravel()
+    return positions + start, segment[positions]
+
+
+def step_change_points(fitx: np.ndarray) -> np.ndarray:
+    """
+    Positions needed to draw a piecewise constant fit exactly as a polyline:
+    the ends and both samples around every level change
+    """
+    n = len(fitx)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    change = np.flatnonzero(np.diff(fitx) != 0)
+    return np.unique(np.concatenate([[0, n - 1], change, change + 1]))
+
+
 def histogram(data, binsize=5):
     try:
         data = np.array(data).ravel()
@@ -280,3 +1113,167 @@ def remove_small_objects(img, min_size=10, connectivity=2):
     # print(ret.dtype)
     # print(ret)
     return ret
+
+
+# stacks larger than this are memory mapped to a temporary file instead of held in memory
+OUTPUT_MEMORY_LIMIT = 2 * 1024 ** 3
+
+
+def allocate_stack(shape, dtype, memory_limit: int = None) -> np.ndarray:
+    """
+    Output array of a per frame pipeline, in memory or, when larger than memory_limit
+    (OUTPUT_MEMORY_LIMIT by default), memory mapped to an anonymous temporary file
+    """
+    memory_limit = OUTPUT_MEMORY_LIMIT if memory_limit is None else memory_limit
+    shape = tuple(int(n) for n in shape)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes == 0 or nbytes <= memory_limit:
+        return np.zeros(shape, dtype=dtype)
+    # the mapping keeps the file, it is removed when the array is released
+    with tempfile.TemporaryFile() as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+
+TEMPORAL_FILTERS = ("mean", "median", "ema")
+# working memory of a temporal filter chunk (float64 frames)
+FILTER_CHUNK_BYTES = 256 * 1024 ** 2
+# the median costs O(window) per pixel and output frame, the widget limits its window to this
+MEDIAN_MAX_WINDOW = 31
+
+
+def _filter_chunk_size(frame_shape, window: int, frames_per_output: int = 1, chunk_bytes: int = None) -> int:
+    # output frames per chunk, the chunk reads chunk_size + window - 1 frames
+    # and an output frame takes frames_per_output frames of working memory
+    chunk_bytes = FILTER_CHUNK_BYTES if chunk_bytes is None else chunk_bytes
+    frame_bytes = max(int(np.prod(frame_shape)), 1) * np.dtype(np.float64).itemsize
+    return max(chunk_bytes // (frame_bytes * frames_per_output) - window + 1, 1)
+
+
+def _rolling_median(frames: np.ndarray, window: int) -> np.ndarray:
+    """
+    median of every window frames of the chunk, len(frames) - window + 1 frames (no edge frames).
+    The windows are copied side by side and every median is a selection (np.partition) over its
+    window, so the cost and the working memory grow linearly with the window, unlike the running
+    sum of the mean
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(frames, window, axis=0).copy()
+    middle = window // 2
+    if window % 2:
+        windows.partition(middle, axis=-1)
+        return windows[..., middle]
+    # even window, mean of the two middle values as np.median
+    windows.partition((middle - 1, middle), axis=-1)
+    return (windows[..., middle - 1].astype(np.float64) + windows[..., middle]) / 2
+
+
+def temporal_filter(stack, window: int = 4, method: str = "mean", chunk_size: int = None,
+                    out: np.ndarray = None) -> np.ndarray:
+    """
+    Rolling filter over window frames along the first axis of the stack, frame i of the result
+    is computed from the frames [i, i + window) of the stack:
+        mean: running sum in float64 (no overflow of integer stacks)
+        median: sliding window median, O(window) per pixel and output frame (see _rolling_median)
+        ema: exponential moving average (alpha = 2 / (window + 1)) up to the frame i + window - 1,
+             started at the first frame
+    The stack is read chunk_size output frames at a time (sized to FILTER_CHUNK_BYTES by default),
+    so memory mapped and dask stacks are not loaded. The result is float32, written to out or to
+    an array from allocate_stack.
+    """
+    if method not in TEMPORAL_FILTERS:
+        raise ValueError(f"unknown temporal filter {method}, expected one of {TEMPORAL_FILTERS}")
+    window = int(window)
+    if window < 1:
+        raise ValueError(f"window has to be at least 1, got {window}")
+    n_frames = stack.shape[0]
+    frame_shape = tuple(stack.shape[1:])
+    n_out = max(n_frames - window + 1, 0)
+    if out is None:
+        out = allocate_stack((n_out,) + frame_shape, np.float32)
+    if chunk_size is None:
+        chunk_size = _filter_chunk_size(frame_shape, window, frames_per_output=window if method == "median" else 1)
+
+    if method == "ema":
+        alpha = 2.0 / (window + 1)
+        state = None
+        # the frames may be views of the (read only) stack, the update goes through a scratch frame
+        scratch = np.empty(frame_shape, dtype=np.float64)
+        for start in range(0, n_frames, chunk_size):
+            frames = np.asarray(stack[start:start + chunk_size])
+            for j, frame in enumerate(frames):
+                if state is None:
+                    state = frame.astype(np.float64)
+                else:
+                    # state += alpha * (frame - state), without temporaries
+                    np.subtract(frame, state, out=scratch)
+                    scratch *= alpha
+                    state += scratch
+                t = start + j
+                if t >= window - 1:
+                    out[t - window + 1] = state
+        return out
+
+    for start in range(0, n_out, chunk_size):
+        stop = min(start + chunk_size, n_out)
+        # the chunk overlaps the previous one by window - 1 frames
+        frames = np.asarray(stack[start:stop + window - 1])
+        if method == "median":
+            out[start:stop] = _rolling_median(frames, window)
+            continue
+        total = np.cumsum(frames, axis=0, dtype=np.float64)
+        out[start] = total[window - 1] / window
+        if stop - start > 1:
+            total[window:] -= total[:-window]
+            total[window:] /= window
+            out[start + 1:stop] = total[window:]
+    return out
+
+
+def walking_average(stack, window: int = 4, out: np.ndarray = None) -> np.ndarray:
+    """
+    Moving average over window frames, frame i of the result is the mean of the frames
+    [i, i + window) of the stack, see temporal_filter
+    """
+    return temporal_filter(stack, window=window, method="mean", out=out)
+
+
+def predict_stack_iter(predict, images, out: np.ndarray, post_process=None, chunk_size: int = 8,
+                       n_workers: int = None):
+    """
+    Per frame inference of a stack, pipelined by chunks of frames: the frames of a chunk are
+    read at once and queued on the classifier, the host side work of the chunk (copy back of the
+    results, post_process, write to out) runs in a thread pool while the next chunk is predicted.
+    At most n_workers chunks wait for post processing, which bounds the device memory held.
+
+    params:
+        predict: callable(frame) -> result of the frame (a device or numpy array), only called
+                 from the calling thread
+        post_process: callable(frame index, numpy result) -> frame of out, None writes the result
+        n_workers: int number of post processing threads, None uses up to 4
+    yields:
+        number of frames written to out, chunk by chunk in order
+    """
+    n_frames = images.shape[0]
+    n_workers = min(4, os.cpu_count() or 1) if n_workers is None else max(1, int(n_workers))
+
+    def _post_process_chunk(start, results):
+        for j, values in enumerate(results):
+            values = np.asarray(values)
+            out[start + j] = values if post_process is None else post_process(start + j, values)
+        return len(results)
+
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending = deque()
+    try:
+        for start in range(0, n_frames, chunk_size):
+            frames = np.asarray(images[start:start + chunk_size])
+            results = [predict(frame) for frame in frames]
+            pending.append(executor.submit(_post_process_chunk, start, results))
+            while len(pending) > n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # shutdown(cancel_futures=True) needs python 3.9
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)